@@ -4,6 +4,7 @@ import json
 import logging
 import time
 import asyncio
+import uuid
 from datetime import datetime, timedelta
 from urllib.parse import parse_qs, urlparse
 
@@ -35,13 +36,28 @@ from mongodb_client import (
     save_enriched_data, save_generated_emails, collection,
     generated_emails_collection, lead_exists, delete_lead_by_id,
     delete_email_by_id, get_signature, save_signature,
-    scheduled_emails_collection
+    scheduled_emails_collection, aggregate_llm_usage, fetch_batch_jobs,
+    fetch_generated_emails_for_campaign, fetch_generation_job, fetch_generation_jobs
 )
 from outlook_sender import prepare_outlook_email_payloads, OutlookSender
 from people_search import get_people_search_results
 from people_enrich import get_people_data
 from mail_generation import EmailGenerationPipeline
+from generation_engine import (
+    GENERATION_CONCURRENCY, MAX_GENERATION_CONCURRENCY,
+    MODE_SINGLE as GENERATION_MODE_SINGLE, MODE_SEQUENCE as GENERATION_MODE_SEQUENCE,
+    MODE_BATCH as GENERATION_MODE_BATCH, MODE_SEGMENT as GENERATION_MODE_SEGMENT
+)
 from email_sender import EmailSender, prepare_email_payloads
+from batch_generation import (
+    submit_campaign_batch, poll_batch_jobs, merge_lead_blocks, STATE_INGESTED as BATCH_STATE_INGESTED
+)
+from generation_jobs import (
+    create_generation_job, start_generation_job, is_resumable, has_failed_leads, load_job_results,
+    STATE_RUNNING as GENERATION_STATE_RUNNING, STATE_COMPLETED as GENERATION_STATE_COMPLETED
+)
+from incremental_regeneration import run_incremental_regeneration
+from lead_matching import get_product_matcher, assign_products, LEAD_FIT_THRESHOLD
 
 # Initialize Flask app
 app = Flask(__name__)
@@ -965,69 +981,234 @@ def main():
                 default=[0, 3, 8, 17]
             )
             
+            concurrency = st.number_input(
+                "Concurrent generations",
+                min_value=1,
+                max_value=MAX_GENERATION_CONCURRENCY,
+                value=GENERATION_CONCURRENCY,
+                help="Maximum number of emails generated in parallel"
+            )
+            generation_modes = {
+                "One request per lead (all intervals)": GENERATION_MODE_SEQUENCE,
+                "Batch several leads per request": GENERATION_MODE_BATCH,
+                "One request per email": GENERATION_MODE_SINGLE,
+                "One template per segment (industry, title)": GENERATION_MODE_SEGMENT
+            }
+            generation_mode = st.selectbox(
+                "Generation mode",
+                list(generation_modes.keys()),
+                help="Batching sends the shared product and style guides once for several leads; failed items are regenerated individually. "
+                     "Segment templates are written once per industry and title and filled in with each lead's details, for very large campaigns"
+            )
+            force_regenerate = st.checkbox(
+                "Force regenerate",
+                value=False,
+                help="Ignore previously generated emails for the same leads, product and intervals"
+            )
+            followup_generation = st.radio(
+                "Follow-up generation",
+                ["Now", "Just in time", "Batch job"],
+                horizontal=True,
+                help="Just in time: each follow-up is generated shortly before it is sent, and never if the lead has replied. "
+                     "Batch job: follow-ups are generated by a cheaper batch job and appear under Batch jobs when it completes"
+            )
+            defer_followups = followup_generation == "Just in time"
+            batch_followups = followup_generation == "Batch job"
+            product_fit = st.radio(
+                "Product fit",
+                ["Generate every lead", "Skip poor-fit leads", "Auto-assign best product"],
+                horizontal=True,
+                help="Leads are scored against every product by how well their title, industry and company keywords match it. "
+                     "Skip poor-fit leads generates only leads that fit the selected product; auto-assign generates each lead for its best-fitting product"
+            )
+            fit_threshold = LEAD_FIT_THRESHOLD
+            if product_fit != "Generate every lead":
+                fit_threshold = st.slider("Minimum fit score", 0.0, 0.5, LEAD_FIT_THRESHOLD, 0.01)
+            
+            with st.expander("Lead fit scores"):
+                if st.button("Score leads"):
+                    score_leads = st.session_state["enriched_data"].to_dict(orient="records")
+                    matcher = get_product_matcher()
+                    scores = matcher.score(score_leads)
+                    fit_df = pd.DataFrame(scores, columns=matcher.keys).round(3)
+                    fit_df.insert(0, "lead", [lead.get("name", "") for lead in score_leads])
+                    fit_df.insert(1, "best product", [matcher.keys[column] for column in scores.argmax(axis=1)] if len(score_leads) else [])
+                    st.dataframe(fit_df, use_container_width=True)
+            
             if st.button("Generate Emails"):
-                with st.spinner("Generating emails, please wait..."):
-                    from personalised_email import FOLLOWUP_PROMPTS, generate_email_for_single_lead_with_custom_prompt
-                    product_details = get_product_details(product.lower())
-                    
-                    # Get all enriched leads
-                    enriched_df = st.session_state["enriched_data"]
-                    all_leads = enriched_df.to_dict(orient="records")
-                    
-                    logging.info(f"Generating emails for {len(all_leads)} leads with product: {product}")
-                    
-                    # Get user's signature
+                # Get all enriched leads
+                enriched_df = st.session_state["enriched_data"]
+                all_leads = enriched_df.to_dict(orient="records")
+                
+                lead_products = None
+                if product_fit == "Skip poor-fit leads":
+                    try:
+                        all_leads, dropped_leads, _ = get_product_matcher().filter_by_fit(all_leads, product, fit_threshold)
+                        st.info(f"Skipping {len(dropped_leads)} leads with a fit score below {fit_threshold:.2f} for {product}")
+                    except ValueError as e:
+                        st.warning(f"{e}; generating every lead")
+                elif product_fit == "Auto-assign best product":
+                    assignments, _ = assign_products(all_leads, fit_threshold)
+                    display_names = {name.lower(): name for name in PRODUCTS}
+                    assigned = [(lead, display_names.get(key, key)) for lead, key in zip(all_leads, assignments) if key]
+                    st.info(f"Assigned a product to {len(assigned)} leads, skipping {len(all_leads) - len(assigned)} that fit no product")
+                    all_leads = [lead for lead, _ in assigned]
+                    lead_products = [name for _, name in assigned]
+                
+                logging.info(f"Generating emails for {len(all_leads)} leads with product: {product if lead_products is None else 'auto-assigned'}")
+                
+                if not all_leads:
+                    st.warning("No leads left to generate emails for.")
+                else:
                     user_email = get_user_email()
-                    signature = get_signature(user_email)
+                    campaign_id = uuid.uuid4().hex
+                    batch_days = [day for day in intervals if day > 0] if batch_followups else []
+                    if batch_days:
+                        product_groups = {}
+                        for lead, lead_product in zip(all_leads, lead_products or [product] * len(all_leads)):
+                            product_groups.setdefault(lead_product, []).append(lead)
+                        failed_products = []
+                        for group_product, group_leads in product_groups.items():
+                            try:
+                                batch_job_id = submit_campaign_batch(
+                                    group_leads, group_product, get_product_details(group_product.lower()), batch_days, user_email, campaign_id
+                                )
+                                st.info(f"{group_product} follow-ups for days {', '.join(map(str, batch_days))} submitted as batch job {batch_job_id}")
+                            except Exception as e:
+                                logging.error(f"Batch submission for {group_product} failed: {e}")
+                                failed_products.append(group_product)
+                                st.error(f"Could not submit the {group_product} follow-ups as a batch job: {e}")
+                        if len(failed_products) == len(product_groups):
+                            st.warning("Generating the follow-ups now instead.")
+                            batch_days = []
+                        elif failed_products:
+                            st.warning(f"Follow-ups for {', '.join(failed_products)} leads were not generated; generate them again for those leads.")
                     
-                    all_generated_emails = []
-                    for lead in all_leads:
-                        lead_emails = []
-                        # Get recipient details from lead data
-                        recipient_name = lead.get('name', 'No recipient')
-                        recipient_email = lead.get('email', 'No email provided')
+                    # Run generation as a checkpointed background job so reruns and restarts don't lose progress
+                    create_generation_job(
+                        all_leads,
+                        product_name=product,
+                        intervals=[day for day in intervals if day not in batch_days],
+                        user_email=user_email,
+                        campaign_id=campaign_id,
+                        mode=generation_modes[generation_mode],
+                        max_concurrency=concurrency,
+                        force_regenerate=force_regenerate,
+                        defer_followups=defer_followups,
+                        lead_products=lead_products
+                    )
+                    start_generation_job(campaign_id)
+                    st.session_state["generation_job_id"] = campaign_id
+                    st.session_state["generation_job_loaded"] = False
+
+            generation_job_id = st.session_state.get("generation_job_id")
+            if generation_job_id:
+                job = fetch_generation_job(generation_job_id)
+                if job is not None:
+                    done = job.get('completed_leads', 0)
+                    total = max(job.get('lead_count', 0), 1)
+                    st.progress(min(done / total, 1.0), text=f"Generated {done}/{job.get('lead_count', 0)} leads ({job['state']})")
+                    if job['state'] == GENERATION_STATE_RUNNING and not is_resumable(job):
+                        # Poll the job record until the background run finishes
+                        time.sleep(2)
+                        st.rerun()
+                    elif is_resumable(job) and job['state'] != GENERATION_STATE_COMPLETED:
+                        st.warning(f"Generation stopped before finishing{': ' + job['error'] if job.get('error') else ''}")
+                        if st.button("Resume generation"):
+                            start_generation_job(generation_job_id)
+                            st.rerun()
+                    elif job['state'] == GENERATION_STATE_COMPLETED and not st.session_state.get("generation_job_loaded"):
+                        user_email = get_user_email()
+                        all_generated_emails = load_job_results(generation_job_id, user_email)
                         
-                        for day in sorted(intervals):
-                            prompt = FOLLOWUP_PROMPTS[day]
-                            email = generate_email_for_single_lead_with_custom_prompt(
-                                lead_details=lead,
-                                product_details=product_details,
-                                prompt=prompt,
-                                subject_style=subject_style,
-                                body_style=body_style,
-                                recipient_name=recipient_name,
-                                recipient_email=recipient_email,
-                                product_name=product,
-                                followup_day=day
+                        # Token, latency and cost accounting for this run
+                        usage = aggregate_llm_usage('campaign', campaign_id=generation_job_id)
+                        if usage:
+                            usage = usage[0]
+                            st.info(
+                                f"LLM usage: {usage['calls']} calls, {usage['total_tokens']:,} tokens "
+                                f"({usage['prompt_tokens']:,} prompt / {usage['response_tokens']:,} response), "
+                                f"avg latency {usage['avg_latency_ms'] or 0:.0f} ms, est. cost ${usage['cost_usd'] or 0:.4f}"
                             )
-                            
-                            # Add signature if it exists
-                            if signature:
-                                body = email.get('body', '')
-                                if body.strip().endswith("Best Regards,"):
-                                    body = body.rstrip() + f"\n\n{signature['name']}\n{signature['company']}\n{signature['linkedin_url']}\n"
-                                    email['body'] = body
-                            
-                            email["interval_day"] = day
-                            lead_emails.append(email)
-                            
-                        all_generated_emails.append({
-                            "lead_id": lead.get("id") or lead.get("lead_id"),
-                            "lead_name": lead.get("name"),
-                            "emails": lead_emails
-                        })
-                    
-                    # Save generated emails both locally and to MongoDB
-                    filename = save_generated_emails_locally(all_generated_emails, user_email)
-                    if filename:
-                        st.success(f"Emails saved locally to {filename}")
-                    
-                    # Save to MongoDB as well
-                    save_generated_emails(all_generated_emails, user_email)
-                    st.success("Emails saved to database")
-                    
-                    st.session_state["generated_emails"] = all_generated_emails
-                    st.session_state["mail_generation_completed"] = True
+                        
+                        # Emails that failed generation were never saved; report them instead
+                        if job.get('failed_count'):
+                            st.error(f"{job['failed_count']} emails could not be generated and were left out:")
+                            st.dataframe(pd.DataFrame(job.get('failures', [])), use_container_width=True)
+                        
+                        # Results are already in MongoDB (checkpointed per lead); keep a local copy too
+                        filename = save_generated_emails_locally(all_generated_emails, user_email)
+                        if filename:
+                            st.success(f"Emails saved locally to {filename}")
+                        st.success("Emails saved to database")
+                        
+                        st.session_state["generated_emails"] = all_generated_emails
+                        st.session_state["mail_generation_completed"] = True
+                        st.session_state["generation_job_loaded"] = True
+                    if job['state'] == GENERATION_STATE_COMPLETED and has_failed_leads(job) and is_resumable(job):
+                        if st.button("Retry failed leads"):
+                            start_generation_job(generation_job_id)
+                            st.session_state["generation_job_loaded"] = False
+                            st.rerun()
+
+            with st.expander("Generation jobs"):
+                user_email = get_user_email()
+                generation_jobs = fetch_generation_jobs(user_email)
+                if generation_jobs:
+                    st.dataframe(pd.DataFrame([
+                        {key: job.get(key) for key in ('_id', 'product_name', 'state', 'lead_count', 'completed_leads', 'failed_count', 'created_at')}
+                        for job in generation_jobs
+                    ]), use_container_width=True)
+                    resumable_jobs = [job['_id'] for job in generation_jobs if is_resumable(job)]
+                    if resumable_jobs:
+                        selected_generation_job = st.selectbox("Unfinished job", resumable_jobs)
+                        if st.button("Resume job"):
+                            start_generation_job(selected_generation_job)
+                            st.session_state["generation_job_id"] = selected_generation_job
+                            st.session_state["generation_job_loaded"] = False
+                            st.rerun()
+                else:
+                    st.write("No generation jobs yet.")
+
+            with st.expander("Batch jobs"):
+                user_email = get_user_email()
+                if st.button("Check batch jobs"):
+                    ingested = poll_batch_jobs(user_email)
+                    st.success(f"{ingested} batch jobs completed and saved to the database")
+                batch_jobs = fetch_batch_jobs(user_email)
+                if batch_jobs:
+                    st.dataframe(pd.DataFrame([
+                        {key: job.get(key) for key in ('_id', 'product_name', 'state', 'item_count', 'generated_count', 'failed_count', 'created_at', 'completed_at')}
+                        for job in batch_jobs
+                    ]), use_container_width=True)
+                    ingested_jobs = [job for job in batch_jobs if job['state'] == BATCH_STATE_INGESTED]
+                    if ingested_jobs:
+                        selected_job = st.selectbox("Completed job", [job['_id'] for job in ingested_jobs])
+                        if st.button("Load batch results"):
+                            job = next(job for job in ingested_jobs if job['_id'] == selected_job)
+                            st.session_state["generated_emails"] = merge_lead_blocks(
+                                st.session_state.get("generated_emails") or [],
+                                [block for block in fetch_generated_emails_for_campaign(job['campaign_id'], user_email) if block.get("batch_job_id") == job['_id']]
+                            )
+                            st.success("Batch results added to the generated emails")
+                else:
+                    st.write("No batch jobs yet.")
+
+            with st.expander("Stale scheduled emails"):
+                st.caption("Scheduled emails that haven't been sent yet, generated from a product entry or prompt that has since changed.")
+                if st.button("Check for stale emails"):
+                    st.write(run_incremental_regeneration(get_user_email(), dry_run=True))
+                if st.button("Regenerate stale emails"):
+                    with st.spinner("Regenerating stale emails..."):
+                        st.write(run_incremental_regeneration(get_user_email()))
+
+            with st.expander("LLM usage"):
+                usage_group = st.selectbox("Group by", ["day", "campaign", "model", "interval_day"])
+                usage_rows = aggregate_llm_usage(usage_group, user_email=get_user_email())
+                if usage_rows:
+                    st.dataframe(pd.DataFrame(usage_rows), use_container_width=True)
+                else:
+                    st.write("No LLM calls recorded yet.")
 
             if st.session_state.get("generated_emails"):
                 st.subheader("Generated Emails & Follow-ups Preview")
@@ -1047,6 +1228,9 @@ def main():
                     tabs = st.tabs([f"Day {email['interval_day']}" for email in lead_block["emails"]])
                     for idx, email in enumerate(lead_block["emails"]):
                         with tabs[idx]:
+                            if email.get("deferred"):
+                                st.info("This follow-up will be generated shortly before it is sent, unless the lead replies first.")
+                                continue
                             st.markdown(f"<div class='followup-email-meta'><b>To:</b> {email.get('recipient_email','')}</div>", unsafe_allow_html=True)
                             st.markdown(f"<div class='followup-email-meta'><b>Subject:</b> {email.get('subject','')}</div>", unsafe_allow_html=True)
                             st.markdown(f"<div style='margin-top:10px;'><b>Body:</b></div>", unsafe_allow_html=True)
@@ -1145,6 +1329,22 @@ def main():
                                     body = email.get("body", "")
                                     interval_day = email.get("interval_day", 0)
                                     
+                                    if email.get("deferred"):
+                                        # Generated by the scheduled email worker close to send time
+                                        followup_payloads.append({
+                                            "email": [recipient_email],
+                                            "subject": "",
+                                            "body": "",
+                                            "interval_day": interval_day,
+                                            "sender_email": sender_email,
+                                            "sender_name": sender_name,
+                                            "lead_id": lead_id,
+                                            "lead_name": lead_block.get("lead_name", ""),
+                                            "deferred": True,
+                                            "generation": email["generation"]
+                                        })
+                                        continue
+                                    
                                     if not all([recipient_email, subject, body]):
                                         print(f"[DEBUG] Skipping: missing required fields for lead_id {lead_id}")
                                         continue
@@ -1173,7 +1373,8 @@ def main():
                                         "sender_email": sender_email,
                                         "sender_name": sender_name,
                                         "lead_id": lead_id,
-                                        "lead_name": lead_block.get("lead_name", "")
+                                        "lead_name": lead_block.get("lead_name", ""),
+                                        "generation": email.get("generation")
                                     }
                                     
                                     # Separate immediate and follow-up emails
@@ -1218,60 +1419,12 @@ def main():
                     # Save follow-up emails to MongoDB for scheduling
                     if followup_payloads:
                         print(f"[DEBUG] Saving {len(followup_payloads)} follow-up emails for scheduling")
-                        from mongodb_client import scheduled_emails_collection
+                        from mongodb_client import schedule_followup_emails_bulk
                         
-                        # Check if we're in development mode
-                        import os  # Ensure os is imported in this scope
-                        is_development = os.getenv('ENVIRONMENT', 'production').lower() == 'development'
-                        
-                        # Group follow-ups by lead
-                        followups_by_lead = {}
-                        for payload in followup_payloads:
-                            lead_email = payload['email'][0]
-                            if lead_email not in followups_by_lead:
-                                followups_by_lead[lead_email] = []
-                            followups_by_lead[lead_email].append(payload)
-                        
-                        # Save follow-ups for each lead
-                        for lead_email, lead_payloads in followups_by_lead.items():
-                            try:
-                                # Calculate scheduled time for each follow-up
-                                for payload in lead_payloads:
-                                    interval_day = payload['interval_day']
-                                    if is_development:
-                                        # In development, schedule for 2 minutes after current time
-                                        scheduled_time = current_time + timedelta(minutes=2)
-                                    else:
-                                        # In production, schedule for 9 AM on the specified day
-                                        scheduled_time = current_time + timedelta(days=interval_day)
-                                        scheduled_time = scheduled_time.replace(hour=9, minute=0, second=0, microsecond=0)
-                                    
-                                    # Create scheduled email document
-                                    scheduled_email = {
-                                        "email": payload['email'],
-                                        "subject": payload['subject'],
-                                        "body": payload['body'],
-                                        "sender_email": payload['sender_email'],
-                                        "sender_name": payload['sender_name'],
-                                        "scheduled_time": scheduled_time,
-                                        "status": "pending",
-                                        "followup_day": 0 if is_development else interval_day,
-                                        "responded": False,
-                                        "conversation_id": f"{payload['sender_email']}_{lead_email}_{current_time.strftime('%Y%m%d%H%M%S')}",
-                                        "lead_id": payload['lead_id'],
-                                        "lead_name": payload['lead_name']
-                                    }
-                                    
-                                    # Save to MongoDB
-                                    result = scheduled_emails_collection.insert_one(scheduled_email)
-                                    if result.inserted_id:
-                                        successful += 1
-                                    else:
-                                        failed += 1
-                                        
-                            except Exception as e:
-                                print(f"[DEBUG] Error saving follow-up for {lead_email}: {str(e)}")
-                                failed += 1
+                        # Build every follow-up document in memory and write them in one round trip
+                        scheduled, failed_to_schedule = schedule_followup_emails_bulk(followup_payloads, current_time, user_email=get_user_email())
+                        successful += scheduled
+                        failed += failed_to_schedule
                         
                         st.success(f"Successfully scheduled {successful} follow-up emails")
                         if failed > 0:
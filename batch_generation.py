@@ -0,0 +1,353 @@
+import os
+import json
+import uuid
+import logging
+from types import SimpleNamespace
+from datetime import datetime, timedelta
+import requests
+from personalised_email import (
+    build_email_prompt, validate_email_response, failed_email, generate_email_with_gemini, EMAIL_RESPONSE_SCHEMA
+)
+from gemini_client import GEMINI_MODEL_NAME, get_key_pool
+from generation_engine import append_signature, split_failed_emails, generation_record
+from llm_usage import record_llm_call, flush_usage, usage_context
+from llm_backend import LLM_BACKEND
+from mongodb_client import (
+    save_batch_job, update_batch_job, fetch_batch_jobs, fetch_batch_job, claim_batch_job_ingest,
+    save_batch_lead_blocks, get_signature
+)
+
+logger = logging.getLogger(__name__)
+
+# "gemini" submits to the Gemini Batch API, "local" runs the file-based stand-in
+# (the default with LLM_BACKEND=stub, so batch jobs are answered by the stub too)
+BATCH_BACKEND = os.getenv('GEMINI_BATCH_BACKEND', 'local' if LLM_BACKEND == 'stub' else 'gemini').lower()
+# Where job input/output JSONL files are written
+BATCH_JOB_DIR = os.getenv('BATCH_JOB_DIR', 'batch_jobs')
+GEMINI_API_BASE = os.getenv('GEMINI_API_BASE', 'https://generativelanguage.googleapis.com/v1beta')
+GEMINI_UPLOAD_BASE = os.getenv('GEMINI_UPLOAD_BASE', 'https://generativelanguage.googleapis.com/upload/v1beta')
+GEMINI_DOWNLOAD_BASE = os.getenv('GEMINI_DOWNLOAD_BASE', 'https://generativelanguage.googleapis.com/download/v1beta')
+# Input files larger than this are uploaded through the Files API instead of
+# being sent inline (the inline batch request is capped at about 20 MB)
+BATCH_INLINE_MAX_BYTES = int(os.getenv('BATCH_INLINE_MAX_BYTES', str(10 * 1024 * 1024)))
+# Failed items kept on the job record for reporting
+MAX_REPORTED_FAILURES = 50
+# An ingest still unfinished after this many seconds is assumed dead and can be claimed again
+BATCH_INGEST_TIMEOUT = int(os.getenv('BATCH_INGEST_TIMEOUT', '600'))
+
+# Job states
+STATE_SUBMITTED = 'submitted'
+STATE_INGESTING = 'ingesting'
+STATE_FAILED = 'failed'
+STATE_INGESTED = 'ingested'
+
+def write_jsonl(path, records):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, default=str) + '\n')
+
+def read_jsonl(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def request_key(lead_index: int, day: int) -> str:
+    return f"{lead_index}:{day}"
+
+def build_batch_requests(leads: list, product_name: str, product_details: dict, days: list) -> list:
+    """One JSONL record per (lead, interval day): {"key", "request"} in generateContent request format."""
+    records = []
+    for lead_index, lead in enumerate(leads):
+        for day in sorted(days):
+            records.append({
+                "key": request_key(lead_index, day),
+                "request": {
+                    "contents": [{"role": "user", "parts": [{"text": build_email_prompt(lead, product_details, product_name, day)}]}],
+                    "generationConfig": {"responseMimeType": "application/json", "responseSchema": EMAIL_RESPONSE_SCHEMA}
+                }
+            })
+    return records
+
+class BatchJobFailed(Exception):
+    """The batch backend reported that a job failed, expired or was cancelled."""
+
+def _request_prompt(request: dict) -> str:
+    return "".join(part.get("text", "") for content in request["contents"] for part in content["parts"])
+
+class LocalBatchBackend:
+    """
+    File-based stand-in for the provider's batch interface. Submitting just
+    records the input file; the first poll runs every request through
+    generate_fn (the interactive path by default) and writes the output
+    JSONL, so the whole submit/poll/ingest flow can run offline in tests.
+    """
+    name = 'local'
+
+    def __init__(self, generate_fn=None):
+        self.generate_fn = generate_fn or generate_email_with_gemini
+
+    def submit(self, input_path: str, display_name: str, model_name: str = GEMINI_MODEL_NAME) -> dict:
+        return {'output_path': input_path.replace('.input.jsonl', '.output.jsonl')}
+
+    def poll(self, handle: dict, input_path: str):
+        """Path of the output JSONL once the job has finished, else None."""
+        output_path = handle['output_path']
+        if not os.path.exists(output_path):
+            results = []
+            for record in read_jsonl(input_path):
+                try:
+                    text = self.generate_fn(_request_prompt(record["request"]), EMAIL_RESPONSE_SCHEMA)
+                    results.append({"key": record["key"], "response": {"text": text}})
+                except Exception as e:
+                    results.append({"key": record["key"], "error": str(e)})
+            write_jsonl(output_path, results)
+        return output_path
+
+class GeminiBatchBackend:
+    """
+    Gemini Batch API (batchGenerateContent): cheaper per token than
+    interactive calls and billed against a separate quota. Small jobs are
+    sent inline; larger input files are uploaded through the Files API and
+    submitted by reference. Jobs usually finish within hours; poll() reports
+    progress until then.
+    """
+    name = 'gemini'
+
+    def _api_key(self):
+        return get_key_pool().keys[0].api_key
+
+    def _upload(self, input_path: str, display_name: str) -> str:
+        """Resumable upload of the JSONL input to the Files API. Returns the file name ("files/...")."""
+        size = os.path.getsize(input_path)
+        start = requests.post(
+            f"{GEMINI_UPLOAD_BASE}/files", params={'key': self._api_key()},
+            headers={
+                'X-Goog-Upload-Protocol': 'resumable',
+                'X-Goog-Upload-Command': 'start',
+                'X-Goog-Upload-Header-Content-Length': str(size),
+                'X-Goog-Upload-Header-Content-Type': 'application/jsonl'
+            },
+            json={'file': {'display_name': display_name}}, timeout=60
+        )
+        start.raise_for_status()
+        with open(input_path, 'rb') as f:
+            response = requests.post(
+                start.headers['X-Goog-Upload-URL'],
+                headers={'X-Goog-Upload-Offset': '0', 'X-Goog-Upload-Command': 'upload, finalize'},
+                data=f, timeout=600
+            )
+        response.raise_for_status()
+        return response.json()['file']['name']
+
+    def submit(self, input_path: str, display_name: str, model_name: str = GEMINI_MODEL_NAME) -> dict:
+        model = model_name if model_name.startswith('models/') else f"models/{model_name}"
+        if os.path.getsize(input_path) > BATCH_INLINE_MAX_BYTES:
+            # Each line of the input file is already a {"key", "request"} record
+            input_config = {"file_name": self._upload(input_path, display_name)}
+        else:
+            input_config = {"requests": {"requests": [
+                {"request": record["request"], "metadata": {"key": record["key"]}} for record in read_jsonl(input_path)
+            ]}}
+        body = {"batch": {"display_name": display_name, "input_config": input_config}}
+        response = requests.post(f"{GEMINI_API_BASE}/{model}:batchGenerateContent", params={'key': self._api_key()}, json=body, timeout=120)
+        response.raise_for_status()
+        return {'name': response.json()['name'], 'model': model_name,
+                'output_path': input_path.replace('.input.jsonl', '.output.jsonl')}
+
+    def poll(self, handle: dict, input_path: str):
+        """
+        Path of the output JSONL once the job has finished, else None.
+        Raises BatchJobFailed if the provider reports the job failed.
+        """
+        response = requests.get(f"{GEMINI_API_BASE}/{handle['name']}", params={'key': self._api_key()}, timeout=60)
+        response.raise_for_status()
+        data = response.json()
+        state = (data.get('metadata') or {}).get('state') or data.get('state', '')
+        if data.get('error') or state in ('BATCH_STATE_FAILED', 'BATCH_STATE_CANCELLED', 'BATCH_STATE_EXPIRED'):
+            raise BatchJobFailed(f"Batch {handle['name']} ended in {state or 'error'}: {data.get('error')}")
+        if not data.get('done') and state != 'BATCH_STATE_SUCCEEDED':
+            return None
+        results = []
+        for item in self._responses(data):
+            key = item.get('key') or (item.get('metadata') or {}).get('key')
+            if item.get('error'):
+                results.append({"key": key, "error": json.dumps(item['error'])})
+                continue
+            generated = item.get('response') or {}
+            parts = ((generated.get('candidates') or [{}])[0].get('content') or {}).get('parts') or []
+            # Usage is recorded at ingest, once per job, not on every poll
+            results.append({"key": key, "response": {"text": "".join(part.get('text', '') for part in parts)},
+                            "usage": generated.get('usageMetadata') or {}})
+        write_jsonl(handle['output_path'], results)
+        return handle['output_path']
+
+    def _responses(self, data):
+        """Per-request results of a finished job: inline, or downloaded from its responses file."""
+        output = data.get('response') or data.get('output') or {}
+        output = output.get('output') or output
+        if output.get('responsesFile'):
+            response = requests.get(f"{GEMINI_DOWNLOAD_BASE}/{output['responsesFile']}:download",
+                                    params={'key': self._api_key(), 'alt': 'media'}, timeout=600)
+            response.raise_for_status()
+            return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+        inlined = output.get('inlinedResponses') or {}
+        return inlined.get('inlinedResponses', inlined) if isinstance(inlined, dict) else inlined
+
+def record_batch_usage(model_name: str, results: list):
+    """Record the provider-reported usage of every result of a batch job (results without it are skipped)."""
+    for result in results:
+        usage = result.get('usage')
+        if not usage:
+            continue
+        metadata = SimpleNamespace(
+            prompt_token_count=usage.get('promptTokenCount', 0),
+            candidates_token_count=usage.get('candidatesTokenCount', 0),
+            cached_content_token_count=usage.get('cachedContentTokenCount', 0),
+            total_token_count=usage.get('totalTokenCount', 0)
+        )
+        record_llm_call(model_name, SimpleNamespace(usage_metadata=metadata), request_type='batch_api')
+    flush_usage()
+
+def get_batch_backend(name: str = None):
+    return LocalBatchBackend() if (name or BATCH_BACKEND) == 'local' else GeminiBatchBackend()
+
+def submit_campaign_batch(leads: list, product_name: str, product_details: dict, days: list,
+                          user_email: str, campaign_id: str, backend=None) -> str:
+    """
+    Write every (lead, day) request of a campaign to a JSONL job file, submit
+    it to the batch backend and record the job. Returns the job id.
+    """
+    backend = backend or get_batch_backend()
+    job_id = f"{campaign_id}-{uuid.uuid4().hex[:8]}"
+    input_path = os.path.join(BATCH_JOB_DIR, f"{job_id}.input.jsonl")
+    records = build_batch_requests(leads, product_name, product_details, days)
+    write_jsonl(input_path, records)
+    handle = backend.submit(input_path, display_name=f"leadx-{job_id}")
+    items = {}
+    for lead_index, lead in enumerate(leads):
+        for day in days:
+            items[request_key(lead_index, day)] = {
+                "lead_id": lead.get("id") or lead.get("lead_id"),
+                "lead_name": lead.get("name"),
+                "interval_day": day,
+                "generation": generation_record(lead, product_name, day, campaign_id, product_details)
+            }
+    save_batch_job({
+        '_id': job_id,
+        'user_email': user_email,
+        'campaign_id': campaign_id,
+        'product_name': product_name,
+        'backend': backend.name,
+        'handle': handle,
+        'input_path': input_path,
+        'state': STATE_SUBMITTED,
+        'item_count': len(records),
+        'items': items,
+        'created_at': datetime.now()
+    })
+    logger.info(f"Submitted batch job {job_id} with {len(records)} requests to {backend.name}")
+    return job_id
+
+def ingest_batch_results(job: dict, output_path: str) -> int:
+    """
+    Turn a finished job's output JSONL into lead blocks, shaped like the
+    interactive ones, and save them to generated_emails. Invalid or failed
+    items are left out and listed on the job record. The job's usage is
+    recorded once it is marked ingested. Returns the number of emails saved.
+    """
+    signature = get_signature(job['user_email'])
+    results = read_jsonl(output_path)
+    blocks = {}
+    for result in results:
+        item = job['items'].get(result.get('key'))
+        if item is None:
+            continue
+        if result.get('error'):
+            email = failed_email(result['error'])
+        else:
+            email, error = validate_email_response((result.get('response') or {}).get('text'))
+            email = email or failed_email(error)
+        email['body'] = append_signature(email.get('body', ''), signature)
+        email['interval_day'] = item['interval_day']
+        if not email.get('generation_failed') and item.get('generation'):
+            email['generation'] = item['generation']
+        block = blocks.setdefault(item['lead_id'], {
+            "lead_id": item['lead_id'],
+            "lead_name": item['lead_name'],
+            "campaign_id": job['campaign_id'],
+            "batch_job_id": job['_id'],
+            "emails": []
+        })
+        block["emails"].append(email)
+    for block in blocks.values():
+        block["emails"].sort(key=lambda email: email["interval_day"])
+
+    clean_blocks, failures = split_failed_emails(list(blocks.values()))
+    save_batch_lead_blocks(clean_blocks, job['user_email'])
+    generated = sum(len(block["emails"]) for block in clean_blocks)
+    update_batch_job(job['_id'], {
+        'state': STATE_INGESTED,
+        'generated_count': generated,
+        'failed_count': len(failures),
+        'failures': failures[:MAX_REPORTED_FAILURES],
+        'completed_at': datetime.now()
+    })
+    with usage_context(user_email=job['user_email'], campaign_id=job['campaign_id']):
+        record_batch_usage(job['handle'].get('model', GEMINI_MODEL_NAME), results)
+    logger.info(f"Ingested batch job {job['_id']}: {generated} emails, {len(failures)} failed")
+    return generated
+
+def poll_batch_job(job_id: str, backend=None) -> str:
+    """
+    Check one submitted job and ingest its results once it has finished.
+    The job is claimed before ingesting, so concurrent pollers (workers, the
+    UI) ingest it once. Returns the job state.
+    """
+    job = fetch_batch_job(job_id)
+    if job is None or job['state'] not in (STATE_SUBMITTED, STATE_INGESTING):
+        return job['state'] if job else None
+    backend = backend or get_batch_backend(job['backend'])
+    try:
+        # The local backend generates while polling; tag those calls with the job's owner
+        with usage_context(user_email=job['user_email'], campaign_id=job['campaign_id']):
+            output_path = backend.poll(job['handle'], job['input_path'])
+    except BatchJobFailed as e:
+        logger.error(f"Batch job {job_id} failed: {str(e)}")
+        update_batch_job(job_id, {'state': STATE_FAILED, 'error': str(e), 'completed_at': datetime.now()})
+        return STATE_FAILED
+    if output_path is None:
+        return job['state']
+    job = claim_batch_job_ingest(job_id, datetime.now() - timedelta(seconds=BATCH_INGEST_TIMEOUT))
+    if job is None:
+        return STATE_INGESTING
+    try:
+        ingest_batch_results(job, output_path)
+    except Exception:
+        # Hand the job back; ingestion upserts, so a retry can't duplicate anything
+        update_batch_job(job_id, {'state': STATE_SUBMITTED})
+        raise
+    return STATE_INGESTED
+
+def poll_batch_jobs(user_email: str = None) -> int:
+    """Poll every unfinished job (optionally one user's). Returns the number ingested."""
+    ingested = 0
+    for job in fetch_batch_jobs(user_email, states=[STATE_SUBMITTED, STATE_INGESTING]):
+        try:
+            ingested += poll_batch_job(job['_id']) == STATE_INGESTED
+        except Exception as e:
+            logger.error(f"Error polling batch job {job['_id']}: {str(e)}")
+    return ingested
+
+def merge_lead_blocks(existing: list, incoming: list) -> list:
+    """
+    Merge lead blocks (e.g. batch-generated follow-ups into the day-0 blocks
+    of the same campaign) by lead, keeping one email per interval day.
+    """
+    merged = {block["lead_id"]: dict(block, emails=list(block["emails"])) for block in existing}
+    for block in incoming:
+        block = {key: value for key, value in block.items() if key not in ('_id', 'user_email')}
+        target = merged.setdefault(block["lead_id"], dict(block, emails=[]))
+        days = {email["interval_day"] for email in target["emails"]}
+        target["emails"].extend(email for email in block["emails"] if email["interval_day"] not in days)
+        target["emails"].sort(key=lambda email: email["interval_day"])
+    return list(merged.values())
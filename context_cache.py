@@ -0,0 +1,149 @@
+import os
+import time
+import threading
+import logging
+from personalised_email import (
+    build_static_prompt_prefix, build_lead_message, generate_tiered_email,
+    generate_email_with_gemini, json_generation_config, _response_text, EMAIL_RESPONSE_SCHEMA
+)
+from llm_usage import usage_context
+from email_cache import content_hash
+from gemini_client import generate_content, create_cached_content
+from model_tiering import models_for
+
+logger = logging.getLogger(__name__)
+
+# "gemini" uses server-side cached content, "local" the in-process stand-in, "off" disables caching
+CONTEXT_CACHE_BACKEND = os.getenv('GEMINI_CONTEXT_CACHE', 'off').lower()
+# Lifetime of a cached prefix
+CONTEXT_CACHE_TTL = int(os.getenv('GEMINI_CONTEXT_CACHE_TTL', '3600'))
+# Recreate entries this many seconds before the server would expire them
+EXPIRY_MARGIN = 60
+
+class LocalContextCache:
+    """
+    Keeps one rendered static prefix per (product, product details, interval
+    day, model) with a TTL and sends only the lead-specific message
+    alongside it. Emails go through the same model tiers and quality checks
+    as uncached ones; each tier uses the prefix cached for its model.
+    This base implementation keeps prefixes in process memory and joins them
+    with the lead message before calling the model, so it behaves like the
+    server-side cache (same keys, TTLs and hit accounting) without needing
+    Gemini caching. Pass generate_fn to run it fully offline in tests.
+    """
+    def __init__(self, ttl_seconds: int = CONTEXT_CACHE_TTL, generate_fn=None):
+        self.ttl_seconds = ttl_seconds
+        self.generate_fn = generate_fn or generate_email_with_gemini
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._create_lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'errors': 0}
+
+    def _count(self, stat):
+        with self._lock:
+            self.stats[stat] += 1
+
+    def _create(self, key, prefix):
+        """Store the prefix; returns the handle _generate will receive."""
+        return prefix
+
+    def _generate(self, handle, lead_message, model_name):
+        """Run one request against a cached prefix; returns the cleaned JSON text."""
+        return self.generate_fn(f"{handle}\n\n{lead_message}", EMAIL_RESPONSE_SCHEMA, model_name)
+
+    def get_handle(self, product_name, product_details, day, model_name):
+        """Return the live cache handle for (product, day, model), creating it on a miss or expiry."""
+        # Edited product details get a fresh prefix instead of the stale one until TTL
+        key = (product_name.lower(), day, content_hash(product_details), model_name)
+        entry = self._entries.get(key)
+        if entry and entry['expires_at'] > time.monotonic():
+            self._count('hits')
+            return entry['handle']
+        with self._create_lock:
+            # Another thread may have created it while we waited
+            entry = self._entries.get(key)
+            if entry and entry['expires_at'] > time.monotonic():
+                self._count('hits')
+                return entry['handle']
+            self._count('expired' if entry else 'misses')
+            handle = self._create(key, build_static_prompt_prefix(product_name, product_details, day))
+            self._entries[key] = {
+                'handle': handle,
+                'expires_at': time.monotonic() + self.ttl_seconds - EXPIRY_MARGIN
+            }
+            return handle
+
+    def generate_email(self, lead_details, product_details, product_name, day):
+        """
+        Generate one email using the cached (product, day) prefix, escalating
+        through models_for like generate_tiered_email and retrying invalid output.
+        """
+        lead_message = build_lead_message(lead_details, product_name, day)
+
+        def generate(model_name):
+            try:
+                handle = self.get_handle(product_name, product_details, day, model_name)
+                return self._generate(handle, lead_message, model_name)
+            except Exception:
+                self._count('errors')
+                raise
+
+        with usage_context(product_name=product_name, interval_day=day, request_type='single'):
+            return generate_tiered_email(generate, f"{lead_details.get('email', 'lead')} (day {day}, cached prefix)",
+                                         models_for(product_name, day))
+
+    def get_stats(self):
+        """Snapshot of hit accounting, plus the hit rate over all lookups."""
+        with self._lock:
+            stats = dict(self.stats)
+        lookups = stats['hits'] + stats['misses'] + stats['expired']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        stats['entries'] = len(self._entries)
+        return stats
+
+class GeminiContextCache(LocalContextCache):
+    """
+    Stores each (product, interval day) prefix as cached content on the
+    configured backend (Gemini, or the stub), so requests only carry the
+    lead details. If a prefix can't be cached
+    (e.g. it is below the model's minimum cacheable size) requests for it
+    fall back to sending the full prompt.
+    """
+    def _create(self, key, prefix):
+        try:
+            cached_content = create_cached_content(
+                display_name=f"leadx-{key[0]}-day{key[1]}",
+                system_instruction=prefix,
+                ttl_seconds=self.ttl_seconds,
+                model_name=key[3]
+            )
+            return {'cached_content': cached_content, 'prefix': None}
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Could not create Gemini cached content for {key}, sending full prompts: {str(e)}")
+            return {'cached_content': None, 'prefix': prefix}
+
+    def _generate(self, handle, lead_message, model_name):
+        if handle['cached_content'] is None:
+            return self.generate_fn(f"{handle['prefix']}\n\n{lead_message}", EMAIL_RESPONSE_SCHEMA, model_name)
+        # Same key pool, backend and hedging as every other call
+        response = generate_content(
+            lead_message,
+            model_name=model_name,
+            generation_config=json_generation_config(EMAIL_RESPONSE_SCHEMA),
+            cached_content=handle['cached_content']
+        )
+        return _response_text(response)
+
+_context_cache = None
+_context_cache_lock = threading.Lock()
+
+def get_context_cache():
+    """Process-wide context cache for the configured backend, or None when disabled."""
+    global _context_cache
+    if CONTEXT_CACHE_BACKEND not in ('gemini', 'local'):
+        return None
+    with _context_cache_lock:
+        if _context_cache is None:
+            _context_cache = GeminiContextCache() if CONTEXT_CACHE_BACKEND == 'gemini' else LocalContextCache()
+        return _context_cache
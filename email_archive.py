@@ -0,0 +1,125 @@
+import os
+import gzip
+import logging
+from datetime import datetime, timedelta, timezone
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo import ASCENDING
+from pymongo.errors import BulkWriteError
+from mongodb_client import (
+    scheduled_emails_collection, generated_emails_collection,
+    scheduled_emails_archive_collection, generated_emails_archive_collection,
+    fetch_unfinished_campaign_ids
+)
+
+# Scheduled emails in these states are never touched by the worker again
+TERMINAL_STATUSES = ['sent', 'cancelled', 'failed']
+# Days a terminal scheduled email stays in the hot collection
+SCHEDULED_RETENTION_DAYS = int(os.getenv('SCHEDULED_RETENTION_DAYS', '7'))
+# Days a generated email stays in the hot collection
+GENERATED_RETENTION_DAYS = int(os.getenv('GENERATED_RETENTION_DAYS', '30'))
+# Days archived documents are kept before a TTL index deletes them (0 keeps them forever)
+ARCHIVE_TTL_DAYS = int(os.getenv('ARCHIVE_TTL_DAYS', '0'))
+# "mongo" moves documents to the *_archive collections, "disk" to gzipped JSONL files
+ARCHIVE_TARGET = os.getenv('ARCHIVE_TARGET', 'mongo').lower()
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'archive')
+ARCHIVE_BATCH_SIZE = 500
+
+def ensure_archive_indexes():
+    """
+    Index the archive collections by archived_at. With ARCHIVE_TTL_DAYS set
+    the index is a TTL index, so archived records expire on their own.
+    """
+    for archive in (scheduled_emails_archive_collection, generated_emails_archive_collection):
+        if ARCHIVE_TTL_DAYS > 0:
+            archive.create_index([('archived_at', ASCENDING)], expireAfterSeconds=ARCHIVE_TTL_DAYS * 86400)
+        else:
+            archive.create_index([('archived_at', ASCENDING)])
+
+def utc_now(now=None):
+    """now (default: the current time) as a naive UTC datetime, the way pymongo stores dates."""
+    if now is None:
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+    if now.tzinfo is not None:
+        return now.astimezone(timezone.utc).replace(tzinfo=None)
+    return now
+
+def scheduled_archive_query(now=None):
+    """Terminal-state scheduled emails whose send slot is past the retention window."""
+    cutoff = utc_now(now) - timedelta(days=SCHEDULED_RETENTION_DAYS)
+    return {'status': {'$in': TERMINAL_STATUSES}, 'scheduled_time': {'$lt': cutoff}}
+
+def generated_archive_query(now=None):
+    """
+    Generated emails created before the retention window (ObjectIds carry
+    their creation time in UTC), except blocks of generation or batch jobs
+    that haven't finished and still need them.
+    """
+    cutoff = utc_now(now) - timedelta(days=GENERATED_RETENTION_DAYS)
+    return {'_id': {'$lt': ObjectId.from_datetime(cutoff)}, 'campaign_id': {'$nin': fetch_unfinished_campaign_ids()}}
+
+def _write_to_collection(archive, documents):
+    try:
+        archive.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        # Duplicate keys mean a previous run archived these but crashed before deleting them
+        other_errors = [err for err in e.details.get('writeErrors', []) if err.get('code') != 11000]
+        if other_errors:
+            raise
+
+def _write_to_disk(name, documents):
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    filename = os.path.join(ARCHIVE_DIR, f"{name}_{datetime.now().strftime('%Y%m%d')}.jsonl.gz")
+    with gzip.open(filename, 'at', encoding='utf-8') as f:
+        for document in documents:
+            f.write(json_util.dumps(document) + "\n")
+    return filename
+
+def archive_collection(source, archive, query, name, batch_size=ARCHIVE_BATCH_SIZE, target=ARCHIVE_TARGET):
+    """
+    Move every document matching query out of source in batches.
+    Each batch is written to the archive first and only then deleted from
+    source, so a crash can leave a duplicate but never lose a document.
+    Returns the number of documents moved.
+    """
+    moved = 0
+    while True:
+        documents = list(source.find(query).limit(batch_size))
+        if not documents:
+            break
+        archived_at = datetime.now()
+        for document in documents:
+            document['archived_at'] = archived_at
+
+        if target == 'disk':
+            _write_to_disk(name, documents)
+        else:
+            _write_to_collection(archive, documents)
+
+        result = source.delete_many({'_id': {'$in': [d['_id'] for d in documents]}})
+        moved += result.deleted_count
+        logging.info(f"[Archive] Moved {result.deleted_count} documents out of {name}")
+        if len(documents) < batch_size:
+            break
+    return moved
+
+def run_archive_job(now=None):
+    """Apply the retention policy to scheduled_emails and generated_emails."""
+    # One naive UTC reference time for both collections, whatever the caller passed
+    now = utc_now(now)
+    if ARCHIVE_TARGET != 'disk':
+        ensure_archive_indexes()
+    scheduled_moved = archive_collection(
+        scheduled_emails_collection, scheduled_emails_archive_collection,
+        scheduled_archive_query(now), 'scheduled_emails'
+    )
+    generated_moved = archive_collection(
+        generated_emails_collection, generated_emails_archive_collection,
+        generated_archive_query(now), 'generated_emails'
+    )
+    logging.info(f"[Archive] Archived {scheduled_moved} scheduled emails and {generated_moved} generated emails")
+    return {'scheduled_emails': scheduled_moved, 'generated_emails': generated_moved}
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    print(run_archive_job())
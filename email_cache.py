@@ -0,0 +1,82 @@
+import json
+import hashlib
+from gemini_client import GEMINI_MODEL_NAME
+from model_tiering import models_for, tier_label
+from personalised_email import FOLLOWUP_PROMPTS, subject_style, body_style, project_lead_for_prompt
+from mongodb_client import get_cached_generated_emails, save_cached_generated_emails
+
+# Bump when generation changes in a way the prompt text doesn't capture (parsing, post-processing)
+PROMPT_TEMPLATE_VERSION = 2
+
+def content_hash(value) -> str:
+    """Stable sha256 of any JSON-serializable value (dict key order doesn't matter)."""
+    serialized = json.dumps(value, sort_keys=True, default=str, separators=(',', ':'))
+    return hashlib.sha256(serialized.encode('utf-8')).hexdigest()
+
+def prompt_template_hash(day: int) -> str:
+    """Hash of everything template-side that shapes the email for an interval day."""
+    return content_hash([FOLLOWUP_PROMPTS[day], subject_style, body_style])
+
+def generation_stamp(product_details: dict, day: int) -> dict:
+    """
+    Content hashes of the inputs an email for interval day was generated from,
+    stored with the email so later edits to the product entry or the prompt
+    template can be detected.
+    """
+    return {
+        'product_hash': content_hash(product_details),
+        'template_hash': prompt_template_hash(day),
+        'template_version': PROMPT_TEMPLATE_VERSION
+    }
+
+def project_lead(lead: dict) -> dict:
+    """
+    The part of a lead that can influence its generated email: the prompt
+    projection plus the recipient address, which prompts get separately.
+    """
+    return dict(project_lead_for_prompt(lead), email=lead.get('email', ''))
+
+def email_cache_key(product_name: str, product_details: dict, lead: dict, day: int, model_name: str = None,
+                    variant: str = None) -> str:
+    """
+    Content address of one generated email. The model defaults to the tier
+    list used for it. variant keeps emails that aren't written for the lead
+    alone (e.g. rendered segment templates) apart from bespoke ones.
+    """
+    key = {
+        'model': model_name or tier_label(models_for(product_name, day)),
+        'template_version': PROMPT_TEMPLATE_VERSION,
+        'template': prompt_template_hash(day),
+        'product_name': product_name.lower(),
+        'product': product_details,
+        'lead': project_lead(lead),
+        'day': day
+    }
+    if variant:
+        key['variant'] = variant
+    return content_hash(key)
+
+def is_cacheable(email: dict) -> bool:
+    """Only real generations are cached, never a failed one."""
+    email = email or {}
+    body = email.get('body', '')
+    return not email.get('generation_failed') and bool(email.get('subject')) and bool(body.strip())
+
+def lookup_emails(cache_keys) -> dict:
+    """{cache_key: {"subject", "body"}} for every key already generated."""
+    return get_cached_generated_emails(cache_keys)
+
+def store_emails(entries: dict, product_name: str, model_name: str = GEMINI_MODEL_NAME) -> int:
+    """Cache {cache_key: (day, email)} results, skipping failed generations."""
+    documents = {
+        key: {
+            'subject': email['subject'],
+            'body': email['body'],
+            'interval_day': day,
+            'product_name': product_name,
+            'model': model_name,
+            'template_version': PROMPT_TEMPLATE_VERSION
+        }
+        for key, (day, email) in entries.items() if is_cacheable(email)
+    }
+    return save_cached_generated_emails(documents)
@@ -10,6 +10,7 @@ from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from auth import get_gmail_service, get_user_email, get_user_name, is_authenticated
 from outlook_auth import is_outlook_authenticated, get_outlook_email, get_outlook_name
+from mongodb_client import get_signature
 
 class EmailSender:
     def __init__(self, batch_size: int = 5):
@@ -0,0 +1,343 @@
+import os
+import json
+import time
+import asyncio
+import datetime
+import threading
+import logging
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import google.generativeai as genai
+from llm_usage import TimedCall, usage_from_response
+from gemini_key_pool import GeminiKeyPool, load_api_keys, is_rate_limited
+from llm_backend import LLMBackend, StubBackend, LLM_BACKEND, stub_api_keys
+
+logger = logging.getLogger(__name__)
+
+# Model used for email generation unless a caller asks for another one
+GEMINI_MODEL_NAME = os.getenv('GEMINI_MODEL', 'gemini-2.0-flash')
+# Generation config applied to every call on the default handle
+DEFAULT_GENERATION_CONFIG = {}
+# Deadline (seconds) for one generation call, hedges included
+GEMINI_CALL_TIMEOUT = float(os.getenv('GEMINI_CALL_TIMEOUT', '60'))
+# Issue a duplicate request when a call runs past the observed p95 latency
+GEMINI_HEDGING = os.getenv('GEMINI_HEDGING', 'false').lower() == 'true'
+# Latency samples kept per model, and how many are needed before hedging starts
+HEDGE_WINDOW = int(os.getenv('GEMINI_HEDGE_WINDOW', '200'))
+HEDGE_MIN_SAMPLES = int(os.getenv('GEMINI_HEDGE_MIN_SAMPLES', '20'))
+# Never hedge sooner than this (seconds), whatever the p95
+HEDGE_MIN_DELAY = float(os.getenv('GEMINI_HEDGE_MIN_DELAY', '2'))
+# Limits so hedging can't flood the quota: share of recent calls that may be
+# hedged, and hedges in flight at once
+HEDGE_MAX_FRACTION = float(os.getenv('GEMINI_HEDGE_MAX_FRACTION', '0.1'))
+HEDGE_MAX_IN_FLIGHT = int(os.getenv('GEMINI_HEDGE_MAX_IN_FLIGHT', '4'))
+
+_configure_lock = threading.Lock()
+_configured = False
+_models_lock = threading.Lock()
+_models = {}
+_key_pool = None
+_key_clients = {}
+_backend = None
+
+def get_key_pool() -> GeminiKeyPool:
+    """Process-wide pool of the configured Gemini API keys, created on first use."""
+    global _key_pool
+    if _key_pool is None:
+        with _configure_lock:
+            if _key_pool is None:
+                _key_pool = GeminiKeyPool(stub_api_keys() if LLM_BACKEND == 'stub' else load_api_keys())
+                logger.info(f"Gemini key pool with {len(_key_pool)} keys")
+    return _key_pool
+
+def configure_gemini(api_key: str = None):
+    """
+    Configure the Gemini SDK once per process. Called lazily on first use so
+    importing this module doesn't require the API key to be present. The
+    default client (used for context caching) runs on the first pooled key.
+    """
+    global _configured
+    if _configured and api_key is None:
+        return
+    api_key = api_key or get_key_pool().keys[0].api_key
+    with _configure_lock:
+        genai.configure(api_key=api_key)
+        _configured = True
+
+def _clients_for(key):
+    """gRPC clients bound to one pooled key, shared by every model handle using it."""
+    clients = _key_clients.get(key.label)
+    if clients is None:
+        from google.ai import generativelanguage as glm
+        options = {'api_key': key.api_key}
+        clients = (glm.GenerativeServiceClient(client_options=options), glm.GenerativeServiceAsyncClient(client_options=options))
+        _key_clients[key.label] = clients
+    return clients
+
+def get_model(model_name: str = GEMINI_MODEL_NAME, generation_config: dict = None, key=None,
+              cached_content: str = None) -> genai.GenerativeModel:
+    """
+    Return the long-lived GenerativeModel for (model_name, generation_config),
+    bound to a pooled API key when one is given (otherwise the default
+    client). Handles are created once and shared by every thread; the
+    underlying gRPC channel is thread-safe and reused across calls. With
+    cached_content the handle reuses that cached prefix (its model is
+    pinned by the cache, and the pooled keys must share its project).
+    """
+    config = DEFAULT_GENERATION_CONFIG if generation_config is None else generation_config
+    cache_key = (model_name, json.dumps(config, sort_keys=True, default=str), key.label if key else None, cached_content)
+    model = _models.get(cache_key)
+    if model is None:
+        configure_gemini()
+        with _models_lock:
+            model = _models.get(cache_key)
+            if model is None:
+                if cached_content:
+                    model = genai.GenerativeModel.from_cached_content(cached_content=cached_content, generation_config=config or None)
+                else:
+                    model = genai.GenerativeModel(model_name, generation_config=config or None)
+                if key is not None:
+                    # The SDK only configures one key globally; give this handle its own clients
+                    model._client, model._async_client = _clients_for(key)
+                _models[cache_key] = model
+                logger.info(f"Created Gemini model handle for {model_name}" + (f" on {key.label}" if key else ""))
+    return model
+
+class GeminiBackend(LLMBackend):
+    """Requests to the Gemini API on the pooled model handles."""
+    name = 'gemini'
+
+    def generate(self, prompt, model_name: str, generation_config: dict, key, timeout: float, cached_content: str = None):
+        model = get_model(model_name, generation_config, key, cached_content)
+        return model.generate_content(prompt, request_options={'timeout': timeout})
+
+    async def generate_async(self, prompt, model_name: str, generation_config: dict, key, timeout: float, cached_content: str = None):
+        model = get_model(model_name, generation_config, key, cached_content)
+        return await model.generate_content_async(prompt, request_options={'timeout': timeout})
+
+    def create_cached_content(self, model_name: str, display_name: str, system_instruction: str, ttl_seconds: int) -> str:
+        from google.generativeai import caching
+        configure_gemini()
+        return caching.CachedContent.create(
+            model=model_name,
+            display_name=display_name,
+            system_instruction=system_instruction,
+            ttl=datetime.timedelta(seconds=ttl_seconds)
+        ).name
+
+def get_llm_backend() -> LLMBackend:
+    """The backend selected by LLM_BACKEND, created on first use."""
+    global _backend
+    if _backend is None:
+        with _configure_lock:
+            if _backend is None:
+                _backend = StubBackend() if LLM_BACKEND == 'stub' else GeminiBackend()
+                logger.info(f"LLM backend: {_backend.name}")
+    return _backend
+
+def set_llm_backend(backend: LLMBackend):
+    """Swap the backend, e.g. for a benchmark with a differently configured StubBackend."""
+    global _backend
+    _backend = backend
+
+class LatencyTracker:
+    """
+    Rolling window of successful call latencies per model, used to pick the
+    hedging delay, plus the hedge budget over the same window.
+    """
+    def __init__(self, window: int = HEDGE_WINDOW):
+        self.window = window
+        self._latencies = {}
+        self._recent_calls = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._hedges_in_flight = threading.BoundedSemaphore(HEDGE_MAX_IN_FLIGHT)
+
+    def observe(self, model_name: str, latency: float):
+        with self._lock:
+            self._latencies.setdefault(model_name, deque(maxlen=self.window)).append(latency)
+
+    def p95(self, model_name: str):
+        """p95 latency for model_name, or None until HEDGE_MIN_SAMPLES calls have completed."""
+        with self._lock:
+            samples = sorted(self._latencies.get(model_name, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * 0.95))]
+
+    def hedge_delay(self, model_name: str):
+        """Seconds to wait before hedging a call, or None if it shouldn't be hedged."""
+        if not GEMINI_HEDGING:
+            return None
+        p95 = self.p95(model_name)
+        return None if p95 is None else max(p95, HEDGE_MIN_DELAY)
+
+    def count_call(self, hedged: bool):
+        with self._lock:
+            self._recent_calls.append(hedged)
+
+    def try_start_hedge(self) -> bool:
+        """Reserve a hedge if both the in-flight cap and the recent-call budget allow it."""
+        with self._lock:
+            hedged = sum(self._recent_calls)
+            if hedged + 1 > max(1, HEDGE_MAX_FRACTION * len(self._recent_calls)):
+                return False
+        if not self._hedges_in_flight.acquire(blocking=False):
+            return False
+        with self._lock:
+            self._recent_calls.append(True)
+        return True
+
+    def finish_hedge(self):
+        self._hedges_in_flight.release()
+
+latency_tracker = LatencyTracker()
+
+# Runs the requests of hedged calls so the caller can wait on whichever finishes first
+_hedge_pool = ThreadPoolExecutor(max_workers=int(os.getenv('GEMINI_HEDGE_POOL_SIZE', '64')), thread_name_prefix='gemini-call')
+
+def _remaining(deadline: float) -> float:
+    return max(deadline - time.monotonic(), 1)
+
+def _call_model(prompt, model_name: str, generation_config: dict, deadline: float, cached_content: str = None, **tags):
+    """
+    One timed request on the least-loaded pooled key; feeds the latency
+    tracker on success. A 429 puts the key in cooldown and the request moves
+    on to another key while any are left.
+    """
+    pool = get_key_pool()
+    backend = get_llm_backend()
+    if cached_content:
+        tags['context_cached'] = True
+    tried = []
+    while True:
+        key = pool.acquire(deadline, exclude=tried)
+        tried.append(key.label)
+        try:
+            with TimedCall(model_name, api_key=key.label, backend=backend.name, **tags) as call:
+                call.response = backend.generate(prompt, model_name, generation_config, key, _remaining(deadline), cached_content)
+        except Exception as e:
+            pool.release(key, error=e)
+            if is_rate_limited(e) and len(tried) < len(pool) and time.monotonic() < deadline:
+                continue
+            raise
+        pool.release(key, usage_from_response(call.response)['total_tokens'])
+        latency_tracker.observe(model_name, call.latency)
+        return call.response
+
+def _submit(fn, *args, **kwargs):
+    # Run in a copy of the caller's context so usage tags follow the request
+    return _hedge_pool.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def generate_content(prompt: str, model_name: str = GEMINI_MODEL_NAME, generation_config: dict = None,
+                     timeout: float = GEMINI_CALL_TIMEOUT, cached_content: str = None):
+    """
+    Synchronous generation on the shared model handle, bounded by timeout
+    seconds. Tokens and latency are recorded. With GEMINI_HEDGING on, a call
+    still running after the model's p95 latency gets one duplicate request
+    (within the hedge limits) and the first successful response wins.
+    Requests are spread over the API key pool (see GeminiKeyPool).
+    cached_content names a prefix from create_cached_content that the prompt
+    follows. Raises TimeoutError when nothing succeeds before the deadline.
+    """
+    deadline = time.monotonic() + timeout
+    delay = latency_tracker.hedge_delay(model_name)
+    if delay is None or delay >= timeout:
+        latency_tracker.count_call(False)
+        return _call_model(prompt, model_name, generation_config, deadline, cached_content)
+
+    futures = [_submit(_call_model, prompt, model_name, generation_config, deadline, cached_content)]
+    done, _ = wait(futures, timeout=delay)
+    hedged = False
+    if not done and latency_tracker.try_start_hedge():
+        hedged = True
+        logger.info(f"Hedging {model_name} call after {delay:.1f}s")
+        futures.append(_submit(_call_model, prompt, model_name, generation_config, deadline, cached_content, hedge=True))
+    else:
+        latency_tracker.count_call(False)
+    try:
+        pending = set(futures)
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        raise TimeoutError(f"Gemini call to {model_name} exceeded its {timeout:.0f}s deadline")
+    finally:
+        if hedged:
+            latency_tracker.finish_hedge()
+
+async def generate_content_async(prompt: str, model_name: str = GEMINI_MODEL_NAME, generation_config: dict = None,
+                                 timeout: float = GEMINI_CALL_TIMEOUT, cached_content: str = None):
+    """Async variant of generate_content with the same deadline, key pool and hedging rules."""
+    deadline = time.monotonic() + timeout
+    pool = get_key_pool()
+    backend = get_llm_backend()
+
+    async def call(**tags):
+        if cached_content:
+            tags['context_cached'] = True
+        tried = []
+        while True:
+            key = await pool.acquire_async(deadline, exclude=tried)
+            tried.append(key.label)
+            try:
+                with TimedCall(model_name, api_key=key.label, backend=backend.name, **tags) as timed:
+                    timed.response = await backend.generate_async(prompt, model_name, generation_config, key, _remaining(deadline), cached_content)
+            except asyncio.CancelledError:
+                pool.release(key)
+                raise
+            except Exception as e:
+                pool.release(key, error=e)
+                if is_rate_limited(e) and len(tried) < len(pool) and time.monotonic() < deadline:
+                    continue
+                raise
+            pool.release(key, usage_from_response(timed.response)['total_tokens'])
+            latency_tracker.observe(model_name, timed.latency)
+            return timed.response
+
+    delay = latency_tracker.hedge_delay(model_name)
+    tasks = [asyncio.ensure_future(call())]
+    hedged = False
+    try:
+        if delay is not None and delay < timeout:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and latency_tracker.try_start_hedge():
+                hedged = True
+                logger.info(f"Hedging {model_name} call after {delay:.1f}s")
+                tasks.append(asyncio.ensure_future(call(hedge=True)))
+        if not hedged:
+            latency_tracker.count_call(False)
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(deadline - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        if error is not None and not pending:
+            raise error
+        raise TimeoutError(f"Gemini call to {model_name} exceeded its {timeout:.0f}s deadline")
+    finally:
+        for task in tasks:
+            task.cancel()
+        if hedged:
+            latency_tracker.finish_hedge()
+
+def create_cached_content(display_name: str, system_instruction: str, ttl_seconds: int, model_name: str) -> str:
+    """
+    Store a static prompt prefix for model_name as cached content with the
+    given TTL, on the configured backend. Returns its name, for
+    generate_content(cached_content=...). Gemini only caches for pinned
+    model versions (e.g. "gemini-2.0-flash-001").
+    """
+    return get_llm_backend().create_cached_content(model_name, display_name, system_instruction, ttl_seconds)
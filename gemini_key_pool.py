@@ -0,0 +1,166 @@
+import os
+import time
+import asyncio
+import threading
+import logging
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+# Per-key limits; leave some headroom under the quota of the key's tier
+GEMINI_KEY_RPM = int(os.getenv('GEMINI_KEY_RPM', '1000'))
+GEMINI_KEY_TPM = int(os.getenv('GEMINI_KEY_TPM', '1000000'))
+# Cooldown after a 429, doubled for each consecutive 429 on the same key
+KEY_COOLDOWN_SECONDS = float(os.getenv('GEMINI_KEY_COOLDOWN', '30'))
+KEY_MAX_COOLDOWN_SECONDS = float(os.getenv('GEMINI_KEY_MAX_COOLDOWN', '300'))
+# Rates are measured over this sliding window (seconds)
+RATE_WINDOW = 60
+
+def load_api_keys():
+    """
+    Configured Gemini API keys, in order. GEMINI_API_KEYS (Streamlit secret
+    list or comma-separated environment variable) takes precedence over the
+    single GEMINI_API_KEY.
+    """
+    import streamlit as st
+    keys = None
+    try:
+        keys = st.secrets.get("GEMINI_API_KEYS")
+    except Exception:
+        keys = None
+    keys = keys or os.getenv('GEMINI_API_KEYS')
+    if isinstance(keys, str):
+        keys = [key.strip() for key in keys.split(',')]
+    if not keys:
+        keys = [os.getenv('GEMINI_API_KEY') or st.secrets["GEMINI_API_KEY"]]
+    return [key for key in dict.fromkeys(keys) if key]
+
+def is_rate_limited(error) -> bool:
+    """True for a 429 / RESOURCE_EXHAUSTED error from the Gemini API."""
+    code = getattr(error, 'code', None)
+    return code == 429 or type(error).__name__ in ('ResourceExhausted', 'TooManyRequests')
+
+class KeyState:
+    """Sliding-window request and token counts, in-flight calls and cooldown for one key."""
+    def __init__(self, label: str, api_key: str):
+        self.label = label
+        self.api_key = api_key
+        self.requests = deque()
+        self.tokens = deque()
+        self.token_total = 0
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.consecutive_429s = 0
+
+    def trim(self, now):
+        while self.requests and self.requests[0] <= now - RATE_WINDOW:
+            self.requests.popleft()
+        while self.tokens and self.tokens[0][0] <= now - RATE_WINDOW:
+            self.token_total -= self.tokens.popleft()[1]
+
+    def load(self, rpm: int, tpm: int):
+        """
+        Sort key for picking the least-loaded key: the fraction of the tighter
+        of the two limits in use, then calls in flight. Requests are recorded
+        when they start, so in-flight calls are already in the request window.
+        """
+        return (max(len(self.requests) / rpm, self.token_total / tpm), self.in_flight)
+
+    def available_at(self, now, rpm: int, tpm: int) -> float:
+        """Earliest time this key can take another request."""
+        at = max(now, self.cooldown_until)
+        if len(self.requests) >= rpm and self.requests:
+            at = max(at, self.requests[0] + RATE_WINDOW)
+        if self.token_total >= tpm and self.tokens:
+            at = max(at, self.tokens[0][0] + RATE_WINDOW)
+        return at
+
+class GeminiKeyPool:
+    """
+    Rotates Gemini requests across several API keys. Each call takes the
+    least-loaded key that is neither cooling down after a 429 nor at its
+    request/token rate limit, waiting for the first key to free up when all
+    are busy. Throughput scales with the number of keys configured.
+    """
+    def __init__(self, api_keys: list, rpm: int = GEMINI_KEY_RPM, tpm: int = GEMINI_KEY_TPM):
+        if not api_keys:
+            raise ValueError("GeminiKeyPool needs at least one API key")
+        self.rpm = rpm
+        self.tpm = tpm
+        self.keys = [KeyState(f"key-{index + 1}", api_key) for index, api_key in enumerate(api_keys)]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _try_acquire(self, exclude):
+        """Reserve a key now if one is usable; otherwise return (None, time the first one frees up)."""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [key for key in self.keys if key.label not in exclude] or self.keys
+            for key in candidates:
+                key.trim(now)
+            ready = [key for key in candidates if key.available_at(now, self.rpm, self.tpm) <= now]
+            if ready:
+                key = min(ready, key=lambda key: key.load(self.rpm, self.tpm))
+                key.requests.append(now)
+                key.in_flight += 1
+                return key, now
+            return None, min(key.available_at(now, self.rpm, self.tpm) for key in candidates)
+
+    def _wait_time(self, wait_until, deadline):
+        if deadline is not None and wait_until >= deadline:
+            raise TimeoutError("No Gemini API key available before the call deadline")
+        return min(max(wait_until - time.monotonic(), 0.05), 1.0)
+
+    def acquire(self, deadline: float = None, exclude=()) -> KeyState:
+        """
+        Reserve the least-loaded usable key, blocking until one frees up.
+        Keys in exclude (labels) are skipped unless nothing else is configured.
+        Raises TimeoutError if no key frees up before deadline (time.monotonic()).
+        """
+        while True:
+            key, wait_until = self._try_acquire(exclude)
+            if key is not None:
+                return key
+            time.sleep(self._wait_time(wait_until, deadline))
+
+    async def acquire_async(self, deadline: float = None, exclude=()) -> KeyState:
+        """acquire() for coroutines: waits without blocking the event loop."""
+        while True:
+            key, wait_until = self._try_acquire(exclude)
+            if key is not None:
+                return key
+            await asyncio.sleep(self._wait_time(wait_until, deadline))
+
+    def release(self, key: KeyState, tokens: int = 0, error=None):
+        """Return a key after a call, recording its tokens and starting a cooldown on a 429."""
+        with self._lock:
+            now = time.monotonic()
+            key.in_flight -= 1
+            if tokens:
+                key.tokens.append((now, tokens))
+                key.token_total += tokens
+            if error is not None and is_rate_limited(error):
+                key.consecutive_429s += 1
+                cooldown = min(KEY_COOLDOWN_SECONDS * 2 ** (key.consecutive_429s - 1), KEY_MAX_COOLDOWN_SECONDS)
+                key.cooldown_until = now + cooldown
+                logger.warning(f"Gemini {key.label} rate limited, cooling down for {cooldown:.0f}s")
+            elif error is None:
+                key.consecutive_429s = 0
+
+    def get_stats(self):
+        """Per-key snapshot: requests and tokens in the last minute, in-flight calls and cooldown left."""
+        with self._lock:
+            now = time.monotonic()
+            stats = []
+            for key in self.keys:
+                key.trim(now)
+                stats.append({
+                    'key': key.label,
+                    'requests_per_minute': len(key.requests),
+                    'tokens_per_minute': key.token_total,
+                    'in_flight': key.in_flight,
+                    'cooldown_seconds': max(key.cooldown_until - now, 0),
+                })
+            return stats
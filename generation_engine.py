@@ -0,0 +1,296 @@
+import os
+import uuid
+import logging
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from personalised_email import (
+    FOLLOWUP_PROMPTS, subject_style, body_style,
+    generate_email_for_single_lead_with_custom_prompt, generate_email_sequence_for_lead,
+    generate_emails_for_lead_batch, pack_leads_by_token_budget, generate_segment_template, failed_email
+)
+from context_cache import get_context_cache
+from email_cache import email_cache_key, lookup_emails, store_emails, project_lead, generation_stamp
+from llm_usage import usage_context, flush_usage
+from segment_templates import group_leads_by_segment, describe_segment, render_segment_email
+
+logger = logging.getLogger(__name__)
+
+# Default number of Gemini calls in flight at once
+GENERATION_CONCURRENCY = int(os.getenv('GENERATION_CONCURRENCY', '8'))
+# Upper bound offered in the UI
+MAX_GENERATION_CONCURRENCY = 32
+
+# Generation modes: one request per email, per lead (whole sequence), per batch of leads and day,
+# or one template per segment and day rendered locally for each lead
+MODE_SINGLE = "single"
+MODE_SEQUENCE = "sequence"
+MODE_BATCH = "batch"
+MODE_SEGMENT = "segment"
+
+def append_signature(body: str, signature: dict) -> str:
+    """Append the user's signature after the "Best Regards," closing, if both exist."""
+    if signature and body.strip().endswith("Best Regards,"):
+        body = body.rstrip() + f"\n\n{signature['name']}\n{signature['company']}\n{signature['linkedin_url']}\n"
+    return body
+
+def generation_record(lead: dict, product_name: str, day: int, campaign_id: str, product_details: dict = None) -> dict:
+    """
+    The inputs an email is (re)generated from, kept with the email through
+    scheduling. With product_details, the content hashes of the product
+    entry and prompt template used are stamped on as well.
+    """
+    record = {
+        "product_name": product_name,
+        "interval_day": day,
+        "lead_details": project_lead(lead),
+        "campaign_id": campaign_id
+    }
+    if product_details is not None:
+        record.update(generation_stamp(product_details, day))
+    return record
+
+def deferred_email_placeholder(lead: dict, product_name: str, day: int, campaign_id: str) -> dict:
+    """
+    Stand-in for a follow-up that is generated just in time by the scheduled
+    email worker. Carries everything the worker needs to generate it later.
+    """
+    return {
+        "subject": "",
+        "body": "",
+        "interval_day": day,
+        "deferred": True,
+        "generation": generation_record(lead, product_name, day, campaign_id)
+    }
+
+def split_failed_emails(all_generated_emails: list):
+    """
+    Separate emails that failed generation from the lead blocks.
+    Returns (blocks without failed emails, [{"lead_id", "lead_name", "interval_day", "error"}]).
+    """
+    clean_blocks = []
+    failures = []
+    for lead_block in all_generated_emails:
+        emails = []
+        for email in lead_block["emails"]:
+            if email.get("generation_failed"):
+                failures.append({
+                    "lead_id": lead_block["lead_id"],
+                    "lead_name": lead_block["lead_name"],
+                    "interval_day": email.get("interval_day"),
+                    "error": email.get("error", "")
+                })
+            else:
+                emails.append(email)
+        if emails:
+            clean_blocks.append(dict(lead_block, emails=emails))
+    return clean_blocks, failures
+
+class EmailGenerationEngine:
+    """
+    Generates emails for (lead, interval day) pairs on a bounded thread pool.
+    At most `max_concurrency` generations run at once and results are always
+    returned in input order, whatever order they complete in.
+    """
+    def __init__(self, max_concurrency: int = GENERATION_CONCURRENCY, context_cache=None):
+        self.max_concurrency = max(1, int(max_concurrency))
+        # Per-email requests send only lead details when a context cache is configured
+        self.context_cache = context_cache if context_cache is not None else get_context_cache()
+
+    def map_ordered(self, fn, items: list, progress_callback=None, on_error=None) -> list:
+        """
+        Apply fn to every item with bounded concurrency and return the results
+        in the order of items. progress_callback(done, total) is called from the
+        calling thread, so it is safe to update Streamlit widgets from it.
+        Each item runs in a copy of the caller's context, so usage tags set by
+        the caller (user, campaign) reach the worker threads.
+        An item that raises gets on_error(item, exception) as its result
+        (failed_email(...) by default), so one error never costs the others.
+        """
+        results = [None] * len(items)
+        if not items:
+            return results
+        with ThreadPoolExecutor(max_workers=min(self.max_concurrency, len(items))) as pool:
+            futures = {pool.submit(contextvars.copy_context().run, fn, item): index for index, item in enumerate(items)}
+            for done, future in enumerate(as_completed(futures), 1):
+                index = futures[future]
+                try:
+                    results[index] = future.result()
+                except Exception as e:
+                    logger.error(f"Generation task {index} failed: {str(e)}")
+                    results[index] = on_error(items[index], e) if on_error else failed_email(str(e))
+                if progress_callback:
+                    progress_callback(done, len(items))
+        return results
+
+    def generate_one(self, lead: dict, product_name: str, product_details: dict, day: int) -> dict:
+        """Generate the email for a single lead and interval day."""
+        if self.context_cache is not None:
+            return self.context_cache.generate_email(lead, product_details, product_name, day)
+        return generate_email_for_single_lead_with_custom_prompt(
+            lead_details=lead,
+            product_details=product_details,
+            prompt=FOLLOWUP_PROMPTS[day],
+            subject_style=subject_style,
+            body_style=body_style,
+            recipient_name=lead.get('name', 'No recipient'),
+            recipient_email=lead.get('email', 'No email provided'),
+            product_name=product_name,
+            followup_day=day
+        )
+
+    def generate_sequence(self, lead: dict, product_name: str, product_details: dict, days: list) -> dict:
+        """Generate the given interval days for one lead in a single request. Returns {day: email}."""
+        return generate_email_sequence_for_lead(lead, product_details, product_name, days)
+
+    def generate_pending(self, leads: list, product_name: str, product_details: dict, pending: list,
+                         mode: str = MODE_SINGLE, progress_callback=None) -> dict:
+        """
+        Generate the (lead_index, day) pairs in pending. mode picks how requests are formed:
+        - MODE_SINGLE: every pair is its own request;
+        - MODE_SEQUENCE: each lead's pending days come from one structured
+          request, falling back to per-day calls for days that fail;
+        - MODE_BATCH: leads pending the same day share a request, packed up to
+          a token budget, retrying only the leads that came back invalid;
+        - MODE_SEGMENT: leads are clustered by (industry, normalized title,
+          product) and each segment gets one template per day, rendered
+          locally from every lead's own fields. Segments whose template fails
+          fall back to per-email requests.
+        Returns {(lead_index, day): email}.
+        """
+        results = {}
+        if mode == MODE_SEGMENT:
+            segments = group_leads_by_segment(leads, product_name)
+            lead_segment = {lead_index: key for key, lead_indexes in segments.items() for lead_index in lead_indexes}
+            pending_by_task = {}
+            for lead_index, day in pending:
+                pending_by_task.setdefault((lead_segment[lead_index], day), []).append(lead_index)
+            tasks = list(pending_by_task)
+            logger.info(f"Generating {len(pending)} emails from {len(tasks)} segment templates with concurrency {self.max_concurrency}")
+            templates = self.map_ordered(
+                lambda task: generate_segment_template(
+                    describe_segment([leads[i] for i in pending_by_task[task]]), product_details, product_name, task[1]
+                ),
+                tasks,
+                progress_callback
+            )
+            fallback = []
+            for (key, day), template in zip(tasks, templates):
+                for lead_index in pending_by_task[(key, day)]:
+                    try:
+                        if template.get('generation_failed'):
+                            raise ValueError(template.get('error') or "template generation failed")
+                        results[(lead_index, day)] = render_segment_email(template, leads[lead_index])
+                    except (KeyError, ValueError) as e:
+                        logger.warning(f"Segment template unusable for lead {lead_index} (day {day}): {str(e)}")
+                        fallback.append((lead_index, day))
+            if fallback:
+                results.update(self.generate_pending(leads, product_name, product_details, fallback, MODE_SINGLE))
+        elif mode == MODE_SEQUENCE:
+            days_by_lead = {}
+            for lead_index, day in pending:
+                days_by_lead.setdefault(lead_index, []).append(day)
+            lead_indexes = list(days_by_lead)
+            logger.info(f"Generating sequences for {len(lead_indexes)} leads with concurrency {self.max_concurrency}")
+            sequences = self.map_ordered(
+                lambda lead_index: self.generate_sequence(leads[lead_index], product_name, product_details, days_by_lead[lead_index]),
+                lead_indexes,
+                progress_callback,
+                on_error=lambda lead_index, e: {day: failed_email(str(e)) for day in days_by_lead[lead_index]}
+            )
+            for lead_index, emails in zip(lead_indexes, sequences):
+                for day in days_by_lead[lead_index]:
+                    results[(lead_index, day)] = emails[day]
+        elif mode == MODE_BATCH:
+            leads_by_day = {}
+            for lead_index, day in pending:
+                leads_by_day.setdefault(day, []).append(lead_index)
+            tasks = []
+            for day, lead_indexes in leads_by_day.items():
+                day_leads = [leads[i] for i in lead_indexes]
+                for batch in pack_leads_by_token_budget(day_leads, product_details, product_name, day):
+                    tasks.append((day, [lead_indexes[i] for i in batch]))
+            logger.info(f"Generating {len(pending)} emails in {len(tasks)} batched requests with concurrency {self.max_concurrency}")
+            batch_results = self.map_ordered(
+                lambda task: generate_emails_for_lead_batch([leads[i] for i in task[1]], product_details, product_name, task[0]),
+                tasks,
+                progress_callback,
+                on_error=lambda task, e: [failed_email(str(e)) for _ in task[1]]
+            )
+            for (day, lead_indexes), emails in zip(tasks, batch_results):
+                for lead_index, email in zip(lead_indexes, emails):
+                    results[(lead_index, day)] = email
+        else:
+            logger.info(f"Generating {len(pending)} emails with concurrency {self.max_concurrency}")
+            emails = self.map_ordered(
+                lambda task: self.generate_one(leads[task[0]], product_name, product_details, task[1]),
+                pending,
+                progress_callback
+            )
+            results = dict(zip(pending, emails))
+        return results
+
+    def generate_campaign(self, leads: list, product_name: str, product_details: dict, intervals: list,
+                          signature: dict = None, progress_callback=None, mode: str = MODE_SINGLE,
+                          use_cache: bool = True, force_regenerate: bool = False,
+                          user_email: str = None, campaign_id: str = None, defer_followups: bool = False) -> list:
+        """
+        Generate every selected interval day for every lead.
+        Emails already generated from identical inputs (model, prompt template,
+        product details, lead details, interval day) are served from the email
+        cache without calling Gemini, unless force_regenerate is set. See
+        generate_pending for the request modes.
+        Every LLM call is recorded in llm_usage tagged with user_email and
+        campaign_id (a new id when none is given, also set on each block).
+        With defer_followups only day 0 is generated now; later days get a
+        deferred_email_placeholder and are generated by the worker shortly
+        before they are sent, and only if the lead hasn't replied.
+        Returns one block per lead, in lead order, shaped like
+        {"lead_id", "lead_name", "campaign_id", "emails": [...]} with emails sorted by interval day.
+        """
+        days = sorted(intervals)
+        campaign_id = campaign_id or uuid.uuid4().hex
+        generated_days = [day for day in days if day == 0] if defer_followups else days
+        pairs = [(lead_index, day) for lead_index in range(len(leads)) for day in generated_days]
+
+        cache_keys = {}
+        cached = {}
+        if use_cache:
+            # Segment renders are generic, so they never stand in for (or are served as) bespoke emails
+            variant = MODE_SEGMENT if mode == MODE_SEGMENT else None
+            cache_keys = {pair: email_cache_key(product_name, product_details, leads[pair[0]], pair[1], variant=variant) for pair in pairs}
+            if not force_regenerate:
+                hits = lookup_emails(set(cache_keys.values()))
+                cached = {pair: dict(hits[key]) for pair, key in cache_keys.items() if key in hits}
+                logger.info(f"Email cache: {len(cached)}/{len(pairs)} hits")
+
+        pending = [pair for pair in pairs if pair not in cached]
+        generated = {}
+        if pending:
+            with usage_context(user_email=user_email, campaign_id=campaign_id, generation_mode=mode):
+                generated = self.generate_pending(leads, product_name, product_details, pending, mode, progress_callback)
+            flush_usage()
+        if use_cache and generated:
+            # Cache the raw generation, before the signature is added
+            store_emails({cache_keys[pair]: (pair[1], dict(email)) for pair, email in generated.items()}, product_name)
+
+        results = {**cached, **generated}
+        all_generated_emails = []
+        for lead_index, lead in enumerate(leads):
+            lead_emails = []
+            for day in days:
+                if (lead_index, day) not in results:
+                    lead_emails.append(deferred_email_placeholder(lead, product_name, day, campaign_id))
+                    continue
+                email = results[(lead_index, day)]
+                email['body'] = append_signature(email.get('body', ''), signature)
+                email["interval_day"] = day
+                if not email.get("generation_failed"):
+                    email["generation"] = generation_record(lead, product_name, day, campaign_id, product_details)
+                lead_emails.append(email)
+            all_generated_emails.append({
+                "lead_id": lead.get("id") or lead.get("lead_id"),
+                "lead_name": lead.get("name"),
+                "campaign_id": campaign_id,
+                "emails": lead_emails
+            })
+        return all_generated_emails
@@ -0,0 +1,201 @@
+import os
+import time
+import logging
+import threading
+from datetime import datetime, timedelta
+from personalised_email import get_product_details
+from generation_engine import EmailGenerationEngine, split_failed_emails, GENERATION_CONCURRENCY, MODE_SINGLE
+from mongodb_client import (
+    save_generation_job, update_generation_job, fetch_generation_job, save_generated_lead_blocks,
+    save_generation_job_leads, fetch_generation_job_leads,
+    fetch_completed_lead_indexes, ensure_generation_job_indexes, fetch_generated_emails_for_campaign,
+    get_signature
+)
+
+logger = logging.getLogger(__name__)
+
+# Leads generated between two checkpoints
+CHECKPOINT_LEADS = int(os.getenv('GENERATION_CHECKPOINT_LEADS', '25'))
+# A running job whose heartbeat is older than this is treated as dead and can be resumed
+HEARTBEAT_TIMEOUT = int(os.getenv('GENERATION_HEARTBEAT_TIMEOUT', '300'))
+# Minimum seconds between heartbeats written from generation progress
+HEARTBEAT_INTERVAL = 30
+# Failed emails kept on the job record for reporting
+MAX_REPORTED_FAILURES = 200
+
+# Job states
+STATE_RUNNING = 'running'
+STATE_COMPLETED = 'completed'
+STATE_FAILED = 'failed'
+
+# Jobs running in this process, so Streamlit reruns don't start a second copy
+_running_jobs = {}
+_running_lock = threading.Lock()
+
+def create_generation_job(leads: list, product_name: str, intervals: list, user_email: str, campaign_id: str,
+                          mode: str = MODE_SINGLE, max_concurrency: int = GENERATION_CONCURRENCY,
+                          force_regenerate: bool = False, defer_followups: bool = False,
+                          lead_products: list = None) -> str:
+    """
+    Record a generation job with a snapshot of its leads (stored per lead,
+    see save_generation_job_leads), so it can be run and resumed without
+    the Streamlit session. The job id is the campaign id.
+    lead_products optionally gives a product per lead (aligned to leads),
+    overriding product_name where set.
+    """
+    ensure_generation_job_indexes()
+    # Leads first: a job record is never visible without its leads
+    save_generation_job_leads(campaign_id, [{key: value for key, value in lead.items() if key != '_id'} for lead in leads],
+                              lead_products)
+    save_generation_job({
+        '_id': campaign_id,
+        'user_email': user_email,
+        'product_name': product_name,
+        'intervals': sorted(intervals),
+        'mode': mode,
+        'max_concurrency': max_concurrency,
+        'force_regenerate': force_regenerate,
+        'defer_followups': defer_followups,
+        'lead_count': len(leads),
+        'completed_leads': 0,
+        'failed_count': 0,
+        'failures': [],
+        'state': STATE_RUNNING,
+        'created_at': datetime.now(),
+        'heartbeat_at': datetime.now()
+    })
+    return campaign_id
+
+def run_generation_job(job_id: str, engine: EmailGenerationEngine = None):
+    """
+    Generate every lead of a job that doesn't have saved results yet,
+    CHECKPOINT_LEADS at a time. Each chunk's lead blocks are written to
+    generated_emails and the job's progress updated before the next chunk
+    starts, so a crash or restart loses at most one chunk. Only leads whose
+    every requested day succeeded are checkpointed; the rest are retried by
+    the next run, and failed_count reflects this run's failures.
+    """
+    job = fetch_generation_job(job_id)
+    if job is None:
+        raise ValueError(f"Generation job {job_id} not found")
+    ensure_generation_job_indexes()
+    engine = engine or EmailGenerationEngine(max_concurrency=job.get('max_concurrency', GENERATION_CONCURRENCY))
+    snapshots = fetch_generation_job_leads(job_id)
+    leads = [snapshot['lead'] for snapshot in snapshots]
+    lead_products = [snapshot.get('product_name') for snapshot in snapshots]
+    done = fetch_completed_lead_indexes(job_id)
+    remaining = [index for index in range(len(leads)) if index not in done]
+    completed = len(done)
+    failures = []
+    update_generation_job(job_id, {
+        'state': STATE_RUNNING, 'completed_leads': completed, 'failed_count': 0, 'failures': [], 'heartbeat_at': datetime.now()
+    })
+    if done:
+        logger.info(f"Resuming generation job {job_id}: {len(done)}/{len(leads)} leads already done")
+
+    product_details = {}
+    signature = get_signature(job['user_email'])
+    last_heartbeat = [time.monotonic()]
+
+    def heartbeat(done_count, total):
+        # Keep the job alive while a slow chunk runs, so is_resumable doesn't offer it to another process
+        if time.monotonic() - last_heartbeat[0] >= HEARTBEAT_INTERVAL:
+            last_heartbeat[0] = time.monotonic()
+            update_generation_job(job_id, {'heartbeat_at': datetime.now()})
+
+    try:
+        for start in range(0, len(remaining), CHECKPOINT_LEADS):
+            chunk = remaining[start:start + CHECKPOINT_LEADS]
+            # One generate_campaign call per product within the chunk
+            by_product = {}
+            for index in chunk:
+                by_product.setdefault(lead_products[index] or job['product_name'], []).append(index)
+            blocks = []
+            for product_name, indexes in by_product.items():
+                if product_name not in product_details:
+                    product_details[product_name] = get_product_details(product_name.lower())
+                product_blocks = engine.generate_campaign(
+                    [leads[index] for index in indexes],
+                    product_name=product_name,
+                    product_details=product_details[product_name],
+                    intervals=job['intervals'],
+                    signature=signature,
+                    progress_callback=heartbeat,
+                    mode=job['mode'],
+                    force_regenerate=job.get('force_regenerate', False),
+                    user_email=job['user_email'],
+                    campaign_id=job_id,
+                    defer_followups=job.get('defer_followups', False)
+                )
+                for index, block in zip(indexes, product_blocks):
+                    block['lead_index'] = index
+                    block['product_name'] = product_name
+                blocks.extend(product_blocks)
+            # A lead missing any day isn't checkpointed, so a resume regenerates the whole lead
+            complete_blocks = []
+            for block in blocks:
+                _, block_failures = split_failed_emails([block])
+                if block_failures:
+                    failures.extend(block_failures)
+                else:
+                    complete_blocks.append(block)
+            save_generated_lead_blocks(complete_blocks, job['user_email'])
+            completed += len(complete_blocks)
+            update_generation_job(job_id, {
+                'heartbeat_at': datetime.now(), 'completed_leads': completed,
+                'failed_count': len(failures), 'failures': failures[-MAX_REPORTED_FAILURES:]
+            })
+        update_generation_job(job_id, {'state': STATE_COMPLETED, 'completed_at': datetime.now()})
+        logger.info(f"Generation job {job_id} completed")
+    except Exception as e:
+        logger.error(f"Generation job {job_id} failed: {str(e)}")
+        update_generation_job(job_id, {'state': STATE_FAILED, 'error': str(e)})
+        raise
+
+def is_job_running_here(job_id: str) -> bool:
+    with _running_lock:
+        thread = _running_jobs.get(job_id)
+        return thread is not None and thread.is_alive()
+
+def start_generation_job(job_id: str) -> bool:
+    """
+    Run a job on a background thread of this process, unless it is already
+    running here. The thread outlives Streamlit reruns of the page that
+    started it. Returns True if a new run was started.
+    """
+    with _running_lock:
+        thread = _running_jobs.get(job_id)
+        if thread is not None and thread.is_alive():
+            return False
+
+        def run():
+            try:
+                run_generation_job(job_id)
+            except Exception:
+                pass  # Already logged and recorded on the job
+
+        thread = threading.Thread(target=run, name=f"generation-job-{job_id}", daemon=True)
+        _running_jobs[job_id] = thread
+        thread.start()
+        return True
+
+def has_failed_leads(job: dict) -> bool:
+    """True for a completed job that left some leads without all their emails."""
+    return job['state'] == STATE_COMPLETED and job.get('completed_leads', 0) < job.get('lead_count', 0)
+
+def is_resumable(job: dict) -> bool:
+    """
+    True if a job didn't finish (or finished with failed leads) and nothing
+    is working on it any more.
+    """
+    if job['state'] == STATE_FAILED or has_failed_leads(job):
+        return not is_job_running_here(job['_id'])
+    stale_before = datetime.now() - timedelta(seconds=HEARTBEAT_TIMEOUT)
+    return job['state'] == STATE_RUNNING and not is_job_running_here(job['_id']) and job.get('heartbeat_at', stale_before) <= stale_before
+
+def load_job_results(job_id: str, user_email: str = None) -> list:
+    """A job's saved lead blocks in lead order, ready for the preview and Send Emails tab."""
+    blocks = fetch_generated_emails_for_campaign(job_id, user_email)
+    blocks = [{key: value for key, value in block.items() if key not in ('_id', 'user_email')}
+              for block in blocks if 'lead_index' in block]
+    return sorted(blocks, key=lambda block: block['lead_index'])
@@ -0,0 +1,125 @@
+import argparse
+import logging
+from collections import Counter
+from mongodb_client import fetch_regeneration_candidates, replace_scheduled_email_content, get_signature
+from personalised_email import get_product_details
+from generation_engine import EmailGenerationEngine, append_signature, GENERATION_CONCURRENCY
+from email_cache import generation_stamp
+from llm_usage import usage_context, flush_usage
+
+logger = logging.getLogger(__name__)
+
+# Stamp fields compared against the current inputs; template_version covers generation code changes
+STAMP_FIELDS = ('product_hash', 'template_hash', 'template_version')
+
+def stored_stamp(email) -> dict:
+    """The stamp an email was generated with, or None for emails generated before stamping."""
+    generation = email.get('generation') or {}
+    if not all(field in generation for field in STAMP_FIELDS):
+        return None
+    return {field: generation[field] for field in STAMP_FIELDS}
+
+def changed_inputs(stamp: dict, current: dict) -> list:
+    """Which inputs differ: any of "product", "template"."""
+    changed = []
+    if stamp['product_hash'] != current['product_hash']:
+        changed.append('product')
+    if stamp['template_hash'] != current['template_hash'] or stamp['template_version'] != current['template_version']:
+        changed.append('template')
+    return changed
+
+class StampIndex:
+    """Current generation stamps, computed once per (product, interval day)."""
+    def __init__(self):
+        self._products = {}
+        self._stamps = {}
+
+    def product_details(self, product_name: str):
+        key = product_name.lower()
+        if key not in self._products:
+            self._products[key] = get_product_details(key)
+        return self._products[key]
+
+    def current(self, product_name: str, day: int):
+        """None if the product no longer exists."""
+        key = (product_name.lower(), day)
+        if key not in self._stamps:
+            product_details = self.product_details(product_name)
+            self._stamps[key] = generation_stamp(product_details, day) if product_details else None
+        return self._stamps[key]
+
+def find_stale_emails(user_email: str = None, stamps: StampIndex = None):
+    """
+    Split a user's (or everyone's) pending scheduled emails into stale ones,
+    as (email, stored stamp, current stamp, changed inputs) tuples, and a
+    summary of the rest.
+    """
+    stamps = stamps or StampIndex()
+    stale = []
+    summary = Counter()
+    for email in fetch_regeneration_candidates(user_email):
+        summary['checked'] += 1
+        stamp = stored_stamp(email)
+        if stamp is None:
+            summary['unstamped'] += 1
+            continue
+        generation = email['generation']
+        current = stamps.current(generation['product_name'], generation.get('interval_day', email.get('followup_day', 0)))
+        if current is None:
+            summary['unknown_product'] += 1
+            continue
+        changed = changed_inputs(stamp, current)
+        if changed:
+            stale.append((email, stamp, current, changed))
+        else:
+            summary['current'] += 1
+    return stale, summary
+
+def regenerate_email(email, expected_stamp: dict, stamps: StampIndex, engine: EmailGenerationEngine) -> str:
+    """Regenerate one stale email and store it. Returns "regenerated", "superseded" or "failed"."""
+    generation = email['generation']
+    product_name = generation['product_name']
+    day = generation.get('interval_day', email.get('followup_day', 0))
+    try:
+        with usage_context(user_email=email.get('user_email') or email['sender_email'],
+                           campaign_id=generation.get('campaign_id'), generation_mode='regeneration'):
+            generated = engine.generate_one(generation['lead_details'], product_name, stamps.product_details(product_name), day)
+        if generated.get('generation_failed'):
+            raise Exception(generated.get('error') or "Generation failed")
+        body = append_signature(generated.get('body', ''), get_signature(email['sender_email']))
+        if not replace_scheduled_email_content(email['_id'], generated['subject'], body,
+                                               stamps.current(product_name, day), expected_stamp):
+            # Sent, claimed or regenerated by someone else in the meantime
+            return 'superseded'
+        return 'regenerated'
+    except Exception as e:
+        logger.error(f"Error regenerating scheduled email {email['_id']}: {str(e)}")
+        return 'failed'
+
+def run_incremental_regeneration(user_email: str = None, dry_run: bool = False, engine: EmailGenerationEngine = None) -> dict:
+    """
+    Regenerate the unsent scheduled emails whose product entry or prompt
+    template changed since they were generated. Emails generated before
+    stamping are reported as unstamped and left alone. Returns a summary.
+    """
+    stamps = StampIndex()
+    stale, summary = find_stale_emails(user_email, stamps)
+    summary['stale'] = len(stale)
+    for _, _, _, changed in stale:
+        for name in changed:
+            summary[f'{name}_changed'] += 1
+    if stale and not dry_run:
+        engine = engine or EmailGenerationEngine(max_concurrency=GENERATION_CONCURRENCY)
+        results = engine.map_ordered(lambda item: regenerate_email(item[0], item[1], stamps, engine), stale)
+        summary.update(results)
+        flush_usage()
+    logger.info(f"[Regeneration] {dict(summary)}")
+    return dict(summary)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Regenerate unsent emails whose product entry or prompt template changed.")
+    parser.add_argument('--user', help="Only this user's scheduled emails")
+    parser.add_argument('--dry-run', action='store_true', help="Report stale emails without regenerating them")
+    args = parser.parse_args()
+    print(run_incremental_regeneration(args.user, args.dry_run))
@@ -0,0 +1,98 @@
+import os
+import logging
+from datetime import datetime, timedelta
+from mongodb_client import (
+    claim_deferred_generations, complete_deferred_generation, release_deferred_generation,
+    cancel_conversation_followups, check_for_reply, get_signature
+)
+from personalised_email import get_product_details
+from generation_engine import EmailGenerationEngine, append_signature, GENERATION_CONCURRENCY
+from llm_usage import usage_context, flush_usage
+from email_cache import generation_stamp
+
+logger = logging.getLogger(__name__)
+
+# Generate a deferred follow-up this many seconds before its scheduled_time
+JIT_GENERATION_LEAD_TIME = int(os.getenv('JIT_GENERATION_LEAD_TIME', '3600'))
+# Maximum number of follow-ups a worker claims for generation per pass
+JIT_GENERATION_BATCH_SIZE = int(os.getenv('JIT_GENERATION_BATCH_SIZE', '20'))
+# How often (seconds) the event-driven worker looks for follow-ups to generate
+JIT_CHECK_INTERVAL = int(os.getenv('JIT_CHECK_INTERVAL', '300'))
+# Generation attempts before a follow-up is marked failed
+JIT_MAX_ATTEMPTS = int(os.getenv('JIT_MAX_ATTEMPTS', '3'))
+# Seconds before a failed generation is retried, doubled after every further failure
+JIT_RETRY_BACKOFF = int(os.getenv('JIT_RETRY_BACKOFF', '120'))
+
+def get_generation_cutoff(current_time=None):
+    """Latest scheduled_time whose follow-up should be generated now."""
+    return (current_time or datetime.now()) + timedelta(seconds=JIT_GENERATION_LEAD_TIME)
+
+def conversation_is_unanswered(email) -> bool:
+    """
+    True if the lead hasn't replied since the campaign started. On a reply
+    every pending follow-up of the conversation is cancelled, so nothing is
+    generated (or sent) for it.
+    """
+    if email.get('responded'):
+        return False
+    since = email.get('campaign_started_at') or email['scheduled_time'] - timedelta(days=email.get('followup_day', 0))
+    if check_for_reply(email['sender_email'], email['email'][0], since):
+        cancelled = cancel_conversation_followups(email['conversation_id'])
+        logger.info(f"Lead {email['email'][0]} replied, cancelled {cancelled} follow-ups without generating them")
+        return False
+    return True
+
+def generate_deferred_email(email, engine: EmailGenerationEngine) -> dict:
+    """
+    Generate the subject and body of a claimed deferred follow-up, with the
+    generation_stamp of the inputs used under "stamp".
+    """
+    generation = email['generation']
+    product_name = generation['product_name']
+    product_details = get_product_details(product_name.lower())
+    day = generation.get('interval_day', email['followup_day'])
+    with usage_context(user_email=email.get('user_email') or email['sender_email'],
+                       campaign_id=generation.get('campaign_id'), generation_mode='just_in_time'):
+        generated = engine.generate_one(generation['lead_details'], product_name, product_details, day)
+    generated['body'] = append_signature(generated.get('body', ''), get_signature(email['sender_email']))
+    generated['stamp'] = generation_stamp(product_details, day)
+    return generated
+
+def process_claimed_generation(email, worker_id: str, engine: EmailGenerationEngine) -> bool:
+    """Generate one claimed follow-up and store it. Returns True if it is ready to send."""
+    try:
+        if not conversation_is_unanswered(email):
+            return False
+        generated = generate_deferred_email(email, engine)
+        if generated.get('generation_failed'):
+            raise Exception(generated.get('error') or "Generation failed")
+        if not complete_deferred_generation(email['_id'], generated['subject'], generated['body'], worker_id, generated['stamp']):
+            logger.warning(f"Generation lease on scheduled email {email['_id']} was lost before it could be stored")
+            return False
+        return True
+    except Exception as e:
+        attempts = email.get('generation_attempts', 1)
+        give_up = attempts >= JIT_MAX_ATTEMPTS
+        logger.error(f"Error generating scheduled email {email['_id']}{' (giving up)' if give_up else ''}: {str(e)}")
+        # Back off so a transient outage doesn't use up every attempt within one pass
+        release_deferred_generation(email['_id'], str(e), worker_id, give_up=give_up,
+                                    retry_after=JIT_RETRY_BACKOFF * 2 ** (attempts - 1))
+        return False
+
+def process_deferred_generations(worker_id: str, engine: EmailGenerationEngine = None) -> int:
+    """
+    Claim and generate every deferred follow-up due within the lead time,
+    generating a batch at a time in parallel. Returns the number generated.
+    """
+    engine = engine or EmailGenerationEngine(max_concurrency=GENERATION_CONCURRENCY)
+    total = 0
+    while True:
+        claimed = claim_deferred_generations(worker_id, JIT_GENERATION_BATCH_SIZE, get_generation_cutoff())
+        if claimed:
+            results = engine.map_ordered(lambda email: process_claimed_generation(email, worker_id, engine), claimed)
+            total += sum(results)
+            flush_usage()
+        if len(claimed) < JIT_GENERATION_BATCH_SIZE:
+            if total:
+                logger.info(f"Generated {total} follow-ups just in time")
+            return total
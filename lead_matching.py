@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+import numpy as np
+from personalised_email import prompt_registry, project_lead_for_prompt
+
+# Lead fields that describe what the lead's company does
+LEAD_MATCH_FIELDS = ['title', 'headline', 'company_industry', 'company_overview', 'company_keywords']
+# Minimum fit score (cosine similarity of TF-IDF vectors, 0-1) for a lead to be generated
+LEAD_FIT_THRESHOLD = float(os.getenv('LEAD_FIT_THRESHOLD', '0.05'))
+# Leads vectorized per matrix operation, bounding memory for very large sets
+LEAD_MATCH_CHUNK = int(os.getenv('LEAD_MATCH_CHUNK', '2048'))
+
+TOKEN_PATTERN = re.compile(r'[a-z][a-z0-9]+')
+STOP_WORDS = {
+    'and', 'the', 'for', 'with', 'from', 'into', 'that', 'this', 'are', 'our', 'your', 'their', 'its',
+    'of', 'to', 'in', 'on', 'by', 'as', 'at', 'an', 'or', 'is', 'be', 'we', 'you', 'it', 'all', 'more',
+    'based', 'like', 'across', 'using', 'via', 'over', 'than', 'also', 'has', 'have', 'can', 'not'
+}
+
+def tokenize(text: str) -> list:
+    """Lowercase word tokens without stop words, with simple plurals folded ("hospitals" -> "hospital")."""
+    tokens = []
+    for token in TOKEN_PATTERN.findall(text.lower()):
+        if token in STOP_WORDS:
+            continue
+        if len(token) > 4 and token.endswith('s') and not token.endswith('ss'):
+            token = token[:-1]
+        tokens.append(token)
+    return tokens
+
+def _flatten_text(value) -> str:
+    if isinstance(value, dict):
+        return ' '.join(_flatten_text(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return ' '.join(_flatten_text(item) for item in value)
+    return str(value)
+
+def lead_text(lead: dict) -> str:
+    """The lead's match fields, as projected for prompts, in one string."""
+    projected = project_lead_for_prompt(lead)
+    return ' '.join(projected[field] for field in LEAD_MATCH_FIELDS if field in projected)
+
+class ProductMatcher:
+    """
+    TF-IDF vectors of every product entry, computed once. Leads are
+    vectorized over the same vocabulary and scored against all products
+    with a single matrix product: scores[lead, product] is the cosine
+    similarity of the two, 0 when they share no terms.
+    """
+    def __init__(self, products: dict):
+        self.keys = list(products)
+        documents = [tokenize(_flatten_text(products[key])) for key in self.keys]
+        self.vocabulary = {}
+        for tokens in documents:
+            for token in tokens:
+                self.vocabulary.setdefault(token, len(self.vocabulary))
+        counts = self._count_matrix(documents)
+        # Smoothed idf: terms found in every product still count a little
+        document_frequency = (counts > 0).sum(axis=0)
+        self.idf = np.log((1 + len(documents)) / (1 + document_frequency)) + 1
+        self.product_vectors = self._weigh(counts)
+
+    def _count_matrix(self, documents: list):
+        counts = np.zeros((len(documents), len(self.vocabulary)), dtype=np.float32)
+        for row, tokens in enumerate(documents):
+            for token in tokens:
+                column = self.vocabulary.get(token)
+                if column is not None:
+                    counts[row, column] += 1
+        return counts
+
+    def _weigh(self, counts):
+        """Sublinear tf * idf, L2-normalized per row."""
+        weights = np.zeros_like(counts)
+        nonzero = counts > 0
+        weights[nonzero] = 1 + np.log(counts[nonzero])
+        weights *= self.idf
+        norms = np.linalg.norm(weights, axis=1, keepdims=True)
+        return weights / np.where(norms == 0, 1, norms)
+
+    def score(self, leads: list):
+        """(len(leads), len(keys)) array of fit scores."""
+        scores = np.zeros((len(leads), len(self.keys)), dtype=np.float32)
+        for start in range(0, len(leads), LEAD_MATCH_CHUNK):
+            chunk = leads[start:start + LEAD_MATCH_CHUNK]
+            vectors = self._weigh(self._count_matrix([tokenize(lead_text(lead)) for lead in chunk]))
+            scores[start:start + len(chunk)] = vectors @ self.product_vectors.T
+        return scores
+
+    def product_index(self, product_name: str) -> int:
+        try:
+            return self.keys.index(product_name.lower())
+        except ValueError:
+            raise ValueError(f"No product_database entry for product {product_name!r}")
+
+    def best_products(self, leads: list) -> list:
+        """(product key, score) of the best-fitting product for every lead."""
+        scores = self.score(leads)
+        if not len(leads):
+            return []
+        best = scores.argmax(axis=1)
+        return [(self.keys[column], float(scores[row, column])) for row, column in enumerate(best)]
+
+    def filter_by_fit(self, leads: list, product_name: str, threshold: float = LEAD_FIT_THRESHOLD):
+        """
+        Split leads by their fit with one product. Returns (kept, dropped,
+        scores), with scores aligned to leads.
+        """
+        column = self.score(leads)[:, self.product_index(product_name)]
+        kept = [lead for lead, score in zip(leads, column) if score >= threshold]
+        dropped = [lead for lead, score in zip(leads, column) if score < threshold]
+        return kept, dropped, [float(score) for score in column]
+
+_matcher = None
+_matcher_lock = threading.Lock()
+
+def get_product_matcher() -> ProductMatcher:
+    """Matcher over product_database, built on first use."""
+    global _matcher
+    with _matcher_lock:
+        if _matcher is None:
+            _matcher = ProductMatcher(prompt_registry.products)
+        return _matcher
+
+def assign_products(leads: list, threshold: float = LEAD_FIT_THRESHOLD):
+    """
+    Best product key per lead, or None where no product reaches threshold.
+    Returns (assignments, scores), aligned to leads.
+    """
+    best = get_product_matcher().best_products(leads)
+    assignments = [key if score >= threshold else None for key, score in best]
+    return assignments, [score for _, score in best]
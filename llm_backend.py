@@ -0,0 +1,226 @@
+import os
+import re
+import json
+import math
+import time
+import random
+import asyncio
+import hashlib
+import threading
+import logging
+from types import SimpleNamespace
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+# "gemini" calls the Gemini API, "stub" the offline StubBackend below
+LLM_BACKEND = os.getenv('LLM_BACKEND', 'gemini').lower()
+# Stub latency in seconds: "fixed:S", "uniform:LOW,HIGH", "normal:MEAN,STD" or "lognormal:MEDIAN,SIGMA"
+LLM_STUB_LATENCY = os.getenv('LLM_STUB_LATENCY', 'lognormal:1.2,0.4')
+# Fraction of stub calls that fail with a server error, with a 429, or return schema-invalid JSON
+LLM_STUB_ERROR_RATE = float(os.getenv('LLM_STUB_ERROR_RATE', '0'))
+LLM_STUB_RATE_LIMIT_RATE = float(os.getenv('LLM_STUB_RATE_LIMIT_RATE', '0'))
+LLM_STUB_INVALID_RATE = float(os.getenv('LLM_STUB_INVALID_RATE', '0'))
+LLM_STUB_SEED = os.getenv('LLM_STUB_SEED', '0')
+# Fake API keys the stub spreads requests over, so the key pool behaves as in production
+LLM_STUB_KEYS = int(os.getenv('LLM_STUB_KEYS', '2'))
+
+class LLMBackend:
+    """
+    One model request on behalf of the Gemini client. The client keeps the
+    deadline, key pool, 429 failover, hedging and usage accounting around
+    it, so every backend is driven by the same machinery. Responses must
+    expose .text and .usage_metadata like a Gemini response. cached_content
+    names a prefix made by create_cached_content that the prompt follows.
+    """
+    name = None
+
+    def generate(self, prompt, model_name: str, generation_config: dict, key, timeout: float, cached_content: str = None):
+        raise NotImplementedError
+
+    async def generate_async(self, prompt, model_name: str, generation_config: dict, key, timeout: float, cached_content: str = None):
+        return await asyncio.to_thread(self.generate, prompt, model_name, generation_config, key, timeout, cached_content)
+
+    def create_cached_content(self, model_name: str, display_name: str, system_instruction: str, ttl_seconds: int) -> str:
+        """Store a static prompt prefix for model_name with a TTL. Returns its name."""
+        raise NotImplementedError
+
+class StubRateLimited(Exception):
+    """Injected 429, recognized by is_rate_limited like the API's ResourceExhausted."""
+    code = 429
+
+class StubServerError(Exception):
+    """Injected transient server error."""
+    code = 503
+
+def parse_latency_spec(spec: str):
+    """A function of a random.Random returning one latency in seconds, for an LLM_STUB_LATENCY spec."""
+    kind, _, args = spec.partition(':')
+    values = [float(value) for value in args.split(',') if value.strip()]
+    kind = kind.strip().lower()
+    if kind == 'fixed':
+        return lambda rng: values[0]
+    if kind == 'uniform':
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'normal':
+        return lambda rng: max(rng.gauss(values[0], values[1]), 0.0)
+    if kind == 'lognormal':
+        return lambda rng: values[0] * math.exp(rng.gauss(0, values[1]))
+    raise ValueError(f"Unknown stub latency distribution {spec!r}")
+
+# Sentences stub bodies are assembled from
+STUB_SENTENCES = [
+    "I came across your team's work and thought our product could be relevant.",
+    "Teams like yours often lose hours to manual follow-ups and scattered data.",
+    "Our product automates the repetitive parts so people can focus on decisions.",
+    "It fits into the tools you already use, with no lengthy rollout.",
+    "A similar team cut their turnaround time noticeably within a few weeks.",
+    "Happy to share a short walkthrough tailored to your setup.",
+    "Would a 15-minute call next week be useful?",
+    "If the timing isn't right, I'd be glad to reconnect later in the quarter.",
+]
+
+class StubBackend(LLMBackend):
+    """
+    Deterministic offline backend. Output, latency and injected failures are
+    drawn from a generator seeded by (seed, prompt, how many times this
+    prompt was requested), so a run is reproducible and retries of the same
+    prompt can come out differently. JSON follows the request's
+    response_schema; array responses get one item per "### Interval day N"
+    section or per "lead_key" found in the prompt. Bodies fall within the
+    EMAIL_MIN_WORDS..EMAIL_MAX_WORDS range the tiering quality checks expect,
+    so escalations only come from injected faults.
+    """
+    name = 'stub'
+
+    def __init__(self, latency: str = LLM_STUB_LATENCY, error_rate: float = LLM_STUB_ERROR_RATE,
+                 rate_limit_rate: float = LLM_STUB_RATE_LIMIT_RATE, invalid_rate: float = LLM_STUB_INVALID_RATE,
+                 seed: str = LLM_STUB_SEED, sleep: bool = True):
+        self.latency = parse_latency_spec(latency)
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.invalid_rate = invalid_rate
+        self.seed = seed
+        self.sleep = sleep
+        self._calls = Counter()
+        self._cached_contents = {}
+        self._lock = threading.Lock()
+        self.stats = Counter()
+        # Imported here: model_tiering depends on gemini_client, which depends on this module
+        from model_tiering import EMAIL_MIN_WORDS, EMAIL_MAX_WORDS
+        self.body_words = (EMAIL_MIN_WORDS, EMAIL_MAX_WORDS)
+
+    def _rng(self, prompt):
+        digest = hashlib.sha256(str(prompt).encode('utf-8')).hexdigest()
+        with self._lock:
+            attempt = self._calls[digest]
+            self._calls[digest] += 1
+        return random.Random(f"{self.seed}:{digest}:{attempt}"), digest
+
+    def _count(self, outcome):
+        with self._lock:
+            self.stats[outcome] += 1
+
+    def _plan(self, prompt, generation_config, timeout):
+        """(latency to wait, error to raise or None, response or None) for one call."""
+        rng, digest = self._rng(prompt)
+        latency = self.latency(rng)
+        roll = rng.random()
+        if latency > timeout:
+            self._count('timeout')
+            return timeout, TimeoutError(f"Stub call exceeded its {timeout:.0f}s deadline"), None
+        if roll < self.rate_limit_rate:
+            self._count('rate_limited')
+            return latency * 0.1, StubRateLimited("429 Resource has been exhausted (stub)"), None
+        if roll < self.rate_limit_rate + self.error_rate:
+            self._count('error')
+            return latency, StubServerError("503 The service is currently unavailable (stub)"), None
+        if roll < self.rate_limit_rate + self.error_rate + self.invalid_rate:
+            self._count('invalid')
+            text = json.dumps({"subject": ""})
+        else:
+            self._count('ok')
+            schema = (generation_config or {}).get('response_schema') or {"type": "OBJECT", "properties": {"subject": {"type": "STRING"}, "body": {"type": "STRING"}}}
+            text = json.dumps(self._value(schema, str(prompt), rng, digest))
+        return latency, None, self._response(str(prompt), text)
+
+    def _response(self, prompt, text):
+        prompt_tokens = max(1, len(prompt) // 4)
+        response_tokens = max(1, len(text) // 4)
+        return SimpleNamespace(text=text, usage_metadata=SimpleNamespace(
+            prompt_token_count=prompt_tokens, candidates_token_count=response_tokens,
+            cached_content_token_count=0, total_token_count=prompt_tokens + response_tokens
+        ))
+
+    def _value(self, schema, prompt, rng, digest, name=None):
+        kind = schema.get('type', 'STRING').upper()
+        if kind == 'OBJECT':
+            return {field: self._value(sub, prompt, rng, digest, field) for field, sub in schema.get('properties', {}).items()}
+        if kind == 'ARRAY':
+            items = schema.get('items', {})
+            fields = items.get('properties', {})
+            if 'interval_day' in fields:
+                return [dict(self._value(items, prompt, rng, digest), interval_day=int(day))
+                        for day in re.findall(r'### Interval day (\d+)', prompt)]
+            if 'lead_key' in fields:
+                return [dict(self._value(items, prompt, rng, digest), lead_key=key)
+                        for key in re.findall(r'"lead_key":"([^"]*)"', prompt)]
+            return [self._value(items, prompt, rng, digest)]
+        if kind == 'INTEGER':
+            return rng.randint(0, 30)
+        if name == 'subject':
+            return f"Streamlining your workflow, reference {digest[:6]}"
+        if name == 'body':
+            return self._body(rng)
+        return ""
+
+    def _body(self, rng):
+        """A body with a word count in the lower half of self.body_words."""
+        low, high = self.body_words
+        target = rng.randint(low, max(low, (low + high) // 2))
+        pool = rng.sample(STUB_SENTENCES, len(STUB_SENTENCES))
+        sentences = []
+        words = 4  # "Hi there," and "Best Regards,"
+        while words < target:
+            sentence = pool[len(sentences) % len(pool)]
+            if words + len(sentence.split()) > high:
+                break
+            sentences.append(sentence)
+            words += len(sentence.split())
+        return "Hi there,\n\n" + "\n\n".join(sentences) + "\n\nBest Regards,\n\n"
+
+    def create_cached_content(self, model_name: str, display_name: str, system_instruction: str, ttl_seconds: int) -> str:
+        name = f"cachedContents/stub-{hashlib.sha256(system_instruction.encode('utf-8')).hexdigest()[:16]}"
+        with self._lock:
+            self._cached_contents[name] = system_instruction
+        return name
+
+    def _full_prompt(self, prompt, cached_content):
+        """The prompt as the model would see it, cached prefix included."""
+        if cached_content is None:
+            return prompt
+        with self._lock:
+            prefix = self._cached_contents.get(cached_content)
+        if prefix is None:
+            raise StubServerError(f"404 Cached content {cached_content} not found (stub)")
+        return f"{prefix}\n\n{prompt}"
+
+    def generate(self, prompt, model_name: str, generation_config: dict, key, timeout: float, cached_content: str = None):
+        latency, error, response = self._plan(self._full_prompt(prompt, cached_content), generation_config, timeout)
+        if self.sleep:
+            time.sleep(latency)
+        if error is not None:
+            raise error
+        return response
+
+    async def generate_async(self, prompt, model_name: str, generation_config: dict, key, timeout: float, cached_content: str = None):
+        latency, error, response = self._plan(self._full_prompt(prompt, cached_content), generation_config, timeout)
+        if self.sleep:
+            await asyncio.sleep(latency)
+        if error is not None:
+            raise error
+        return response
+
+def stub_api_keys(count: int = LLM_STUB_KEYS):
+    """Placeholder keys for the key pool when no real API is called."""
+    return [f"stub-key-{index + 1}" for index in range(max(1, count))]
@@ -0,0 +1,174 @@
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+# Set LLM_USAGE_TRACKING=0 to stop recording calls
+LLM_USAGE_TRACKING = os.getenv('LLM_USAGE_TRACKING', '1') != '0'
+# Records are written to MongoDB in batches of this size (and on flush/exit)
+LLM_USAGE_FLUSH_SIZE = int(os.getenv('LLM_USAGE_FLUSH_SIZE', '50'))
+# USD per million tokens as (prompt, response, cached prompt). Override with
+# LLM_PRICING='{"model": [prompt, response, cached], ...}'
+MODEL_PRICING = {
+    'gemini-2.0-flash': (0.10, 0.40, 0.025),
+    'gemini-2.0-flash-lite': (0.075, 0.30, 0.01875),
+    'gemini-1.5-flash': (0.075, 0.30, 0.01875),
+    'gemini-1.5-pro': (1.25, 5.00, 0.3125),
+}
+MODEL_PRICING.update({model: tuple(prices) for model, prices in json.loads(os.getenv('LLM_PRICING', '{}')).items()})
+# Batch API requests are billed at this fraction of the interactive price
+BATCH_PRICE_FACTOR = float(os.getenv('LLM_BATCH_PRICE_FACTOR', '0.5'))
+
+# Tags (user_email, campaign_id, product_name, interval_day, ...) attached to calls made in the current context
+_usage_tags = contextvars.ContextVar('llm_usage_tags', default={})
+
+@contextmanager
+def usage_context(**tags):
+    """
+    Tag every LLM call made inside the block. Nested blocks add to (and
+    override) the outer tags. Worker threads only see the tags if they run
+    in a copy of the submitting context (see EmailGenerationEngine.map_ordered).
+    """
+    token = _usage_tags.set({**_usage_tags.get(), **tags})
+    try:
+        yield
+    finally:
+        _usage_tags.reset(token)
+
+def current_tags() -> dict:
+    return dict(_usage_tags.get())
+
+def _price_for(model_name: str):
+    """Pricing for a model name, matching versioned names like models/gemini-2.0-flash-001 by prefix."""
+    name = model_name.split('/')[-1]
+    for model in sorted(MODEL_PRICING, key=len, reverse=True):
+        if name.startswith(model):
+            return MODEL_PRICING[model]
+    return None
+
+def estimate_cost(model_name: str, prompt_tokens: int, response_tokens: int, cached_tokens: int = 0):
+    """Cost in USD of one call, or None when the model has no known pricing."""
+    prices = _price_for(model_name or '')
+    if prices is None:
+        return None
+    prompt_price, response_price, cached_price = prices
+    uncached = max(prompt_tokens - cached_tokens, 0)
+    return (uncached * prompt_price + cached_tokens * cached_price + response_tokens * response_price) / 1_000_000
+
+def usage_from_response(response) -> dict:
+    """Token counts from a Gemini response's usage_metadata (zeros when it is missing)."""
+    metadata = getattr(response, 'usage_metadata', None)
+    def count(field):
+        return int(getattr(metadata, field, 0) or 0) if metadata is not None else 0
+    return {
+        'prompt_tokens': count('prompt_token_count'),
+        'response_tokens': count('candidates_token_count'),
+        'cached_tokens': count('cached_content_token_count'),
+        'total_tokens': count('total_token_count'),
+    }
+
+class UsageRecorder:
+    """
+    Buffers one record per LLM call and writes them to the llm_usage
+    collection in batches, so accounting adds no round trip to the call
+    itself. Also keeps in-process totals for quick summaries.
+    """
+    def __init__(self, flush_size: int = LLM_USAGE_FLUSH_SIZE):
+        self.flush_size = flush_size
+        self._buffer = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._indexes_ready = False
+
+    def record(self, model_name: str, response=None, latency_seconds: float = 0.0, error: str = None, **tags):
+        usage = usage_from_response(response)
+        cost = estimate_cost(model_name, usage['prompt_tokens'], usage['response_tokens'], usage['cached_tokens'])
+        if cost is not None and tags.get('request_type') == 'batch_api':
+            cost *= BATCH_PRICE_FACTOR
+        record = {
+            **current_tags(),
+            **tags,
+            'model': model_name,
+            **usage,
+            'cost_usd': cost,
+            'latency_ms': round(latency_seconds * 1000, 1),
+            'error': error,
+            'created_at': datetime.now(),
+        }
+        with self._lock:
+            self._buffer.append(record)
+            should_flush = len(self._buffer) >= self.flush_size
+        if should_flush:
+            self.flush()
+        return record
+
+    def flush(self) -> int:
+        """Write buffered records to MongoDB. Returns the number written."""
+        with self._flush_lock:
+            with self._lock:
+                records, self._buffer = self._buffer, []
+            if not records:
+                return 0
+            from mongodb_client import save_llm_usage, ensure_llm_usage_indexes
+            if not self._indexes_ready:
+                try:
+                    ensure_llm_usage_indexes()
+                    self._indexes_ready = True
+                except Exception as e:
+                    logger.warning(f"Could not create llm_usage indexes: {str(e)}")
+            return save_llm_usage(records)
+
+usage_recorder = UsageRecorder()
+
+def record_llm_call(model_name: str, response=None, latency_seconds: float = 0.0, error: str = None, **tags):
+    """Record one LLM call (no-op when tracking is disabled)."""
+    if not LLM_USAGE_TRACKING:
+        return None
+    try:
+        return usage_recorder.record(model_name, response, latency_seconds, error, **tags)
+    except Exception as e:
+        logger.warning(f"Failed to record LLM usage: {str(e)}")
+        return None
+
+def flush_usage() -> int:
+    """Write any buffered usage records now. Failures are logged, never raised."""
+    if not LLM_USAGE_TRACKING:
+        return 0
+    try:
+        return usage_recorder.flush()
+    except Exception as e:
+        logger.warning(f"Failed to flush LLM usage: {str(e)}")
+        return 0
+
+# Don't lose the tail of a run when the process exits
+atexit.register(flush_usage)
+
+class TimedCall:
+    """
+    Context manager that times an LLM call and records it on exit, e.g.
+        with TimedCall(model_name) as call:
+            call.response = model.generate_content(prompt)
+    Failed calls are recorded with their error and the exception propagates.
+    """
+    def __init__(self, model_name: str, **tags):
+        self.model_name = model_name
+        self.tags = tags
+        self.response = None
+        self.latency = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.latency = time.perf_counter() - self._start
+        record_llm_call(self.model_name, self.response, self.latency,
+                        f"{exc_type.__name__}: {exc}" if exc_type else None, **self.tags)
+        return False
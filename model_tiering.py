@@ -0,0 +1,60 @@
+import os
+import json
+from gemini_client import GEMINI_MODEL_NAME
+
+# Try a cheaper model first and escalate on bad output. Off: every email uses GEMINI_MODEL_NAME
+MODEL_TIERING = os.getenv('MODEL_TIERING', 'false').lower() == 'true'
+# The cheap first tier of the default policy
+GEMINI_FAST_MODEL = os.getenv('GEMINI_FAST_MODEL', 'gemini-2.0-flash-lite')
+# Models to try in order, cheapest first. Lookup order: product + interval day,
+# product default, interval day, default. Override (merged per key) with
+# MODEL_TIER_POLICY='{"days": {"3": [...]}, "products": {"predco": {"default": [...], "days": {...}}}}'
+TIER_POLICY = {
+    'default': [GEMINI_FAST_MODEL, GEMINI_MODEL_NAME],
+    # The first email sets the tone of the whole sequence; always use the strong model
+    'days': {'0': [GEMINI_MODEL_NAME]},
+    'products': {},
+}
+for _scope, _value in json.loads(os.getenv('MODEL_TIER_POLICY', '{}')).items():
+    if isinstance(_value, dict):
+        TIER_POLICY[_scope] = dict(TIER_POLICY.get(_scope, {}), **_value)
+    else:
+        TIER_POLICY[_scope] = _value
+
+# Output checks a non-final tier must pass, or the email is escalated
+EMAIL_CLOSING = "Best Regards,"
+EMAIL_MIN_WORDS = int(os.getenv('EMAIL_MIN_WORDS', '60'))
+EMAIL_MAX_WORDS = int(os.getenv('EMAIL_MAX_WORDS', '260'))
+SUBJECT_MAX_CHARS = int(os.getenv('SUBJECT_MAX_CHARS', '120'))
+
+def models_for(product_name: str = None, day: int = None) -> list:
+    """Models to try for an email, cheapest first; the last one is the final tier."""
+    if not MODEL_TIERING:
+        return [GEMINI_MODEL_NAME]
+    product = TIER_POLICY.get('products', {}).get((product_name or '').lower()) or {}
+    if isinstance(product, list):
+        product = {'default': product}
+    day_key = str(day)
+    for models in (product.get('days', {}).get(day_key), product.get('default'),
+                   TIER_POLICY.get('days', {}).get(day_key), TIER_POLICY['default']):
+        if models:
+            return list(models)
+    return [GEMINI_MODEL_NAME]
+
+def tier_label(models: list) -> str:
+    """One string for a tier list, e.g. for cache keys ("gemini-2.0-flash" when untiered)."""
+    return '>'.join(models)
+
+def email_quality_issues(email: dict) -> list:
+    """Reasons a schema-valid email still isn't good enough (empty when it passes)."""
+    issues = []
+    subject = email.get('subject', '').strip()
+    body = email.get('body', '').rstrip()
+    if not body.endswith(EMAIL_CLOSING):
+        issues.append(f'body does not end with "{EMAIL_CLOSING}"')
+    words = len(body.split())
+    if not EMAIL_MIN_WORDS <= words <= EMAIL_MAX_WORDS:
+        issues.append(f"body has {words} words, expected {EMAIL_MIN_WORDS}-{EMAIL_MAX_WORDS}")
+    if len(subject) > SUBJECT_MAX_CHARS:
+        issues.append(f"subject has {len(subject)} characters, expected at most {SUBJECT_MAX_CHARS}")
+    return issues
@@ -1,7 +1,10 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import BulkWriteError
 import os
 import streamlit as st
 import logging
+import time
+import threading
 from datetime import datetime, timedelta
 
 # Try to get MongoDB URI from Streamlit secrets, fallback to environment variable
@@ -15,6 +18,57 @@ collection = db['enriched_leads']  # Use your collection name
 generated_emails_collection = db['generated_emails']  # Use your collection name
 scheduled_emails_collection = db['scheduled_emails']  # New collection for scheduled emails
 signatures_collection = db['signatures']  # New collection for user signatures
+scheduled_emails_archive_collection = db['scheduled_emails_archive']  # Terminal-state scheduled emails moved out of the hot collection
+generated_emails_archive_collection = db['generated_emails_archive']  # Old generated emails moved out of the hot collection
+email_cache_collection = db['email_cache']  # Generated subject/body keyed by a hash of the generation inputs
+llm_usage_collection = db['llm_usage']  # One document per LLM call: tokens, latency, cost and tags
+batch_jobs_collection = db['batch_jobs']  # Bulk generation jobs submitted to the batch interface
+generation_jobs_collection = db['generation_jobs']  # Progress records of checkpointed, resumable generation runs
+generation_job_leads_collection = db['generation_job_leads']  # Lead snapshots of generation jobs, one document per lead
+
+# How long (seconds) a worker owns a claimed scheduled email before another worker may reclaim it
+SCHEDULED_EMAIL_LEASE_SECONDS = int(os.getenv('SCHEDULED_EMAIL_LEASE_SECONDS', '300'))
+
+# How long (seconds) per-user settings such as signatures are served from memory
+SETTINGS_CACHE_TTL = int(os.getenv('SETTINGS_CACHE_TTL', '300'))
+
+class SettingsCache:
+    """
+    Small thread-safe read-through cache for per-user settings documents.
+    Entries expire after `ttl` seconds and can be invalidated explicitly.
+    Missing documents (None) are cached too, so users without settings
+    don't trigger a lookup on every call.
+    """
+    def __init__(self, ttl: int = SETTINGS_CACHE_TTL):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        """Return the cached value for key, calling loader() on a miss or expiry."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                return entry[1]
+        # Load outside the lock so a slow query doesn't block other keys;
+        # exceptions propagate and nothing is cached.
+        value = loader()
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop a single key, or every entry when key is None."""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+# Shared by every get_signature caller in this process (generation pipeline,
+# payload preparation and the Streamlit tabs)
+settings_cache = SettingsCache()
 
 def save_enriched_data(data, user_email):
     """
@@ -62,6 +116,251 @@ def save_generated_emails(emails, user_email):
         print(f"[MongoDB] Failed to save generated emails for {user_email}: {e}")
         return None
 
+def get_cached_generated_emails(cache_keys):
+    """
+    Look up cached generated emails by content hash in one query.
+    Returns {cache_key: {"subject", "body"}} for the keys that were found.
+    """
+    if not cache_keys:
+        return {}
+    try:
+        cursor = email_cache_collection.find({'_id': {'$in': list(cache_keys)}}, {'subject': 1, 'body': 1})
+        return {doc['_id']: {'subject': doc['subject'], 'body': doc['body']} for doc in cursor}
+    except Exception as e:
+        logging.error(f"[MongoDB] Failed to read email cache: {e}")
+        return {}
+
+def save_cached_generated_emails(entries):
+    """
+    Store generated emails keyed by content hash with one unordered bulk upsert.
+    entries maps cache_key -> document (subject, body and any metadata).
+    """
+    if not entries:
+        return 0
+    now = datetime.now()
+    operations = [
+        UpdateOne({'_id': key}, {'$set': dict(document, cached_at=now)}, upsert=True)
+        for key, document in entries.items()
+    ]
+    try:
+        result = email_cache_collection.bulk_write(operations, ordered=False)
+        return result.upserted_count + result.modified_count
+    except Exception as e:
+        logging.error(f"[MongoDB] Failed to write email cache: {e}")
+        return 0
+
+def ensure_llm_usage_indexes():
+    """
+    Create the indexes the usage aggregations filter on. Safe to call repeatedly.
+    """
+    llm_usage_collection.create_index([('user_email', ASCENDING), ('created_at', ASCENDING)])
+    llm_usage_collection.create_index([('campaign_id', ASCENDING)])
+
+def save_llm_usage(records):
+    """Insert a batch of LLM call records in one unordered write. Returns the number inserted."""
+    if not records:
+        return 0
+    try:
+        result = llm_usage_collection.insert_many(records, ordered=False)
+        return len(result.inserted_ids)
+    except BulkWriteError as e:
+        logging.error(f"[MongoDB] Some LLM usage records failed to save: {e.details.get('writeErrors', [])[:3]}")
+        return e.details.get('nInserted', 0)
+    except Exception as e:
+        logging.error(f"[MongoDB] Failed to save LLM usage: {e}")
+        return 0
+
+# Group keys for aggregate_llm_usage
+LLM_USAGE_GROUPS = {
+    'user': '$user_email',
+    'campaign': '$campaign_id',
+    'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$created_at'}},
+    'model': '$model',
+    'interval_day': '$interval_day',
+}
+
+def aggregate_llm_usage(group_by='day', user_email=None, campaign_id=None, since=None):
+    """
+    Sum LLM usage per group ('user', 'campaign', 'day', 'model' or
+    'interval_day'), optionally restricted to a user, a campaign or calls
+    made since a datetime. Returns one dict per group, most recent/largest
+    group key first.
+    """
+    match = {}
+    if user_email:
+        match['user_email'] = user_email
+    if campaign_id:
+        match['campaign_id'] = campaign_id
+    if since:
+        match['created_at'] = {'$gte': since}
+    pipeline = [
+        {'$match': match},
+        {'$group': {
+            '_id': LLM_USAGE_GROUPS[group_by],
+            'calls': {'$sum': 1},
+            'errors': {'$sum': {'$cond': [{'$ifNull': ['$error', False]}, 1, 0]}},
+            'prompt_tokens': {'$sum': '$prompt_tokens'},
+            'response_tokens': {'$sum': '$response_tokens'},
+            'cached_tokens': {'$sum': '$cached_tokens'},
+            'total_tokens': {'$sum': '$total_tokens'},
+            'cost_usd': {'$sum': '$cost_usd'},
+            'avg_latency_ms': {'$avg': '$latency_ms'},
+            'max_latency_ms': {'$max': '$latency_ms'},
+            'first_call': {'$min': '$created_at'},
+            'last_call': {'$max': '$created_at'},
+        }},
+        {'$sort': {'_id': -1}}
+    ]
+    try:
+        results = []
+        for doc in llm_usage_collection.aggregate(pipeline):
+            doc[group_by] = doc.pop('_id')
+            results.append(doc)
+        return results
+    except Exception as e:
+        logging.error(f"[MongoDB] Failed to aggregate LLM usage by {group_by}: {e}")
+        return []
+
+def save_generation_job(job):
+    """Insert a generation job record. Returns its id."""
+    return generation_jobs_collection.insert_one(job).inserted_id
+
+def update_generation_job(job_id, fields=None, increments=None):
+    """Set fields on (and $inc counters of) a generation job record."""
+    update = {'$set': dict(fields or {}, updated_at=datetime.now())}
+    if increments:
+        update['$inc'] = increments
+    generation_jobs_collection.update_one({'_id': job_id}, update)
+
+def fetch_generation_job(job_id):
+    return generation_jobs_collection.find_one({'_id': job_id})
+
+def fetch_generation_jobs(user_email, limit=20):
+    """A user's most recent generation jobs."""
+    return list(generation_jobs_collection.find({'user_email': user_email}).sort('created_at', -1).limit(limit))
+
+def save_generation_job_leads(job_id, leads, lead_products=None):
+    """
+    Snapshot a job's leads, one document per (job_id, lead_index), so large
+    campaigns stay clear of the document size limit. lead_products
+    optionally gives a product per lead. Re-saving replaces the snapshot.
+    """
+    generation_job_leads_collection.delete_many({'job_id': job_id})
+    if not leads:
+        return
+    products = lead_products or [None] * len(leads)
+    generation_job_leads_collection.insert_many([
+        {'job_id': job_id, 'lead_index': index, 'lead': lead, 'product_name': product}
+        for index, (lead, product) in enumerate(zip(leads, products))
+    ], ordered=False)
+
+def fetch_generation_job_leads(job_id):
+    """A job's lead snapshots in lead order: {"lead_index", "lead", "product_name"} each."""
+    return list(generation_job_leads_collection.find({'job_id': job_id}, {'_id': 0, 'job_id': 0}).sort('lead_index', ASCENDING))
+
+def save_generated_lead_blocks(blocks, user_email):
+    """
+    Checkpoint generated lead blocks: one upsert per (campaign_id, lead_index),
+    so re-running part of a job never duplicates a lead. Returns the number written.
+    """
+    if not blocks:
+        return 0
+    operations = [
+        UpdateOne(
+            {'campaign_id': block['campaign_id'], 'lead_index': block['lead_index']},
+            {'$set': dict(block, user_email=user_email)},
+            upsert=True
+        )
+        for block in blocks
+    ]
+    result = generated_emails_collection.bulk_write(operations, ordered=False)
+    return result.upserted_count + result.modified_count
+
+def fetch_completed_lead_indexes(campaign_id):
+    """Lead indexes of a job that already have saved results."""
+    return set(generated_emails_collection.distinct('lead_index', {'campaign_id': campaign_id, 'lead_index': {'$exists': True}}))
+
+def ensure_generation_job_indexes():
+    """Index generated_emails for checkpoint lookups. Safe to call repeatedly."""
+    generated_emails_collection.create_index([('campaign_id', ASCENDING), ('lead_index', ASCENDING)])
+    generation_jobs_collection.create_index([('user_email', ASCENDING), ('created_at', ASCENDING)])
+    generation_job_leads_collection.create_index([('job_id', ASCENDING), ('lead_index', ASCENDING)], unique=True)
+
+def fetch_unfinished_campaign_ids():
+    """
+    Campaign ids whose generated_emails blocks are still being written or
+    read back: generation jobs that are running, failed or completed with
+    failed leads, and batch jobs not yet ingested.
+    """
+    generation_ids = generation_jobs_collection.distinct('_id', {'$or': [
+        {'state': {'$ne': 'completed'}},
+        {'$expr': {'$lt': ['$completed_leads', '$lead_count']}}
+    ]})
+    batch_ids = batch_jobs_collection.distinct('campaign_id', {'state': {'$in': ['submitted', 'ingesting']}})
+    return list(set(generation_ids) | set(batch_ids))
+
+def save_batch_job(job):
+    """Insert a batch generation job record. Returns its id."""
+    return batch_jobs_collection.insert_one(job).inserted_id
+
+def update_batch_job(job_id, fields):
+    """Set fields on a batch job record."""
+    batch_jobs_collection.update_one({'_id': job_id}, {'$set': dict(fields, updated_at=datetime.now())})
+
+def fetch_batch_jobs(user_email=None, states=None):
+    """Batch jobs, newest first, optionally for one user and/or in the given states."""
+    query = {}
+    if user_email:
+        query['user_email'] = user_email
+    if states:
+        query['state'] = {'$in': list(states)}
+    return list(batch_jobs_collection.find(query, {'items': 0}).sort('created_at', -1))
+
+def fetch_batch_job(job_id):
+    return batch_jobs_collection.find_one({'_id': job_id})
+
+def claim_batch_job_ingest(job_id, stale_before: datetime):
+    """
+    Atomically move a finished batch job from submitted to ingesting, so only
+    one poller ingests its results. An ingest that started before
+    stale_before (its poller died) can be claimed again. Returns the job, or
+    None if someone else holds it.
+    """
+    return batch_jobs_collection.find_one_and_update(
+        {'_id': job_id, '$or': [
+            {'state': 'submitted'},
+            {'state': 'ingesting', 'ingest_started_at': {'$lt': stale_before}}
+        ]},
+        {'$set': {'state': 'ingesting', 'ingest_started_at': datetime.now(), 'updated_at': datetime.now()}},
+        return_document=ReturnDocument.AFTER
+    )
+
+def save_batch_lead_blocks(blocks, user_email):
+    """
+    Save a batch job's lead blocks with one upsert per (campaign_id, lead_id,
+    batch_job_id), so ingesting the same output twice never duplicates a lead.
+    Returns the number written.
+    """
+    if not blocks:
+        return 0
+    operations = [
+        UpdateOne(
+            {'campaign_id': block['campaign_id'], 'lead_id': block['lead_id'], 'batch_job_id': block['batch_job_id']},
+            {'$set': dict(block, user_email=user_email)},
+            upsert=True
+        )
+        for block in blocks
+    ]
+    result = generated_emails_collection.bulk_write(operations, ordered=False)
+    return result.upserted_count + result.modified_count
+
+def fetch_generated_emails_for_campaign(campaign_id, user_email=None):
+    """Generated lead blocks saved for a campaign (e.g. by a batch job)."""
+    query = {'campaign_id': campaign_id}
+    if user_email:
+        query['user_email'] = user_email
+    return list(generated_emails_collection.find(query))
+
 def lead_exists(lead_id=None, email=None):
     """
     Check if a lead already exists in the database by lead_id or email.
@@ -131,50 +430,342 @@ def get_due_scheduled_emails(current_time):
         'status': 'pending'
     }))
 
-def mark_email_as_sent(email_id):
+def ensure_scheduled_email_indexes():
     """
-    Mark a scheduled email as sent.
+    Create the indexes the claim query relies on. Safe to call repeatedly.
     """
-    scheduled_emails_collection.update_one({'_id': email_id}, {'$set': {'status': 'sent'}})
+    scheduled_emails_collection.create_index([('status', ASCENDING), ('scheduled_time', ASCENDING)])
+    scheduled_emails_collection.create_index([('status', ASCENDING), ('lease_expires_at', ASCENDING)])
+    scheduled_emails_collection.create_index([('generation_status', ASCENDING), ('scheduled_time', ASCENDING)])
 
-def schedule_followup_emails(lead_email: str, base_payload: dict, followup_days: list, user_email: str):
+def claim_due_scheduled_email(worker_id: str, due_before: datetime = None, lease_seconds: int = SCHEDULED_EMAIL_LEASE_SECONDS):
+    """
+    Atomically claim one due scheduled email for worker_id.
+    A document is claimable when it is pending and due, or when it is in_progress
+    but its lease has expired (the previous owner crashed or stalled).
+    Follow-ups whose content hasn't been generated yet are never claimed.
+    The claimed document is moved to in_progress with a lease owner and expiry
+    and returned; None means nothing is due.
+    """
+    now = datetime.now()
+    due_before = due_before or now
+    return scheduled_emails_collection.find_one_and_update(
+        {
+            'scheduled_time': {'$lte': due_before},
+            'responded': {'$ne': True},
+            'generation_status': {'$nin': ['deferred', 'generating']},
+            '$or': [
+                {'status': 'pending'},
+                {'status': 'in_progress', 'lease_expires_at': {'$lt': now}}
+            ]
+        },
+        {
+            '$set': {
+                'status': 'in_progress',
+                'lease_owner': worker_id,
+                'lease_expires_at': now + timedelta(seconds=lease_seconds),
+                'claimed_at': now
+            },
+            '$inc': {'claim_count': 1}
+        },
+        sort=[('scheduled_time', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def claim_deferred_generation(worker_id: str, generate_before: datetime, lease_seconds: int = SCHEDULED_EMAIL_LEASE_SECONDS):
+    """
+    Atomically claim one pending follow-up whose content is still to be
+    generated and whose scheduled_time is at or before generate_before.
+    Failed generations wait until their next_attempt_at. Generations
+    abandoned by a crashed worker are reclaimed once their lease expires. The claimed document is returned with generation_status
+    'generating'; None means nothing needs generating yet.
+    """
+    now = datetime.now()
+    return scheduled_emails_collection.find_one_and_update(
+        {
+            'status': 'pending',
+            'responded': {'$ne': True},
+            'scheduled_time': {'$lte': generate_before},
+            '$or': [
+                {'generation_status': 'deferred', 'next_attempt_at': {'$not': {'$gt': now}}},
+                {'generation_status': 'generating', 'generation_lease_expires_at': {'$lt': now}}
+            ]
+        },
+        {
+            '$set': {
+                'generation_status': 'generating',
+                'generation_lease_owner': worker_id,
+                'generation_lease_expires_at': now + timedelta(seconds=lease_seconds)
+            },
+            '$inc': {'generation_attempts': 1}
+        },
+        sort=[('scheduled_time', ASCENDING)],
+        return_document=ReturnDocument.AFTER
+    )
+
+def claim_deferred_generations(worker_id: str, limit: int, generate_before: datetime, lease_seconds: int = SCHEDULED_EMAIL_LEASE_SECONDS):
+    """Claim up to `limit` follow-ups to generate for worker_id."""
+    claimed = []
+    while len(claimed) < limit:
+        email = claim_deferred_generation(worker_id, generate_before, lease_seconds)
+        if email is None:
+            break
+        claimed.append(email)
+    return claimed
+
+def _generation_lease_query(email_id, worker_id):
+    return {'_id': email_id, 'generation_status': 'generating', 'generation_lease_owner': worker_id}
+
+def complete_deferred_generation(email_id, subject: str, body: str, worker_id: str, stamp: dict = None):
+    """
+    Store the generated subject and body (and the input hashes they were
+    generated from) and make the follow-up sendable. Only applies while
+    worker_id holds the generation lease. Returns True if updated.
+    """
+    fields = {'subject': subject, 'body': body, 'generation_status': 'ready', 'generated_at': datetime.now()}
+    fields.update({f'generation.{key}': value for key, value in (stamp or {}).items()})
+    result = scheduled_emails_collection.update_one(
+        _generation_lease_query(email_id, worker_id),
+        {
+            '$set': fields,
+            '$unset': {'generation_lease_owner': '', 'generation_lease_expires_at': '', 'generation_error': '', 'next_attempt_at': ''}
+        }
+    )
+    return result.modified_count == 1
+
+def release_deferred_generation(email_id, error: str, worker_id: str, give_up: bool = False, retry_after: float = 0):
+    """
+    Return a failed generation to the queue, claimable again after
+    retry_after seconds, or fail the follow-up outright when give_up is set
+    (e.g. after too many attempts).
+    """
+    next_attempt_at = datetime.now() + timedelta(seconds=retry_after)
+    update = {'$set': {'generation_status': 'deferred', 'generation_error': error, 'next_attempt_at': next_attempt_at},
+              '$unset': {'generation_lease_owner': '', 'generation_lease_expires_at': ''}}
+    if give_up:
+        update['$set'].update({'status': 'failed', 'generation_status': 'failed', 'error': f"Generation failed: {error}"})
+    scheduled_emails_collection.update_one(_generation_lease_query(email_id, worker_id), update)
+
+def fetch_regeneration_candidates(user_email: str = None):
+    """
+    Pending scheduled emails that already have content and a generation
+    record, i.e. the ones incremental regeneration may rewrite.
+    """
+    query = {
+        'status': 'pending',
+        'generation': {'$exists': True},
+        'generation_status': {'$nin': ['deferred', 'generating']}
+    }
+    if user_email:
+        # Follow-ups scheduled before user_email was stored only carry the sender
+        query['$or'] = [{'user_email': user_email}, {'user_email': {'$exists': False}, 'sender_email': user_email}]
+    return list(scheduled_emails_collection.find(query))
+
+def replace_scheduled_email_content(email_id, subject: str, body: str, stamp: dict, expected_stamp: dict):
+    """
+    Swap in regenerated content, only if the email is still pending and was
+    stamped with expected_stamp (so a send or a concurrent regeneration
+    always wins). Returns True if updated.
+    """
+    query = {'_id': email_id, 'status': 'pending'}
+    query.update({f'generation.{key}': value for key, value in expected_stamp.items()})
+    fields = {'subject': subject, 'body': body, 'regenerated_at': datetime.now()}
+    fields.update({f'generation.{key}': value for key, value in stamp.items()})
+    result = scheduled_emails_collection.update_one(query, {'$set': fields})
+    return result.modified_count == 1
+
+def cancel_conversation_followups(conversation_id: str):
+    """Cancel every pending follow-up of a conversation that got a reply. Returns the number cancelled."""
+    result = scheduled_emails_collection.update_many(
+        {'conversation_id': conversation_id, 'status': 'pending'},
+        {'$set': {'status': 'cancelled', 'responded': True}}
+    )
+    return result.modified_count
+
+def fetch_pending_schedule():
     """
-    Schedule follow-up emails for a lead.
+    Return (_id, scheduled_time) for every pending, unanswered scheduled email.
+    Used by the worker to seed its in-memory schedule.
+    """
+    cursor = scheduled_emails_collection.find(
+        {'status': 'pending', 'responded': {'$ne': True}},
+        {'scheduled_time': 1}
+    )
+    return [(doc['_id'], doc['scheduled_time']) for doc in cursor if doc.get('scheduled_time')]
+
+def watch_scheduled_emails(resume_after=None, max_await_time_ms: int = 5000):
+    """
+    Open a change stream on scheduled_emails covering inserts, updates,
+    replacements and deletes, with the post-update document attached.
+    Raises pymongo OperationFailure on deployments without change streams
+    (standalone servers).
+    """
+    pipeline = [{'$match': {'operationType': {'$in': ['insert', 'update', 'replace', 'delete']}}}]
+    return scheduled_emails_collection.watch(
+        pipeline,
+        full_document='updateLookup',
+        resume_after=resume_after,
+        max_await_time_ms=max_await_time_ms
+    )
+
+def _lease_query(email_id, worker_id=None):
+    query = {'_id': email_id}
+    if worker_id:
+        # Only the current lease holder may complete the email
+        query.update({'status': 'in_progress', 'lease_owner': worker_id})
+    return query
+
+def mark_email_as_sent(email_id, worker_id: str = None):
+    """
+    Mark a scheduled email as sent and release its lease.
+    When worker_id is given the update only applies while that worker still
+    holds the lease. Returns True if the document was updated.
+    """
+    result = scheduled_emails_collection.update_one(
+        _lease_query(email_id, worker_id),
+        {
+            '$set': {'status': 'sent', 'sent_at': datetime.now()},
+            '$unset': {'lease_owner': '', 'lease_expires_at': ''}
+        }
+    )
+    return result.modified_count > 0
+
+def mark_email_as_failed(email_id, error: str, worker_id: str = None):
+    """
+    Mark a scheduled email as failed and release its lease.
+    Returns True if the document was updated.
+    """
+    result = scheduled_emails_collection.update_one(
+        _lease_query(email_id, worker_id),
+        {
+            '$set': {'status': 'failed', 'error': error},
+            '$unset': {'lease_owner': '', 'lease_expires_at': ''}
+        }
+    )
+    return result.modified_count > 0
+
+def compute_scheduled_times(base_time: datetime, interval_days: list, is_development: bool = False) -> list:
+    """
+    Compute the send time for a whole list of follow-ups in one vectorized pass.
+    In production each follow-up goes out at 9 AM on base_time + interval_day;
+    in development everything is due two minutes after base_time.
+    """
+    if is_development:
+        return [base_time + timedelta(minutes=2)] * len(interval_days)
+    import pandas as pd
+    offsets = pd.to_timedelta(pd.Series(interval_days, dtype='int64'), unit='D')
+    times = (pd.Timestamp(base_time) + offsets).dt.normalize() + pd.Timedelta(hours=9)
+    return [t.to_pydatetime() for t in times]
+
+def build_followup_documents(payloads: list, current_time: datetime = None, user_email: str = None) -> list:
+    """
+    Build scheduled_emails documents in memory for a list of follow-up payloads
+    (as prepared by the Send Emails tab: email, subject, body, interval_day,
+    sender_email, sender_name, lead_id, lead_name, the generation inputs
+    and stamps, and deferred for follow-ups generated just in time).
+    """
+    current_time = current_time or datetime.now()
+    is_development = os.getenv('ENVIRONMENT', 'production').lower() == 'development'
+    scheduled_times = compute_scheduled_times(
+        current_time, [p.get('interval_day', 0) for p in payloads], is_development
+    )
+    stamp = current_time.strftime('%Y%m%d%H%M%S')
+
+    documents = []
+    for payload, scheduled_time in zip(payloads, scheduled_times):
+        lead_email = payload['email'][0]
+        document = {
+            "email": payload['email'],
+            "subject": payload['subject'],
+            "body": payload['body'],
+            "sender_email": payload['sender_email'],
+            "sender_name": payload['sender_name'],
+            "scheduled_time": scheduled_time,
+            "status": "pending",
+            "followup_day": 0 if is_development else payload.get('interval_day', 0),
+            "responded": False,
+            "conversation_id": f"{payload['sender_email']}_{lead_email}_{stamp}",
+            "lead_id": payload.get('lead_id', ""),
+            "lead_name": payload.get('lead_name', "")
+        }
+        if payload.get('generation'):
+            document["generation"] = payload['generation']
+        if payload.get('deferred'):
+            # Content is generated by the worker shortly before scheduled_time
+            document.update({
+                "generation_status": "deferred",
+                "campaign_started_at": current_time
+            })
+        if user_email:
+            document["user_email"] = user_email
+        documents.append(document)
+    return documents
+
+def insert_scheduled_emails(documents: list):
     """
+    Write scheduled email documents with a single unordered insert_many.
+    Returns a (inserted, failed) tuple; one bad document doesn't stop the rest.
+    """
+    if not documents:
+        return 0, 0
     try:
-        # Get the lead's company name
-        lead = collection.find_one({"email": lead_email})
-        company_name = lead.get('company', 'your company') if lead else 'your company'
-        
-        # Get product name from the base payload
+        result = scheduled_emails_collection.insert_many(documents, ordered=False)
+        logging.info(f"[MongoDB] Scheduled {len(result.inserted_ids)} emails in one bulk insert")
+        return len(result.inserted_ids), 0
+    except BulkWriteError as e:
+        inserted = e.details.get('nInserted', 0)
+        logging.error(f"[MongoDB] Bulk scheduling partially failed ({inserted}/{len(documents)} inserted): {e.details.get('writeErrors', [])[:3]}")
+        return inserted, len(documents) - inserted
+    except Exception as e:
+        logging.error(f"[MongoDB] Failed to bulk schedule emails: {e}")
+        return 0, len(documents)
+
+def schedule_followup_emails_bulk(payloads: list, current_time: datetime = None, user_email: str = None):
+    """
+    Schedule every follow-up payload of a campaign in one round trip.
+    Returns a (inserted, failed) tuple.
+    """
+    documents = build_followup_documents(payloads, current_time, user_email)
+    return insert_scheduled_emails(documents)
+
+def schedule_campaign_followups(base_payloads: list, followup_days: list, user_email: str):
+    """
+    Schedule the same set of follow-up days for many leads at once.
+    Company names are fetched with a single $in query instead of one find_one
+    per lead, and all documents are written with one insert_many.
+    Returns a (inserted, failed) tuple.
+    """
+    lead_emails = [p["email"] for p in base_payloads]
+    companies = {
+        lead['email']: lead.get('company', 'your company')
+        for lead in collection.find({"email": {"$in": lead_emails}}, {"email": 1, "company": 1})
+    }
+
+    followup_payloads = []
+    for base_payload in base_payloads:
+        company_name = companies.get(base_payload["email"], 'your company')
         product_name = base_payload.get("product_name", "our product")
-        
-        # Create follow-up subject
         followup_subject = f"Follow-up: {product_name} for {company_name}"
-        
-        # Schedule each follow-up email
         for day in followup_days:
-            scheduled_time = datetime.now() + timedelta(days=day)
-            
-            # Create the email payload
-            email_payload = {
-                "email": base_payload["email"],
+            followup_payloads.append({
+                "email": [base_payload["email"]],
                 "subject": followup_subject if day > 0 else base_payload.get("subject", ""),
                 "body": base_payload["body"],
                 "sender_email": base_payload["sender_email"],
                 "sender_name": base_payload["sender_name"],
-                "scheduled_time": scheduled_time,
-                "followup_day": 0 if is_development else day,
-                "status": "scheduled",
+                "interval_day": day,
                 "lead_id": base_payload.get("lead_id", ""),
-                "lead_name": base_payload.get("lead_name", ""),
-                "user_email": user_email
-            }
-            
-            # Insert into scheduled_emails collection
-            scheduled_emails_collection.insert_one(email_payload)
-            
-        return True
+                "lead_name": base_payload.get("lead_name", "")
+            })
+    return schedule_followup_emails_bulk(followup_payloads, user_email=user_email)
+
+def schedule_followup_emails(lead_email: str, base_payload: dict, followup_days: list, user_email: str):
+    """
+    Schedule follow-up emails for a lead.
+    """
+    try:
+        _, failed = schedule_campaign_followups([dict(base_payload, email=lead_email)], followup_days, user_email)
+        return failed == 0
     except Exception as e:
         logging.error(f"Error scheduling follow-up emails: {e}")
         return False
@@ -307,6 +898,7 @@ def save_signature(user_email, name, company, linkedin_url):
             },
             upsert=True
         )
+        settings_cache.invalidate(('signature', user_email))
         logging.info(f"[MongoDB] Saved/Updated signature for {user_email}")
         return True
     except Exception as e:
@@ -315,12 +907,16 @@ def save_signature(user_email, name, company, linkedin_url):
 
 def get_signature(user_email):
     """
-    Get a user's signature from MongoDB.
+    Get a user's signature, served from the settings cache when possible.
     Returns None if no signature exists.
     """
     try:
-        signature = signatures_collection.find_one({'user_email': user_email})
-        return signature
+        signature = settings_cache.get(
+            ('signature', user_email),
+            lambda: signatures_collection.find_one({'user_email': user_email})
+        )
+        # Hand out a copy so callers can't mutate the cached document
+        return dict(signature) if signature else None
     except Exception as e:
         logging.error(f"[MongoDB] Failed to get signature for {user_email}: {e}")
         return None
@@ -363,13 +959,7 @@ def check_and_update_email_responses(sender_email: str):
             
             if has_reply:
                 # Mark all pending follow-ups for this conversation as cancelled
-                scheduled_emails_collection.update_many(
-                    {
-                        'conversation_id': conv_id,
-                        'status': 'pending'
-                    },
-                    {'$set': {'status': 'cancelled', 'responded': True}}
-                )
+                cancel_conversation_followups(conv_id)
                 logging.info(f"Marked all follow-ups for conversation {conv_id} as cancelled due to reply")
 
     except Exception as e:
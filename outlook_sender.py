@@ -5,6 +5,7 @@ import streamlit as st
 import pandas as pd
 from O365 import Account
 from outlook_auth import get_outlook_account, get_outlook_email, get_outlook_name, is_outlook_authenticated
+from mongodb_client import get_signature
 import json
 import time
 import requests
@@ -2,13 +2,16 @@ from dotenv import load_dotenv
 import os
 import warnings
 import io
-import google.generativeai as genai
+from gemini_client import generate_content, generate_content_async, GEMINI_MODEL_NAME
+from llm_usage import usage_context
+from model_tiering import models_for, email_quality_issues
 import time
 import asyncio
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, ValidationError
 import json
 import re
 import logging
+import threading
 import streamlit as st
 from outlook_auth import get_outlook_auth_url
 
@@ -26,12 +29,96 @@ console_handler.setLevel(logging.INFO)
 logging.getLogger().addHandler(console_handler)
 logging.getLogger().setLevel(logging.INFO)
 
-genai.configure(api_key=st.secrets["GEMINI_API_KEY"])
-
 class EmailResponse(BaseModel):
     subject: str
     body: str
-    lead_id: str
+    lead_id: str = ""
+
+def response_schema_for(model_cls):
+    """Gemini response schema (OpenAPI subset) for a pydantic model with string fields."""
+    return {
+        "type": "OBJECT",
+        "properties": {name: {"type": "STRING"} for name in model_cls.model_fields},
+        "required": [name for name, field in model_cls.model_fields.items() if field.is_required()]
+    }
+
+# Response schemas enforced through Gemini's JSON mode
+EMAIL_RESPONSE_SCHEMA = response_schema_for(EmailResponse)
+SEQUENCE_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": dict(EMAIL_RESPONSE_SCHEMA["properties"], interval_day={"type": "INTEGER"}),
+        "required": ["interval_day"] + EMAIL_RESPONSE_SCHEMA["required"]
+    }
+}
+BATCH_RESPONSE_SCHEMA = {
+    "type": "ARRAY",
+    "items": {
+        "type": "OBJECT",
+        "properties": dict(EMAIL_RESPONSE_SCHEMA["properties"], lead_key={"type": "STRING"}),
+        "required": ["lead_key"] + EMAIL_RESPONSE_SCHEMA["required"]
+    }
+}
+
+# Attempts per email before it is reported as failed
+MAX_GENERATION_ATTEMPTS = int(os.getenv('MAX_GENERATION_ATTEMPTS', '3'))
+
+# Lead fields the prompts use, in prompt order, with the enriched-row column they come from.
+# Everything else on the row (_id, user_email, social URLs, ...) is left out of the prompt.
+LEAD_PROMPT_FIELDS = {
+    'name': 'name',
+    'title': 'title',
+    'headline': 'headline',
+    'company': 'organization',
+    'company_industry': 'company_industry',
+    'company_overview': 'company_overview',
+    'company_size': 'company_size',
+    'company_location': 'company_location',
+    'experience': 'experience',
+    'education': 'education',
+    'company_keywords': 'company_keywords',
+}
+# Longest value (in characters) kept for a lead field, overridable per field below
+LEAD_FIELD_MAX_CHARS = int(os.getenv('LEAD_FIELD_MAX_CHARS', '300'))
+LEAD_FIELD_LIMITS = {
+    'company_overview': int(os.getenv('LEAD_OVERVIEW_MAX_CHARS', '600')),
+    'company_keywords': int(os.getenv('LEAD_KEYWORDS_MAX_CHARS', '200')),
+}
+# Placeholder values the enrichment step writes for missing data
+EMPTY_LEAD_VALUES = {'', 'n/a', 'none', 'nan', 'null', ', ,'}
+
+def _truncate(text, limit):
+    if len(text) <= limit:
+        return text
+    cut = text[:limit].rsplit(' ', 1)[0] if ' ' in text[:limit] else text[:limit]
+    return cut.rstrip(' ,;') + '...'
+
+def project_lead_for_prompt(lead_details):
+    """
+    The subset of a lead that goes into a prompt: only LEAD_PROMPT_FIELDS,
+    with empty placeholders dropped and long values truncated.
+    """
+    projected = {}
+    for field, source in LEAD_PROMPT_FIELDS.items():
+        value = lead_details.get(field)
+        if value is None:
+            value = lead_details.get(source)
+        if value is None:
+            continue
+        text = ' '.join(str(value).split())
+        if text.lower() in EMPTY_LEAD_VALUES:
+            continue
+        projected[field] = _truncate(text, LEAD_FIELD_LIMITS.get(field, LEAD_FIELD_MAX_CHARS))
+    return projected
+
+def format_lead_details(lead_details):
+    """Compact JSON of the projected lead, as it is embedded in prompts."""
+    return json.dumps(project_lead_for_prompt(lead_details), separators=(',', ':'), ensure_ascii=False)
+
+def lead_company(lead_details):
+    """Company name used in follow-up subjects."""
+    return project_lead_for_prompt(lead_details).get('company', 'your company')
 
 # Define the email generation prompt
 subject_style = """
@@ -765,20 +852,107 @@ Do not include any explanation or other text outside the JSON object.
 '''
 }
 
+# --- Single-request prompt for a lead's whole sequence ---
+SEQUENCE_PROMPT = '''# Gemini prompt for a full outreach sequence
+Generate a personalized outreach sequence for the following lead. Write one email for each interval day listed below; each email is sent only if the lead has not replied to the earlier ones.
+
+Lead Details:
+{lead_details}
+
+Product Details:
+{product_database}
+
+Follow this style guide for the subject of the initial (day 0) email:
+{subject_style}
+
+Follow this style guide for the body of every email:
+{body_style}
+
+Write exactly one email for each of these interval days, following the instructions given for that day:
+{day_sections}
+
+Important:
+1. Every follow-up email (interval_day greater than 0) must use exactly this subject: {initial_subject}
+2. Each follow-up must add something new and must not repeat the content of the earlier emails in the sequence.
+3. Every email body must end with "Best Regards," on a new line, followed by a blank line. Do NOT include the sender's name.
+4. The emails will be sent to: {recipient_name} <{recipient_email}>
+
+You MUST return a valid JSON array with exactly one object per interval day, each with EXACTLY these fields:
+[
+    {{
+        "interval_day": 0,
+        "subject": "Your subject line here",
+        "body": "Your email body here ending with 'Best Regards,' on a new line"
+    }}
+]
+
+The response must be a valid JSON array with no additional text, markdown, or formatting.
+Do not include any explanation or other text outside the JSON array.
+'''
+
+# --- Prompt for several leads sharing the same product and interval day ---
+BATCH_PROMPT = '''# Gemini prompt for a batch of leads
+{task_description}
+Write one separate, individually personalized email for EACH lead listed under "Leads". Do not mix details between leads.
+
+Product Details:
+{product_database}
+
+Follow this style guide for the subject:
+{subject_style}
+
+Follow this style guide for the body:
+{body_style}
+
+Instructions for every email:
+{day_instructions}
+
+Important:
+1. Each lead has a "lead_key". Return it unchanged with that lead's email.
+2. If a lead has a "required_subject", use exactly that as the subject of its email.
+3. Every email body must end with "Best Regards," on a new line, followed by a blank line. Do NOT include the sender's name.
+4. Never include the lead_key or any other identifier in the email itself.
+
+Leads:
+{leads}
+
+You MUST return a valid JSON array with exactly one object per lead, each with EXACTLY these fields:
+[
+    {{
+        "lead_key": "the lead_key of the lead",
+        "subject": "Your subject line here",
+        "body": "Your email body here ending with 'Best Regards,' on a new line"
+    }}
+]
+
+The response must be a valid JSON array with no additional text, markdown, or formatting.
+Do not include any explanation or other text outside the JSON array.
+'''
+
+# Prompt budget for one multi-lead request (rough tokens, see estimate_tokens)
+BATCH_PROMPT_TOKEN_BUDGET = int(os.getenv('BATCH_PROMPT_TOKEN_BUDGET', '24000'))
+# Cap on leads per request so the combined answer fits the model's output limit
+BATCH_MAX_LEADS = int(os.getenv('BATCH_MAX_LEADS', '10'))
+# Times the still-missing leads of a batch are re-requested before per-lead fallback
+BATCH_MAX_RETRIES = 2
+
 # Configure logging
 import logging
 logger = logging.getLogger(__name__)
 
-def generate_email_with_gemini(prompt):
-    """Generate email using Gemini model."""
+def json_generation_config(response_schema):
+    """Generation config that makes Gemini return JSON matching response_schema."""
+    return {"response_mime_type": "application/json", "response_schema": response_schema}
+
+def _response_text(response):
+    """The JSON text of a JSON-mode Gemini response."""
+    return response.text.strip()
+
+def generate_email_with_gemini(prompt, response_schema=EMAIL_RESPONSE_SCHEMA, model_name=GEMINI_MODEL_NAME):
+    """Generate email JSON using the shared Gemini model handle in JSON mode."""
     try:
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        response = model.generate_content(prompt)
-        
-        # Extract JSON from the response
-        json_str = response.text.strip()
-        # Remove any markdown code block markers
-        json_str = re.sub(r'^```json\s*|\s*```$', '', json_str, flags=re.MULTILINE)
+        response = generate_content(prompt, model_name=model_name, generation_config=json_generation_config(response_schema))
+        json_str = _response_text(response)
         
         # Log successful API call
         logger.info("Successfully generated email with Gemini API")
@@ -789,13 +963,97 @@ def generate_email_with_gemini(prompt):
         logger.error(f"Error generating email with Gemini: {str(e)}")
         return None
 
+async def generate_email_with_gemini_async(prompt, response_schema=EMAIL_RESPONSE_SCHEMA, model_name=GEMINI_MODEL_NAME):
+    """Async variant of generate_email_with_gemini."""
+    try:
+        response = await generate_content_async(prompt, model_name=model_name, generation_config=json_generation_config(response_schema))
+        json_str = _response_text(response)
+        logger.info("Successfully generated email with Gemini API")
+        return json_str
+    except Exception as e:
+        logger.error(f"Error generating email with Gemini: {str(e)}")
+        return None
+
+class CompiledPrompt:
+    """
+    A prompt template rendered once for everything that doesn't depend on the
+    lead. The lead-specific placeholders are kept as slots, so rendering for a
+    lead is a single join instead of a full str.format over the whole template.
+    """
+    LEAD_FIELDS = ('lead_details', 'recipient_name', 'recipient_email', 'initial_subject')
+    _SLOT = "\x00{}\x00"
+
+    def __init__(self, template, **static_fields):
+        slots = {field: self._SLOT.format(field) for field in self.LEAD_FIELDS}
+        rendered = template.format(**static_fields, **slots)
+        # Alternating [text, field, text, field, ..., text]
+        self.parts = rendered.split("\x00")
+
+    def render(self, **lead_fields):
+        parts = list(self.parts)
+        for i in range(1, len(parts), 2):
+            parts[i] = lead_fields[parts[i]]
+        return "".join(parts)
+
+class PromptRegistry:
+    """
+    Precomputed prompt material for the products in product_database:
+    each product's JSON is serialized once at startup and indexed by product
+    key, and FOLLOWUP_PROMPTS are compiled once per (product, interval day).
+    """
+    def __init__(self, products, templates, subject_style, body_style):
+        self.templates = templates
+        self.subject_style = subject_style
+        self.body_style = body_style
+        self.products = {key.lower(): details for key, details in products.items()}
+        self._product_json = {key: json.dumps(details, indent=2) for key, details in self.products.items()}
+        self._keys_by_id = {id(details): key for key, details in self.products.items()}
+        self._compiled = {}
+        self._lock = threading.Lock()
+
+    def is_standard(self, prompt, day, subject_style, body_style):
+        """True when a call uses the registered template and style guides unchanged."""
+        return (prompt is self.templates.get(day)
+                and subject_style is self.subject_style and body_style is self.body_style)
+
+    def get_product(self, product_key):
+        return self.products.get(product_key.lower())
+
+    def product_key_for(self, product_details):
+        """The product key if product_details is one of the registered entries, else None."""
+        return self._keys_by_id.get(id(product_details))
+
+    def product_json(self, product_details):
+        """Indented JSON for a product, precomputed for registered products."""
+        key = self.product_key_for(product_details)
+        if key is not None:
+            return self._product_json[key]
+        return json.dumps(product_details, indent=2)
+
+    def get_compiled(self, product_key, product_name, day):
+        """CompiledPrompt for a registered product and interval day, compiled on first use."""
+        cache_key = (product_key, product_name, day)
+        compiled = self._compiled.get(cache_key)
+        if compiled is None:
+            with self._lock:
+                compiled = self._compiled.get(cache_key)
+                if compiled is None:
+                    compiled = CompiledPrompt(
+                        self.templates[day],
+                        product_database=self._product_json[product_key],
+                        subject_style=self.subject_style,
+                        body_style=self.body_style,
+                        product_name=product_name
+                    )
+                    self._compiled[cache_key] = compiled
+        return compiled
+
+prompt_registry = PromptRegistry(product_database, FOLLOWUP_PROMPTS, subject_style, body_style)
+
 def get_product_details(product_name):
-    # Convert product name to lowercase for case-insensitive matching
-    product_name = product_name.lower()
+    # Case-insensitive lookup in the registry's product index
     try:
-        for key, value in product_database.items():
-            if key.lower() == product_name:
-                return value
+        return prompt_registry.get_product(product_name)
     except Exception as e:
         # If running in Streamlit context, show error, else just print
         try:
@@ -804,54 +1062,160 @@ def get_product_details(product_name):
         except ImportError:
             print(f"Error getting product details: {str(e)}")
         return None
-    return None
+
+def validate_email_data(data):
+    """
+    Check one decoded email object against EmailResponse plus basic content
+    checks. Returns ({"subject", "body"}, None) or (None, reason).
+    """
+    try:
+        email = EmailResponse.model_validate(data)
+    except ValidationError as e:
+        return None, f"response does not match schema: {e.errors()[0].get('msg', str(e))}"
+    if not email.subject.strip():
+        return None, "empty subject"
+    if not email.body.strip() or email.body.strip() == 'Best Regards,':
+        return None, "empty body"
+    return {'subject': email.subject, 'body': email.body}, None
+
+def validate_email_response(response):
+    """Decode and validate a single-email JSON response. Returns (email, None) or (None, reason)."""
+    if not response:
+        return None, "no response from Gemini"
+    try:
+        data = json.loads(response)
+    except json.JSONDecodeError as e:
+        return None, f"invalid JSON: {str(e)}"
+    return validate_email_data(data)
+
+def failed_email(error):
+    """
+    Explicit failure result. It has no subject or body, so payload
+    preparation skips it, and generation_failed lets callers report it.
+    """
+    return {'subject': '', 'body': '', 'generation_failed': True, 'error': error}
+
+def generate_validated_email(generate_fn, description, max_attempts=MAX_GENERATION_ATTEMPTS):
+    """
+    Call generate_fn() (which returns response JSON text) until it yields a
+    valid email, at most max_attempts times. Only this one email is retried.
+    Returns the email, or failed_email(...) describing the last error.
+    """
+    error = None
+    for attempt in range(1, max_attempts + 1):
+        try:
+            email, error = validate_email_response(generate_fn())
+        except Exception as e:
+            email, error = None, str(e)
+        if email:
+            return email
+        logger.warning(f"Invalid generation for {description} (attempt {attempt}/{max_attempts}): {error}")
+    logger.error(f"Giving up on {description} after {max_attempts} attempts: {error}")
+    return failed_email(error)
+
+def generate_tiered_email(generate_fn, description, models, max_attempts=MAX_GENERATION_ATTEMPTS):
+    """
+    generate_validated_email over a list of models, cheapest first (see
+    models_for). Every tier but the last gets one attempt, and its email must
+    also pass email_quality_issues; otherwise the email is escalated to the
+    next model. The last tier gets max_attempts, with the schema checks only.
+    generate_fn(model_name) returns response JSON text.
+    """
+    for tier, model_name in enumerate(models[:-1]):
+        with usage_context(model_tier=tier):
+            try:
+                email, error = validate_email_response(generate_fn(model_name))
+            except Exception as e:
+                email, error = None, str(e)
+        if email:
+            issues = email_quality_issues(email)
+            if not issues:
+                return email
+            error = "; ".join(issues)
+        logger.info(f"Escalating {description} from {model_name} to {models[tier + 1]}: {error}")
+    with usage_context(model_tier=len(models) - 1):
+        return generate_validated_email(lambda: generate_fn(models[-1]), description, max_attempts)
+
+def passes_tier_checks(email, model_name, models):
+    """True if an email from model_name needs no escalation: it came from the final tier or passes the quality checks."""
+    return model_name == models[-1] or not email_quality_issues(email)
+
+def build_static_prompt_prefix(product_name, product_details, day):
+    """
+    Render FOLLOWUP_PROMPTS[day] for a product with every lead-specific part
+    replaced by a pointer to the message that follows. The result only
+    depends on (product, day), so it can be cached server-side.
+    """
+    return FOLLOWUP_PROMPTS[day].format(
+        lead_details="Provided in the message that follows these instructions.",
+        product_database=prompt_registry.product_json(product_details),
+        subject_style=subject_style,
+        body_style=body_style,
+        recipient_name="the lead",
+        recipient_email="the lead's email address",
+        product_name=product_name,
+        initial_subject="the Required subject given with the lead details"
+    )
+
+def build_lead_message(lead_details, product_name, day):
+    """The per-request part that goes with build_static_prompt_prefix."""
+    lines = [
+        "Lead Details:",
+        format_lead_details(lead_details),
+        f"The email will be sent to: {lead_details.get('name', 'No recipient')} <{lead_details.get('email', 'No email provided')}>"
+    ]
+    if day > 0:
+        lines.append(f'Required subject: Follow-up: "{product_name} for {lead_company(lead_details)}"')
+    return "\n".join(lines)
+
+def format_email_prompt(lead_details, product_details, prompt, subject_style, body_style, recipient_name, recipient_email, product_name, followup_day=0):
+    """Render a single-email prompt for one lead, using the compiled template when it is a standard one."""
+    lead_fields = dict(
+        lead_details=format_lead_details(lead_details),
+        recipient_name=recipient_name,
+        recipient_email=recipient_email,
+        initial_subject=f'Follow-up: "{product_name} for {lead_company(lead_details)}"'
+    )
+    product_key = prompt_registry.product_key_for(product_details)
+    if product_key is not None and prompt_registry.is_standard(prompt, followup_day, subject_style, body_style):
+        # Standard prompt for a known product: only the lead slots need filling
+        return prompt_registry.get_compiled(product_key, product_name, followup_day).render(**lead_fields)
+    # Format the prompt with lead and product details
+    return prompt.format(
+        product_database=prompt_registry.product_json(product_details),  # Changed from product_details to product_database
+        subject_style=subject_style,
+        body_style=body_style,
+        product_name=product_name,
+        **lead_fields
+    )
+
+def build_email_prompt(lead_details, product_details, product_name, day):
+    """The standard FOLLOWUP_PROMPTS[day] prompt for one lead."""
+    return format_email_prompt(
+        lead_details, product_details, FOLLOWUP_PROMPTS[day], subject_style, body_style,
+        lead_details.get('name', 'No recipient'), lead_details.get('email', 'No email provided'),
+        product_name, day
+    )
 
 def generate_email_for_single_lead_with_custom_prompt(lead_details, product_details, prompt, subject_style, body_style, recipient_name, recipient_email, product_name, followup_day=0):
     """Generate a personalized email for a single lead using a custom prompt."""
     try:
-        # Format the prompt with lead and product details
-        formatted_prompt = prompt.format(
-            lead_details=json.dumps(lead_details, indent=2),
-            product_database=json.dumps(product_details, indent=2),  # Changed from product_details to product_database
-            subject_style=subject_style,
-            body_style=body_style,
-            recipient_name=recipient_name,
-            recipient_email=recipient_email,
-            product_name=product_name,
-            initial_subject=f'Follow-up: "{product_name} for {lead_details.get("company", "your company")}"'
+        formatted_prompt = format_email_prompt(
+            lead_details, product_details, prompt, subject_style, body_style,
+            recipient_name, recipient_email, product_name, followup_day
         )
         
-        # Generate email using Gemini
-        response = generate_email_with_gemini(formatted_prompt)
-        
-        if not response:
-            logger.error("No response received from Gemini API")
-            return {
-                'subject': f'Follow-up: {product_name} for {lead_details.get("company", "your company")}',
-                'body': 'Best Regards,'
-            }
-        
-        # Parse the response
-        try:
-            email_data = json.loads(response)
-            return {
-                'subject': email_data.get('subject', f'Follow-up: {product_name} for {lead_details.get("company", "your company")}'),
-                'body': email_data.get('body', 'Best Regards,')
-            }
-        except json.JSONDecodeError as e:
-            logger.error(f"Error parsing Gemini response: {str(e)}")
-            logger.error(f"Raw response: {response}")
-            return {
-                'subject': f'Follow-up: {product_name} for {lead_details.get("company", "your company")}',
-                'body': 'Best Regards,'
-            }
+        # Generate email using Gemini, retrying (and escalating) just this email if the output is invalid
+        with usage_context(product_name=product_name, interval_day=followup_day, request_type='single'):
+            return generate_tiered_email(
+                lambda model_name: generate_email_with_gemini(formatted_prompt, model_name=model_name),
+                f"{recipient_email} (day {followup_day})",
+                models_for(product_name, followup_day)
+            )
             
     except Exception as e:
         logger.error(f"Error generating email: {str(e)}")
-        return {
-            'subject': f'Follow-up: {product_name} for {lead_details.get("company", "your company")}',
-            'body': 'Best Regards,'
-        }
+        return failed_email(str(e))
 
 def generate_email_for_lead(lead_details, product_details, day=0, product_name=None):
     """Generate a personalized email for a lead."""
@@ -893,3 +1257,309 @@ def generate_email_for_lead(lead_details, product_details, day=0, product_name=N
         }
 
 
+
+
+def get_day_instructions(day):
+    """
+    Pull the day-specific part of FOLLOWUP_PROMPTS[day]: the one-line task
+    description and the instructions that follow the body style guide.
+    Placeholders are left in place for the caller to format.
+    """
+    template = FOLLOWUP_PROMPTS[day]
+    lines = template.split("\n")
+    description = lines[1].strip() if len(lines) > 1 else ""
+    instructions = template.split("{body_style}", 1)[-1].split("You MUST return a valid JSON", 1)[0].strip()
+    return f"{description}\n{instructions}"
+
+def build_sequence_prompt(lead_details, product_details, product_name, days, recipient_name, recipient_email):
+    """Build the single prompt that asks for every interval day of a lead's sequence."""
+    day_sections = "\n\n".join(
+        f"### Interval day {day}\n{get_day_instructions(day)}" for day in sorted(days)
+    )
+    format_args = dict(
+        lead_details=format_lead_details(lead_details),
+        product_database=prompt_registry.product_json(product_details),
+        subject_style=subject_style,
+        body_style=body_style,
+        recipient_name=recipient_name,
+        recipient_email=recipient_email,
+        product_name=product_name,
+        initial_subject=f'Follow-up: "{product_name} for {lead_company(lead_details)}"'
+    )
+    # Day sections carry their own placeholders, so fill them in before the outer template
+    return SEQUENCE_PROMPT.format(day_sections=day_sections.format(**format_args), **format_args)
+
+def parse_sequence_response(response, days):
+    """
+    Parse a sequence response into {day: {"subject", "body"}}.
+    Items that are malformed, for a day that wasn't requested, or missing a
+    subject or body are dropped so the caller can regenerate just those days.
+    """
+    if not response:
+        return {}
+    try:
+        items = json.loads(response)
+    except json.JSONDecodeError as e:
+        logger.error(f"Error parsing Gemini sequence response: {str(e)}")
+        return {}
+    if not isinstance(items, list):
+        logger.error("Gemini sequence response is not a JSON array")
+        return {}
+
+    emails = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        try:
+            day = int(item.get("interval_day"))
+        except (TypeError, ValueError):
+            continue
+        email, _ = validate_email_data(item)
+        if day in days and email:
+            emails[day] = email
+    return emails
+
+def generate_email_sequence_for_lead(lead_details, product_details, product_name, days):
+    """
+    Generate every interval day for one lead in a single Gemini request.
+    Days the model didn't return (or returned invalid) fall back to the
+    per-day prompt. Returns {day: {"subject", "body"}} for all requested days.
+    """
+    days = sorted(days)
+    recipient_name = lead_details.get('name', 'No recipient')
+    recipient_email = lead_details.get('email', 'No email provided')
+    emails = {}
+    try:
+        prompt = build_sequence_prompt(lead_details, product_details, product_name, days, recipient_name, recipient_email)
+        # The earliest day's first tier writes the whole sequence; days that need escalating fall back below
+        model_name = models_for(product_name, days[0])[0]
+        with usage_context(product_name=product_name, interval_day=days, request_type='sequence'):
+            emails = parse_sequence_response(generate_email_with_gemini(prompt, SEQUENCE_RESPONSE_SCHEMA, model_name), days)
+        emails = {day: email for day, email in emails.items() if passes_tier_checks(email, model_name, models_for(product_name, day))}
+    except Exception as e:
+        logger.error(f"Error generating email sequence: {str(e)}")
+
+    missing = [day for day in days if day not in emails]
+    if missing:
+        logger.warning(f"Sequence generation missing days {missing} for {recipient_email}, falling back to per-day prompts")
+    for day in missing:
+        emails[day] = generate_email_for_single_lead_with_custom_prompt(
+            lead_details=lead_details,
+            product_details=product_details,
+            prompt=FOLLOWUP_PROMPTS[day],
+            subject_style=subject_style,
+            body_style=body_style,
+            recipient_name=recipient_name,
+            recipient_email=recipient_email,
+            product_name=product_name,
+            followup_day=day
+        )
+    return emails
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (about 4 characters per token) used for batch packing."""
+    return len(text) // 4 + 1
+
+def _batch_lead_entry(lead_key, lead_details, product_name, day):
+    entry = {"lead_key": lead_key, "recipient": f"{lead_details.get('name', '')} <{lead_details.get('email', '')}>", "lead_details": project_lead_for_prompt(lead_details)}
+    if day > 0:
+        entry["required_subject"] = f'Follow-up: "{product_name} for {lead_company(lead_details)}"'
+    return entry
+
+def _build_batch_prompt(entries, product_details, product_name, day):
+    task_description, day_instructions = get_day_instructions(day).split("\n", 1)
+    fill = dict(product_name=product_name, recipient_name="the lead", recipient_email="the lead's email address")
+    return BATCH_PROMPT.format(
+        task_description=task_description.replace("the following lead", "each of the following leads").format(**fill),
+        product_database=prompt_registry.product_json(product_details),
+        subject_style=subject_style,
+        body_style=body_style,
+        day_instructions=day_instructions.format(**fill),
+        leads=json.dumps(entries, separators=(',', ':'), ensure_ascii=False, default=str)
+    )
+
+def pack_leads_by_token_budget(leads, product_details, product_name, day,
+                               token_budget=BATCH_PROMPT_TOKEN_BUDGET, max_leads=BATCH_MAX_LEADS):
+    """
+    Split leads into batches whose prompt fits token_budget. The shared
+    prefix (product, style guides, instructions) is counted once per batch
+    and each lead adds the size of its own entry. Returns lists of indexes
+    into leads, in order.
+    """
+    prefix_tokens = estimate_tokens(_build_batch_prompt([], product_details, product_name, day))
+    batches, current, current_tokens = [], [], prefix_tokens
+    for index, lead in enumerate(leads):
+        entry_tokens = estimate_tokens(json.dumps(_batch_lead_entry(str(index), lead, product_name, day), separators=(',', ':'), ensure_ascii=False, default=str))
+        if current and (current_tokens + entry_tokens > token_budget or len(current) >= max_leads):
+            batches.append(current)
+            current, current_tokens = [], prefix_tokens
+        current.append(index)
+        current_tokens += entry_tokens
+    if current:
+        batches.append(current)
+    return batches
+
+def parse_batch_response(response, expected_keys):
+    """
+    Parse a batch response into {lead_key: {"subject", "body"}}, keeping only
+    well-formed items for keys that were asked for.
+    """
+    if not response:
+        return {}
+    try:
+        items = json.loads(response)
+    except json.JSONDecodeError as e:
+        logger.error(f"Error parsing Gemini batch response: {str(e)}")
+        return {}
+    if not isinstance(items, list):
+        logger.error("Gemini batch response is not a JSON array")
+        return {}
+
+    emails = {}
+    for item in items:
+        if not isinstance(item, dict):
+            continue
+        key = str(item.get("lead_key", ""))
+        email, _ = validate_email_data(item)
+        if key in expected_keys and email:
+            emails[key] = email
+    return emails
+
+def generate_emails_for_lead_batch(leads, product_details, product_name, day, max_retries=BATCH_MAX_RETRIES):
+    """
+    Generate the interval-day email for several leads in one request.
+    Leads are keyed by lead_id (or their position when ids are missing or
+    repeated). Only leads whose item is missing or invalid are re-requested,
+    up to max_retries times, and any still missing after that fall back to a
+    single-lead call. Returns the emails in the order of leads.
+    """
+    keys = []
+    for index, lead in enumerate(leads):
+        key = str(lead.get("lead_id") or lead.get("id") or "") or f"lead_{index}"
+        keys.append(key if key not in keys else f"{key}_{index}")
+
+    emails = {}
+    pending = list(range(len(leads)))
+    models = models_for(product_name, day)
+    for attempt in range(max_retries + 1):
+        if not pending:
+            break
+        entries = [_batch_lead_entry(keys[i], leads[i], product_name, day) for i in pending]
+        # Each retry moves up a tier; items failing the tier's checks count as missing
+        model_name = models[min(attempt, len(models) - 1)]
+        try:
+            prompt = _build_batch_prompt(entries, product_details, product_name, day)
+            with usage_context(product_name=product_name, interval_day=day, request_type='batch', lead_count=len(pending)):
+                parsed = parse_batch_response(generate_email_with_gemini(prompt, BATCH_RESPONSE_SCHEMA, model_name), {keys[i] for i in pending})
+            emails.update({key: email for key, email in parsed.items() if passes_tier_checks(email, model_name, models)})
+        except Exception as e:
+            logger.error(f"Error generating email batch: {str(e)}")
+        pending = [i for i in pending if keys[i] not in emails]
+        if pending and attempt < max_retries:
+            logger.warning(f"Batch for day {day} missing {len(pending)}/{len(leads)} leads, retrying those (attempt {attempt + 2})")
+
+    results = []
+    for index, lead in enumerate(leads):
+        if keys[index] in emails:
+            results.append(emails[keys[index]])
+            continue
+        logger.warning(f"Falling back to single-lead generation for {lead.get('email', keys[index])} (day {day})")
+        results.append(generate_email_for_single_lead_with_custom_prompt(
+            lead_details=lead,
+            product_details=product_details,
+            prompt=FOLLOWUP_PROMPTS[day],
+            subject_style=subject_style,
+            body_style=body_style,
+            recipient_name=lead.get('name', 'No recipient'),
+            recipient_email=lead.get('email', 'No email provided'),
+            product_name=product_name,
+            followup_day=day
+        ))
+    return results
+
+
+SEGMENT_PROMPT = '''# Gemini prompt for a segment template
+{task_description}
+Instead of writing for one lead, write a reusable email TEMPLATE for every lead in this segment:
+{segment}
+
+Product Details:
+{product_database}
+
+Follow this style guide for the subject:
+{subject_style}
+
+Follow this style guide for the body:
+{body_style}
+
+Instructions:
+{day_instructions}
+
+Template rules:
+1. Personalize ONLY through these placeholders, written exactly as shown, each filled in per lead later:
+{slots}
+2. Do not use any other placeholder or bracketed text, and do not invent lead-specific facts (names, companies, achievements).
+3. Tailor the content to the segment: the industry, the role and the problems people in that role typically have.
+4. {subject_rule}
+
+You MUST return a valid JSON object with EXACTLY these fields:
+{{
+    "subject": "Your subject line here",
+    "body": "Your email body here ending with 'Best Regards,' on a new line"
+}}
+
+The response must be a valid JSON object with no additional text, markdown, or formatting.
+Do not include any explanation or other text outside the JSON object.
+'''
+
+# Placeholders a segment template may use, with what each is filled with
+SEGMENT_TEMPLATE_SLOTS = {
+    'first_name': "the lead's first name",
+    'name': "the lead's full name",
+    'company': "the lead's company",
+    'title': "the lead's job title",
+    'industry': "the lead's industry",
+}
+
+def template_slots(text):
+    """Names of every {{slot}} placeholder used in text."""
+    return set(re.findall(r'\{\{\s*(\w+)\s*\}\}', text or ''))
+
+def build_segment_prompt(segment, product_details, product_name, day):
+    """Prompt for one slot-based template shared by every lead of a segment on an interval day."""
+    task_description, day_instructions = get_day_instructions(day).split("\n", 1)
+    fill = dict(product_name=product_name, recipient_name="{{name}}", recipient_email="the lead's email address")
+    if day > 0:
+        subject_rule = f'Use exactly this subject: Follow-up: "{product_name} for {{{{company}}}}"'
+    else:
+        subject_rule = "The subject must not contain any placeholder."
+    return SEGMENT_PROMPT.format(
+        task_description=task_description.replace("the following lead", "a segment of leads").format(**fill),
+        segment=json.dumps(segment, separators=(',', ':'), ensure_ascii=False),
+        product_database=prompt_registry.product_json(product_details),
+        subject_style=subject_style,
+        body_style=body_style,
+        day_instructions=day_instructions.format(**fill),
+        slots="\n".join(f"   - {{{{{slot}}}}}: {meaning}" for slot, meaning in SEGMENT_TEMPLATE_SLOTS.items()),
+        subject_rule=subject_rule
+    )
+
+def generate_segment_template(segment, product_details, product_name, day):
+    """
+    Generate one {"subject", "body"} template for a segment and interval day.
+    Outputs using placeholders other than SEGMENT_TEMPLATE_SLOTS are retried
+    like any other invalid output; returns failed_email(...) if none is valid.
+    """
+    prompt = build_segment_prompt(segment, product_details, product_name, day)
+
+    def generate(model_name):
+        response = generate_email_with_gemini(prompt, model_name=model_name)
+        unknown = template_slots(response) - set(SEGMENT_TEMPLATE_SLOTS)
+        if unknown:
+            raise ValueError(f"unknown template placeholders: {sorted(unknown)}")
+        return response
+
+    with usage_context(product_name=product_name, interval_day=day, request_type='segment', lead_count=segment.get('lead_count')):
+        return generate_tiered_email(generate, f"segment {segment.get('title')} / {segment.get('company_industry')} (day {day})",
+                                     models_for(product_name, day))
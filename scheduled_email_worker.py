@@ -1,24 +1,105 @@
 import time
 import logging
-from datetime import datetime
-from mongodb_client import get_due_scheduled_emails, mark_email_as_sent, check_and_update_email_responses, scheduled_emails_collection
+import asyncio
+import socket
+import uuid
+import heapq
+from datetime import datetime, timedelta
+from pymongo.errors import OperationFailure, PyMongoError
+from mongodb_client import (
+    claim_due_scheduled_email, mark_email_as_sent, mark_email_as_failed,
+    ensure_scheduled_email_indexes, check_and_update_email_responses,
+    fetch_pending_schedule, watch_scheduled_emails
+)
+from jit_generation import process_deferred_generations, JIT_CHECK_INTERVAL
+from batch_generation import poll_batch_jobs
 import os
 
-def is_time_to_send(scheduled_time):
-    """Check if it's time to send the scheduled email."""
-    # Check if we're in development mode
+# Set to "false" to force the polling loop even on replica sets
+USE_CHANGE_STREAM = os.getenv('WORKER_USE_CHANGE_STREAM', 'true').lower() != 'false'
+# Longest the change stream blocks waiting for an event before re-checking the schedule
+WAKEUP_INTERVAL_MS = int(os.getenv('WORKER_WAKEUP_INTERVAL_MS', '5000'))
+# Full resync of the in-memory schedule (also reclaims expired leases)
+RESYNC_INTERVAL = int(os.getenv('WORKER_RESYNC_INTERVAL', '900'))
+# MongoDB error code for "$changeStream is only supported on replica sets"
+CHANGE_STREAM_UNSUPPORTED = 40573
+
+class EmailSchedule:
+    """
+    In-memory view of pending scheduled emails, ordered by scheduled_time.
+    Entries are kept in a heap with lazy deletion: updating or removing an
+    email only touches the id -> time map, stale heap entries are skipped.
+    """
+    def __init__(self):
+        self._times = {}
+        self._heap = []
+
+    def __len__(self):
+        return len(self._times)
+
+    def load(self, entries):
+        """Replace the schedule with (email_id, scheduled_time) pairs."""
+        self._times = {email_id: scheduled_time for email_id, scheduled_time in entries}
+        self._heap = [(t, str(email_id), email_id) for email_id, t in self._times.items()]
+        heapq.heapify(self._heap)
+
+    def upsert(self, email_id, scheduled_time):
+        self._times[email_id] = scheduled_time
+        heapq.heappush(self._heap, (scheduled_time, str(email_id), email_id))
+
+    def remove(self, email_id):
+        self._times.pop(email_id, None)
+
+    def next_time(self):
+        """Earliest scheduled_time in the schedule, or None if empty."""
+        while self._heap:
+            scheduled_time, _, email_id = self._heap[0]
+            if self._times.get(email_id) == scheduled_time:
+                return scheduled_time
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, cutoff):
+        """Remove and return the ids of every email scheduled at or before cutoff."""
+        due = []
+        while True:
+            scheduled_time = self.next_time()
+            if scheduled_time is None or scheduled_time > cutoff:
+                return due
+            _, _, email_id = heapq.heappop(self._heap)
+            self._times.pop(email_id, None)
+            due.append(email_id)
+
+    def apply_change(self, change):
+        """Update the schedule from a scheduled_emails change stream event."""
+        email_id = change['documentKey']['_id']
+        if change['operationType'] == 'delete':
+            self.remove(email_id)
+            return
+        document = change.get('fullDocument')
+        if (document and document.get('status') == 'pending'
+                and not document.get('responded') and document.get('scheduled_time')):
+            self.upsert(email_id, document['scheduled_time'])
+        else:
+            # Sent, claimed, cancelled, failed or deleted before the lookup
+            self.remove(email_id)
+
+def get_worker_id():
+    """Unique lease owner id for this worker process."""
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+def get_due_cutoff(current_time=None):
+    """
+    Latest scheduled_time that is due to be sent.
+    Follow-ups are already scheduled for 9 AM on their day, so in production
+    anything at or before now is due. In development an email is due 2 minutes
+    after its scheduled time.
+    """
     is_development = os.getenv('ENVIRONMENT', 'production').lower() == 'development'
-    current_time = datetime.now()
-    
+    current_time = current_time or datetime.now()
     if is_development:
-        # In development, check if 2 minutes have passed since the scheduled time
-        time_diff = current_time - scheduled_time
-        return time_diff.total_seconds() >= 120  # 120 seconds = 2 minutes
-    else:
-        # In production, check if it's 9 AM on the scheduled day
-        return (current_time.hour == 9 and 
-                # current_time.minute < 2 and  # Give a 2-minute window
-                current_time.date() == scheduled_time.date())
+        return current_time - timedelta(seconds=120)
+    return current_time
 
 def send_email(email_data):
     """Send a single email using the appropriate sender"""
@@ -33,67 +114,138 @@ def send_email(email_data):
         
         # Send the email
         result = sender.send_email_batch([{
-            'email': email_data['email'][0],
+            'email': email_data['email'],  # both senders expect a list of recipients
             'subject': email_data['subject'],
             'body': email_data['body'],
             'sender_email': email_data['sender_email'],
             'sender_name': email_data['sender_name']
         }])
+        # The Gmail sender is async
+        if asyncio.iscoroutine(result):
+            result = asyncio.run(result)
         
         return result
     except Exception as e:
         logging.error(f"Error sending email: {e}")
         return False
 
-def run_worker():
-    """Run the worker to process scheduled emails."""
+def process_claimed_email(email, worker_id):
+    """Send a claimed email and record the outcome while we still hold its lease."""
+    try:
+        result = send_email(email)
+        if not result:
+            raise Exception("Sender returned no result")
+        if isinstance(result, dict) and result.get('failed'):
+            raise Exception("; ".join(result.get('errors', [])) or "Send failed")
+        if isinstance(result, list) and any(r.get('error') for r in result):
+            raise Exception("; ".join(str(r.get('error')) for r in result if r.get('error')))
+
+        if not mark_email_as_sent(email["_id"], worker_id):
+            logging.warning(f"Lease on scheduled email {email['_id']} was lost before it could be marked sent")
+    except Exception as e:
+        logging.error(f"Error sending scheduled email: {str(e)}")
+        mark_email_as_failed(email["_id"], str(e), worker_id)
+
+def process_due_emails(worker_id):
+    """
+    Send due emails until the backlog is drained. Each email is claimed right
+    before it is sent, so a slow send can't run another claimed email past
+    its lease (and into another worker's hands). Returns the number claimed.
+    """
+    total = 0
+    while True:
+        email = claim_due_scheduled_email(worker_id, due_before=get_due_cutoff())
+        if email is None:
+            return total
+        process_claimed_email(email, worker_id)
+        total += 1
+
+def run_polling_worker(worker_id):
+    """Fallback loop for standalone deployments: scan for due emails every minute."""
     while True:
         try:
-            # Get all pending scheduled emails
-            scheduled_emails = scheduled_emails_collection.find({
-                "status": "pending"
-            })
-            
-            # Group emails by conversation
-            emails_by_conversation = {}
-            for email in scheduled_emails:
-                conv_id = email.get('conversation_id')
-                if conv_id not in emails_by_conversation:
-                    emails_by_conversation[conv_id] = []
-                emails_by_conversation[conv_id].append(email)
-            
-            # Process each conversation
-            for conv_id, emails in emails_by_conversation.items():
-                # Check if any email in the conversation has been responded to
-                has_response = any(email.get('responded', False) for email in emails)
-                
-                if not has_response:
-                    # Process each email in the conversation
-                    for email in emails:
-                        if is_time_to_send(email['scheduled_time']):
-                            try:
-                                # Send the email
-                                send_email(email)
-                                
-                                # Update status
-                                scheduled_emails_collection.update_one(
-                                    {"_id": email["_id"]},
-                                    {"$set": {"status": "sent"}}
-                                )
-                            except Exception as e:
-                                logging.error(f"Error sending scheduled email: {str(e)}")
-                                # Update status to failed
-                                scheduled_emails_collection.update_one(
-                                    {"_id": email["_id"]},
-                                    {"$set": {"status": "failed", "error": str(e)}}
-                                )
-            
-            # Sleep for 1 minute before next check
+            process_deferred_generations(worker_id)
+            poll_batch_jobs()
+            process_due_emails(worker_id)
             time.sleep(60)
             
         except Exception as e:
             logging.error(f"Error in worker loop: {str(e)}")
             time.sleep(60)  # Sleep for 1 minute before retrying
 
+def run_change_stream_worker(worker_id):
+    """
+    Event-driven loop. The worker keeps an in-memory schedule of pending
+    emails that is kept current by a change stream on scheduled_emails, so
+    inserts, reschedules and cancellations take effect immediately. It only
+    goes to the database to claim emails that are actually due, plus a
+    periodic resync that also picks up expired leases. Deferred follow-ups
+    are generated (and batch generation jobs polled) every JIT_CHECK_INTERVAL
+    seconds; storing their content shows up on the stream and puts them back
+    on the schedule.
+    Raises OperationFailure if the deployment doesn't support change streams.
+    """
+    schedule = EmailSchedule()
+    resume_token = None
+    last_resync = None
+    last_generation = None
+    while True:
+        try:
+            with watch_scheduled_emails(resume_after=resume_token, max_await_time_ms=WAKEUP_INTERVAL_MS) as stream:
+                if resume_token is None:
+                    # Fresh stream: seed the schedule after the stream is open so no change is missed
+                    schedule.load(fetch_pending_schedule())
+                    last_resync = time.monotonic()
+                    logging.info(f"Watching scheduled_emails, {len(schedule)} emails pending")
+                while stream.alive:
+                    if last_generation is None or time.monotonic() - last_generation >= JIT_CHECK_INTERVAL:
+                        process_deferred_generations(worker_id)
+                        poll_batch_jobs()
+                        last_generation = time.monotonic()
+                    if time.monotonic() - last_resync >= RESYNC_INTERVAL:
+                        process_due_emails(worker_id)
+                        schedule.load(fetch_pending_schedule())
+                        last_resync = time.monotonic()
+                    elif schedule.pop_due(get_due_cutoff()):
+                        process_due_emails(worker_id)
+                    
+                    change = stream.try_next()
+                    while change is not None:
+                        schedule.apply_change(change)
+                        change = stream.try_next()
+                    resume_token = stream.resume_token
+        except OperationFailure as e:
+            if e.code == CHANGE_STREAM_UNSUPPORTED:
+                raise
+            # e.g. the resume token fell off the oplog; start over with a full resync
+            logging.warning(f"Change stream failed, resyncing: {str(e)}")
+            resume_token = None
+            time.sleep(5)
+        except PyMongoError as e:
+            logging.error(f"Change stream interrupted, resuming: {str(e)}")
+            time.sleep(5)
+        except Exception as e:
+            logging.error(f"Error in worker loop: {str(e)}")
+            time.sleep(5)
+
+def run_worker():
+    """
+    Run the worker to process scheduled emails.
+    Due emails are claimed atomically with a lease, so several worker
+    processes can run side by side without double-sending. Emails whose
+    lease expires (e.g. the worker crashed mid-send) are reclaimed.
+    Uses a change stream for wake-ups where the deployment supports it and
+    falls back to polling otherwise.
+    """
+    worker_id = get_worker_id()
+    logging.info(f"Scheduled email worker {worker_id} starting")
+    ensure_scheduled_email_indexes()
+    if USE_CHANGE_STREAM:
+        try:
+            run_change_stream_worker(worker_id)
+        except OperationFailure as e:
+            logging.warning(f"Change streams unavailable ({str(e)}), falling back to polling")
+    run_polling_worker(worker_id)
+
 if __name__ == "__main__":
     run_worker()
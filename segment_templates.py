@@ -0,0 +1,80 @@
+import re
+from personalised_email import project_lead_for_prompt, template_slots, SEGMENT_TEMPLATE_SLOTS
+
+# Title words that are expanded so spelling variants land in the same segment
+TITLE_ABBREVIATIONS = {
+    'sr': 'senior', 'jr': 'junior', 'vp': 'vice president', 'svp': 'senior vice president',
+    'evp': 'executive vice president', 'avp': 'assistant vice president', 'mgr': 'manager',
+    'dir': 'director', 'eng': 'engineering', 'engg': 'engineering', 'asst': 'assistant',
+    'assoc': 'associate', 'exec': 'executive', 'dept': 'department', 'ops': 'operations',
+    'hr': 'human resources', 'it': 'information technology', 'r&d': 'research and development',
+}
+# Everything after one of these separators is treated as a qualifier ("CTO | Co-founder", "Manager at X")
+TITLE_SEPARATORS = re.compile(r'\s+(?:at|@)\s+|\s*[|,;/(]\s*|\s+-\s+')
+# Segment value for leads missing an industry or title
+UNKNOWN_SEGMENT_VALUE = 'unknown'
+
+def normalize_title(title) -> str:
+    """Lowercased primary title with punctuation dropped and common abbreviations expanded."""
+    title = str(title or '').strip()
+    if title.lower() in ('', 'n/a', 'none', 'nan'):
+        return UNKNOWN_SEGMENT_VALUE
+    primary = TITLE_SEPARATORS.split(title.lower(), 1)[0]
+    words = re.findall(r"[a-z0-9&]+", primary)
+    return ' '.join(TITLE_ABBREVIATIONS.get(word, word) for word in words) or UNKNOWN_SEGMENT_VALUE
+
+def normalize_industry(industry) -> str:
+    industry = ' '.join(str(industry or '').lower().split())
+    return industry if industry not in ('', 'n/a', 'none', 'nan') else UNKNOWN_SEGMENT_VALUE
+
+def segment_key(lead: dict, product_name: str) -> tuple:
+    """(company_industry, normalized title, product) a lead is clustered by."""
+    return (normalize_industry(lead.get('company_industry')), normalize_title(lead.get('title')), product_name.lower())
+
+def group_leads_by_segment(leads: list, product_name: str) -> dict:
+    """{segment_key: [lead indexes]} in first-seen order."""
+    segments = {}
+    for index, lead in enumerate(leads):
+        segments.setdefault(segment_key(lead, product_name), []).append(index)
+    return segments
+
+def describe_segment(leads: list) -> dict:
+    """
+    What the template prompt is told about a segment: the shared industry and
+    title plus a few company-level facts that are common to the leads.
+    """
+    first = project_lead_for_prompt(leads[0])
+    segment = {
+        'company_industry': first.get('company_industry', UNKNOWN_SEGMENT_VALUE),
+        'title': first.get('title', UNKNOWN_SEGMENT_VALUE),
+        'lead_count': len(leads),
+    }
+    sizes = {project_lead_for_prompt(lead).get('company_size') for lead in leads} - {None}
+    if len(sizes) == 1:
+        segment['company_size'] = sizes.pop()
+    return segment
+
+def lead_slot_values(lead: dict) -> dict:
+    """Values for every SEGMENT_TEMPLATE_SLOTS placeholder, taken from the lead's own fields."""
+    projected = project_lead_for_prompt(lead)
+    name = projected.get('name', '')
+    values = {
+        'first_name': name.split()[0] if name else 'there',
+        'name': name or 'there',
+        'company': projected.get('company', 'your company'),
+        'title': projected.get('title', 'your role'),
+        'industry': projected.get('company_industry', 'your industry'),
+    }
+    return {slot: values[slot] for slot in SEGMENT_TEMPLATE_SLOTS}
+
+def render_template(template: str, lead: dict) -> str:
+    """Fill a template's {{slot}} placeholders for one lead. Raises KeyError on an unknown slot."""
+    values = lead_slot_values(lead)
+    missing = template_slots(template) - set(values)
+    if missing:
+        raise KeyError(f"unknown template placeholders: {sorted(missing)}")
+    return re.sub(r'\{\{\s*(\w+)\s*\}\}', lambda match: values[match.group(1)], template)
+
+def render_segment_email(template: dict, lead: dict) -> dict:
+    """Render a segment {"subject", "body"} template for one lead."""
+    return {'subject': render_template(template['subject'], lead), 'body': render_template(template['body'], lead)}